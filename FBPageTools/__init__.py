@@ -1,5 +1,72 @@
-from .reddit import *
-from .fbpage import *
-from .dblogging import *
-from .dbapp import *
+import importlib
 
+# Public names of each submodule. Submodules, and the SDKs they import, are only loaded when one of their names is
+# first used, so a job that posts to Facebook never pays for asyncpraw, aiohttp or openai.
+_EXPORTS = {
+    'reddit': ('DEFAULT_SUBREDDITS', 'main_loop_reddit', 'process_subreddit', 'ingest_subreddits',
+               'run_reddit_scheduler', 'sniff_image', 'wait_for_rate_limit'),
+    'fbpage': ('COMMENT_FIELDS', 'DEFAULT_REPLY', 'POST_FIELDS', 'generate_reply', 'get_all_comments',
+               'get_all_post_comments', 'get_all_posts', 'post_to_facebook', 'remove_dev_posts', 'reply_to_comments',
+               'reply_to_comments_async', 'reply_to_comments_concurrent', 'sync_page'),
+    'fbcrawler': ('GRAPH_URL', 'MAX_BATCH_SIZE', 'MAX_RETRIES', 'MISSING_OBJECT_ERROR', 'bulk_delete_posts',
+                  'crawl_post_comments'),
+    'daemon': ('DEFAULT_CADENCES', 'DEFAULT_REPLY_TIMEOUT', 'DEFAULT_REPLY_WORKERS', 'Daemon', 'Job', 'add_page_jobs',
+               'add_service_jobs', 'build_daemon', 'run_daemon'),
+    'aicache': ('ResponseCache', 'get_response_cache', 'normalize_prompt'),
+    'commands': ('COMMANDS', 'classify_comment'),
+    'mediacache': ('MEDIA_COLUMNS', 'SNIFF_BYTES', 'UPLOAD_COLUMNS', 'discard_media', 'evict_media',
+                   'fetch_to_cache', 'get_cached_media', 'get_media_dir'),
+    'memeindex': ('DEFAULT_MAX_DISTANCE', 'HASH_BITS', 'MultiIndexHash', 'backfill_hashes', 'dhash', 'get_meme_index',
+                  'store_hashes'),
+    'dblogging': ('DEFAULT_LOG_LEVEL', 'DatabaseLogSink', 'LEGACY_PART', 'LOGGING_SCHEMA', 'LOG_LEVELS', 'ROTATIONS',
+                  'close_log_sinks', 'flush_logs', 'get_log_dir', 'get_log_sink', 'list_log_segments', 'log_summary',
+                  'maintain_logs', 'move_legacy_logs', 'query_logs', 'set_log_level'),
+    'metrics': ('ENABLED', 'LATENCY_BUCKETS', 'count_sqlite_statements', 'inc', 'instrument', 'monitor_event_loop_lag',
+                'observe', 'render_prometheus', 'reset_metrics', 'rollup_to_database', 'set_metrics_enabled',
+                'snapshot', 'start_metrics_exporter', 'timed', 'write_prometheus'),
+    'dbapp': ('create_tables', 'log_to_database', 'update_table_post_status', 'upsert_comments', 'upsert_posts'),
+    'migrations': ('MIGRATIONS', 'get_schema_version', 'migrate'),
+    'dbconn': ('CONNECTION_HOOKS', 'ConnectionManager', 'DEFAULT_PRAGMAS', 'close_connections', 'get_connection',
+               'get_connection_manager', 'open_connection'),
+    'asyncdb': ('AsyncDatabase', 'MAX_QUERY_IDS', 'MEME_COLUMNS'),
+    'mediaprep': ('JPEG_QUALITY', 'MAX_SIDE', 'MAX_UPLOAD_BYTES', 'MIN_QUALITY', 'get_upload_dir', 'normalize_image',
+                  'normalize_media'),
+    'graphclient': ('BUSINESS_THROTTLE_CODES', 'DEFAULT_BURST', 'DEFAULT_RATE', 'GraphClient', 'POOL_SIZE',
+                    'RateLimiter', 'SLOWDOWN_USAGE', 'THROTTLE_CODES', 'USAGE_HEADERS', 'get_graph_client',
+                    'get_rate_limiter', 'is_throttle_error', 'parse_usage'),
+    'tenants': ('TENANT_NAME', 'TENANT_SETTINGS', 'UNSET_VARIABLE', 'build_tenant_daemon', 'load_tenants',
+                'run_shared_reddit_ingest', 'run_tenants'),
+}
+
+_owners = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_owners)
+
+
+# ============================
+# Function: __getattr__
+# ============================
+def __getattr__(name):
+    """
+    Import the submodule that defines name on first use and return the attribute.
+
+    Parameters:
+        name (str): A public name of a submodule, or a submodule name.
+
+    Returns:
+        object: The attribute.
+    """
+    if name in _owners:
+        value = getattr(importlib.import_module(f'.{_owners[name]}', __name__), name)
+
+        # Module level flags change at runtime, so only functions and classes are kept
+        if callable(value):
+            globals()[name] = value
+        return value
+    if name in _EXPORTS:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_owners))
@@ -0,0 +1,117 @@
+import argparse
+import os
+
+from dotenv import load_dotenv
+
+
+# Each job imports only the modules it runs, so a short cron job does not load the SDKs of the others
+
+
+def _ingest(args):
+    import asyncio
+
+    from .reddit import ingest_subreddits
+    return asyncio.run(ingest_subreddits(args.database, os.getenv('REDDIT_USER_AGENT'), os.getenv('REDDIT_CLIENT_ID'),
+                                         os.getenv('REDDIT_CLIENT_SECRET'), subreddits=args.subreddit))
+
+
+def _post(args):
+    from .fbpage import post_to_facebook
+    return post_to_facebook(args.database, args.access_token, args.table, strategy=args.strategy)
+
+
+def _sync_posts(args):
+    from .fbpage import get_all_posts
+    return get_all_posts(args.database, args.page_id, args.access_token, incremental=args.incremental)
+
+
+def _sync_comments(args):
+    from .fbpage import get_all_post_comments
+    return get_all_post_comments(args.database, args.access_token, incremental=not args.full)
+
+
+def _reply(args):
+    from .fbpage import reply_to_comments_concurrent
+    return reply_to_comments_concurrent(args.database, args.access_token, os.getenv('MODEL_ENGINE'),
+                                        os.getenv('OPEN_AI_API'), workers=args.workers, timeout=args.timeout,
+                                        use_cache=not args.no_cache)
+
+
+def _cleanup(args):
+    from .dblogging import maintain_logs
+    from .mediacache import evict_media
+
+    report = {'logs': maintain_logs(args.database, retention_days=args.log_retention_days),
+              'media': evict_media(args.database, max_age=args.media_max_age)}
+    if args.pattern:
+        from .fbpage import remove_dev_posts
+        report['posts'] = remove_dev_posts(args.database, args.page_id, args.access_token, args.pattern,
+                                           bulk=args.bulk, dry_run=args.dry_run)
+    return report
+
+
+# ============================
+# Function: main
+# ============================
+def main(argv=None):
+    """
+    Run one job and exit, for cron. Credentials are read from the environment or a .env file, like main.py.
+
+    Parameters:
+        argv (list): Command line arguments. Defaults to sys.argv.
+
+    Returns:
+        object: The job's return value.
+    """
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(prog='python -m FBPageTools', description='Run one FBPageTools job.')
+    parser.add_argument('--database', default=os.getenv('DATABASE_NAME'), help='Path to the application db.')
+    parser.add_argument('--page-id', default=os.getenv('FACEBOOK_PAGE_ID'), help='Facebook page id.')
+    parser.add_argument('--access-token', default=os.getenv('FACEBOOK_PAGE_TOKEN'), help='Facebook page token.')
+    jobs = parser.add_subparsers(dest='job', required=True)
+
+    ingest = jobs.add_parser('ingest', help='Ingest memes from Reddit once.')
+    ingest.add_argument('--subreddit', action='append', help='Subreddit to ingest, may be repeated.')
+    ingest.set_defaults(func=_ingest)
+
+    post = jobs.add_parser('post', help='Publish one quote or meme.')
+    post.add_argument('table', choices=('quotes', 'memes'))
+    post.add_argument('--strategy', default='uniform', help='Selection strategy, see selector.pick_unposted.')
+    post.set_defaults(func=_post)
+
+    sync_posts = jobs.add_parser('sync-posts', help='Store the page\'s posts.')
+    sync_posts.add_argument('--incremental', action='store_true', help='Stop at the first page of known posts.')
+    sync_posts.set_defaults(func=_sync_posts)
+
+    sync_comments = jobs.add_parser('sync-comments', help='Store new comments of stored posts.')
+    sync_comments.add_argument('--full', action='store_true', help='Fetch every comment of every post.')
+    sync_comments.set_defaults(func=_sync_comments)
+
+    reply = jobs.add_parser('reply', help='Reply to queued comment commands.')
+    reply.add_argument('--workers', type=int, default=4, help='Comments answered at the same time.')
+    reply.add_argument('--timeout', type=float, default=60, help='Seconds each OpenAI and Graph request may take.')
+    reply.add_argument('--no-cache', action='store_true', help='Always call OpenAI.')
+    reply.set_defaults(func=_reply)
+
+    cleanup = jobs.add_parser('cleanup', help='Roll up old logs, evict cached media and optionally remove posts.')
+    cleanup.add_argument('--log-retention-days', type=float, default=14, help='Days log detail rows are kept.')
+    cleanup.add_argument('--media-max-age', type=int, default=2592000, help='Seconds cached images are kept.')
+    cleanup.add_argument('--pattern', help='Also remove posts whose message matches this regex.')
+    cleanup.add_argument('--bulk', action='store_true', help='Remove posts with batched requests.')
+    cleanup.add_argument('--dry-run', action='store_true', help='Only report the posts that would be removed.')
+    cleanup.set_defaults(func=_cleanup)
+
+    args = parser.parse_args(argv)
+    if not args.database:
+        parser.error('--database or DATABASE_NAME is required')
+
+    from .dbapp import create_tables
+    create_tables(args.database)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    result = main()
+    if result is not None:
+        print(result)
@@ -0,0 +1,177 @@
+import hashlib
+import re
+import threading
+import time
+
+from .dbconn import get_connection
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# ============================
+# Function: normalize_prompt
+# ============================
+def normalize_prompt(prompt):
+    """
+    Normalize a prompt so near-identical comments share a cache entry: case is folded, whitespace is collapsed and
+    trailing punctuation is removed.
+
+    Parameters:
+        prompt (str): The prompt text sent to OpenAI.
+
+    Returns:
+        str: The normalized prompt.
+    """
+    return re.sub(r'\s+', ' ', prompt).strip().rstrip('?!. ').casefold()
+
+
+# ============================
+# Class: ResponseCache
+# ============================
+class ResponseCache:
+    """
+    Persistent cache of OpenAI responses stored in the openai_cache table, keyed on the request kind, model and
+    normalized prompt. Entries expire after a TTL and the least recently used entries are evicted once the table holds
+    more than max_entries rows.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        ttl (int): Seconds a completion stays valid.
+        image_ttl (int): Seconds an image url stays valid. DallE urls expire after about an hour.
+        max_entries (int): Maximum number of cached responses.
+    """
+
+    def __init__(self, database_name, ttl=604800, image_ttl=3000, max_entries=10000):
+        self.database_name = database_name
+        self.ttl = ttl
+        self.image_ttl = image_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(kind, model, prompt):
+        """
+        Build the cache key for a request.
+
+        Parameters:
+            kind (str): 'question' or 'image'.
+            model (str): The OpenAI model, or the image size for image requests.
+            prompt (str): The prompt text.
+
+        Returns:
+            str: Hex digest identifying the request.
+        """
+        return hashlib.sha256(f'{kind}\0{model}\0{normalize_prompt(prompt)}'.encode('utf-8')).hexdigest()
+
+    def get(self, kind, model, prompt):
+        """
+        Look up a cached response and record the hit or miss.
+
+        Parameters:
+            kind (str): 'question' or 'image'.
+            model (str): The OpenAI model, or the image size for image requests.
+            prompt (str): The prompt text.
+
+        Returns:
+            str: The cached response, or None on a miss or an expired entry.
+        """
+        key = self.make_key(kind, model, prompt)
+        ttl = self.image_ttl if kind == 'image' else self.ttl
+        now = int(time.time())
+
+        conn = get_connection(self.database_name)
+        row = conn.execute('SELECT response, latency FROM openai_cache WHERE key = ? AND created_at >= ?',
+                           (key, now - ttl)).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with conn:
+            conn.execute('UPDATE openai_cache SET last_used = ?, hits = hits + 1 WHERE key = ?', (now, key))
+        with self._lock:
+            self.hits += 1
+            self.saved_seconds += row[1] or 0.0
+        return row[0]
+
+    def put(self, kind, model, prompt, response, latency=None):
+        """
+        Store a response and evict the least recently used entries beyond max_entries.
+
+        Parameters:
+            kind (str): 'question' or 'image'.
+            model (str): The OpenAI model, or the image size for image requests.
+            prompt (str): The prompt text.
+            response (str): The reply text or image url returned by OpenAI.
+            latency (float): Seconds the API call took, used to report time saved by later hits.
+
+        Returns:
+            None
+        """
+        now = int(time.time())
+        conn = get_connection(self.database_name)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO openai_cache (key, kind, model, prompt, response, latency, created_at, '
+                         'last_used, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                         (self.make_key(kind, model, prompt), kind, model, normalize_prompt(prompt), response,
+                          latency, now, now))
+            conn.execute('DELETE FROM openai_cache WHERE key IN (SELECT key FROM openai_cache ORDER BY last_used DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def purge_expired(self):
+        """
+        Delete every expired entry.
+
+        Returns:
+            int: Number of entries deleted.
+        """
+        now = int(time.time())
+        conn = get_connection(self.database_name)
+        with conn:
+            cursor = conn.execute('DELETE FROM openai_cache WHERE (kind = \'image\' AND created_at < ?) '
+                                  'OR (kind != \'image\' AND created_at < ?)', (now - self.image_ttl, now - self.ttl))
+        return cursor.rowcount
+
+    def stats(self):
+        """
+        Return the hit and miss counters for this process.
+
+        Returns:
+            dict: hits, misses, hit_rate and saved_seconds, the API latency avoided by hits.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+                'saved_seconds': round(self.saved_seconds, 3),
+            }
+
+
+# ============================
+# Function: get_response_cache
+# ============================
+def get_response_cache(database_name, **kwargs):
+    """
+    Return the shared response cache for a database, creating it on first use.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        **kwargs: Options passed to ResponseCache when the cache is created.
+
+    Returns:
+        ResponseCache: The cache stored in database_name.
+    """
+    cache = _caches.get(database_name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(database_name)
+            if cache is None:
+                cache = ResponseCache(database_name, **kwargs)
+                _caches[database_name] = cache
+    return cache
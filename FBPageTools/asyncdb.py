@@ -0,0 +1,164 @@
+import asyncio
+import functools
+import time
+
+import aiosqlite
+
+from .dbconn import DEFAULT_PRAGMAS, open_connection
+from .memeindex import get_meme_index
+
+# Columns written by insert_memes, in the order of each row
+MEME_COLUMNS = ('id', 'permalink', 'title', 'author', 'ups', 'created_utc', 'image_link', 'indexed_time', 'posted',
+                'postedOn', 'media_path', 'media_size', 'media_hash')
+
+# Ids per existence query, below SQLite's limit on bound parameters
+MAX_QUERY_IDS = 500
+
+
+# ============================
+# Class: AsyncDatabase
+# ============================
+class AsyncDatabase:
+    """
+    Non-blocking access to the application db for coroutines. Queries run on an aiosqlite connection, which owns its
+    own thread, so the event loop keeps serving other tasks while SQLite reads, writes and commits. The connection
+    is opened in WAL mode with the same pragmas and hooks as dbconn connections.
+
+    Log records need no async path: log_to_database only queues them for the log sink's writer thread.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        pragmas (tuple): (name, value) pairs applied to the connection. Defaults to DEFAULT_PRAGMAS.
+        timeout (float): Seconds the connection waits on a lock before raising.
+    """
+
+    def __init__(self, database_name, pragmas=DEFAULT_PRAGMAS, timeout=30.0):
+        self.database_name = database_name
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self._conn = None
+        self._write_lock = None
+
+    async def open(self):
+        """
+        Open the connection. Called by async with.
+
+        Returns:
+            AsyncDatabase: self.
+        """
+        if self._conn is None:
+            connector = functools.partial(open_connection, self.database_name, self.pragmas, self.timeout)
+            self._conn = await aiosqlite.Connection(connector, 64)
+            self._write_lock = asyncio.Lock()
+        return self
+
+    async def close(self):
+        """
+        Close the connection and stop its thread.
+
+        Returns:
+            None
+        """
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def fetchall(self, sql, params=()):
+        """
+        Run a query and return every row.
+
+        Parameters:
+            sql (str): The query.
+            params (tuple): Bound parameters.
+
+        Returns:
+            list: The rows.
+        """
+        return list(await self._conn.execute_fetchall(sql, params))
+
+    async def executemany(self, sql, rows):
+        """
+        Run a statement for every row and commit. Writers on this connection take turns, so one task's commit never
+        includes another task's half-written rows.
+
+        Parameters:
+            sql (str): The statement.
+            rows (list): Bound parameters of each row.
+
+        Returns:
+            int: Rows changed.
+        """
+        async with self._write_lock:
+            before = self._conn.total_changes
+            await self._conn.executemany(sql, rows)
+            await self._conn.commit()
+            return self._conn.total_changes - before
+
+    async def stored_meme_ids(self, ids):
+        """
+        Return the ids that are already stored in the memes table.
+
+        Parameters:
+            ids (list): Reddit post ids.
+
+        Returns:
+            set: The stored ids.
+        """
+        ids = list(ids)
+        stored = set()
+        for i in range(0, len(ids), MAX_QUERY_IDS):
+            chunk = ids[i:i + MAX_QUERY_IDS]
+            rows = await self.fetchall(f'SELECT id FROM memes WHERE id IN ({", ".join("?" * len(chunk))})', chunk)
+            stored.update(row[0] for row in rows)
+        return stored
+
+    async def insert_memes(self, rows):
+        """
+        Insert memes in one transaction, skipping ids that are already stored.
+
+        Parameters:
+            rows (list): One tuple per meme with the values of MEME_COLUMNS.
+
+        Returns:
+            list: Ids of the rows inserted.
+        """
+        if not rows:
+            return []
+        sql = (f'INSERT OR IGNORE INTO memes ({", ".join(MEME_COLUMNS)}) '
+               f'VALUES ({", ".join("?" * len(MEME_COLUMNS))})')
+        inserted = []
+        async with self._write_lock:
+            try:
+                for row in rows:
+                    cursor = await self._conn.execute(sql, row)
+                    if cursor.rowcount > 0:
+                        inserted.append(row[0])
+                await self._conn.commit()
+            except BaseException:
+                await self._conn.rollback()
+                raise
+        return inserted
+
+    async def store_meme_hashes(self, hashes):
+        """
+        Async version of memeindex.store_hashes. Persist image hashes and add them to the in-memory index, which
+        must already be loaded with get_meme_index.
+
+        Parameters:
+            hashes (list): (meme_id, hash) pairs.
+
+        Returns:
+            None
+        """
+        now = int(time.time())
+        await self.executemany('INSERT OR REPLACE INTO meme_hashes (meme_id, phash, indexed_time) VALUES (?, ?, ?)',
+                               [(meme_id, f'{value:016x}', now) for meme_id, value in hashes])
+        index = get_meme_index(self.database_name)
+        for meme_id, value in hashes:
+            index.add(meme_id, value)
@@ -0,0 +1,27 @@
+# Comment prefixes that ask for a reply, and the command type stored for them. Anything else is stored as 'none'.
+COMMANDS = (
+    ('[question]', 'question'),
+    ('[image]', 'image'),
+)
+
+
+# ============================
+# Function: classify_comment
+# ============================
+def classify_comment(message):
+    """
+    Split a comment into its command type and prompt. Prefixes are matched case-insensitively, like the LIKE
+    filters this replaces, and whitespace around the prompt is removed.
+
+    Parameters:
+        message (str): The comment message.
+
+    Returns:
+        tuple: (command, prompt) where command is 'question', 'image' or 'none', and prompt is None for 'none'.
+    """
+    if message:
+        lowered = message[:16].lower()
+        for prefix, command in COMMANDS:
+            if lowered.startswith(prefix):
+                return command, message[len(prefix):].strip()
+    return 'none', None
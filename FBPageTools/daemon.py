@@ -0,0 +1,435 @@
+import asyncio
+import contextlib
+import functools
+import random
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .dbapp import create_tables, log_to_database
+from .dblogging import flush_logs
+from .fbpage import get_all_post_comments, get_all_posts, post_to_facebook, reply_to_comments_async, sync_page
+from .mediaprep import normalize_media
+from .metrics import inc, monitor_event_loop_lag, observe, rollup_to_database
+from .reddit import DEFAULT_SUBREDDITS, run_reddit_scheduler
+
+# Seconds between runs of each default job. reddit_ingest is the interval of every subreddit in the scheduler.
+# sync_page fetches posts with their comments inline and is off by default, enable it in place of sync_posts.
+# normalize_media re-encodes meme images for upload and is off by default.
+DEFAULT_CADENCES = {
+    'reddit_ingest': 21600,
+    'post_quotes': 14400,
+    'post_memes': 14400,
+    'normalize_media': 0,
+    'sync_posts': 3600,
+    'sync_page': 0,
+    'sync_comments': 900,
+    'reply': 300,
+    'metrics_rollup': 300,
+}
+
+# Comments answered at the same time by each reply run, and seconds each OpenAI and Graph API request may take
+DEFAULT_REPLY_WORKERS = 4
+DEFAULT_REPLY_TIMEOUT = 60
+
+
+# ============================
+# Class: Job
+# ============================
+class Job:
+    """
+    A unit of work run by the Daemon on its own cadence. A job never overlaps itself: the next run is scheduled only
+    after the current one returns, and runs missed while it was busy are skipped instead of queued.
+
+    Parameters:
+        name (str): Unique job name used in logs and metrics.
+        func (callable): Function called with no arguments. A coroutine function when blocking is False.
+        interval (float): Seconds between the starts of two runs. If None the job is a long-running service that is
+            restarted after interval_on_failure seconds whenever it returns or fails.
+        blocking (bool): Run func in the daemon's bounded thread pool instead of on the event loop.
+        jitter (float): Fraction of the interval each wait is randomised by.
+        initial_delay (float): Seconds to wait before the first run.
+        interval_on_failure (float): Seconds before a service job is restarted.
+        group (str): Jobs of one group, e.g. one tenant, share the daemon's per-group limit on busy workers.
+    """
+
+    def __init__(self, name, func, interval, blocking=True, jitter=0.1, initial_delay=0.0, interval_on_failure=60.0,
+                 group=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.blocking = blocking
+        self.jitter = jitter
+        self.initial_delay = initial_delay
+        self.interval_on_failure = interval_on_failure
+        self.group = group
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_started = None
+        self.last_seconds = None
+
+    def stats(self):
+        """
+        Return the job's counters.
+
+        Returns:
+            dict: runs, failures, skipped runs, whether it is running and the duration of the last run.
+        """
+        return {'runs': self.runs, 'failures': self.failures, 'skipped': self.skipped, 'running': self.running,
+                'last_started': self.last_started, 'last_seconds': self.last_seconds}
+
+
+# ============================
+# Class: Daemon
+# ============================
+class Daemon:
+    """
+    Run every job in one asyncio event loop. Blocking SDK calls run in a bounded thread pool, and a blocking job
+    waits for a free worker before it starts, so a slow job delays its own next run instead of piling work onto
+    the pool. SIGINT and SIGTERM stop the daemon gracefully: no new runs start, service jobs are cancelled and
+    in-flight runs get grace seconds to finish.
+
+    Jobs can be grouped, e.g. by tenant. A group never holds more than max_per_group workers, and waiting jobs get
+    free workers in the order they started waiting, so one busy group cannot starve the others.
+
+    Parameters:
+        database_name (str): Path to the application db, used for logging.
+        max_workers (int): Threads available to blocking jobs.
+        grace (float): Seconds in-flight runs are given to finish on shutdown.
+        max_per_group (int): Workers one group of jobs may hold at once. If None a group may use every worker.
+    """
+
+    def __init__(self, database_name, max_workers=4, grace=30.0, max_per_group=None):
+        self.database_name = database_name
+        self.max_workers = max_workers
+        self.grace = grace
+        self.max_per_group = max_per_group
+        self.jobs = {}
+        self._executor = None
+        self._slots = None
+        self._group_slots = {}
+        self._stopping = None
+
+    def add_job(self, job):
+        """
+        Register a job. Jobs must be added before run is called.
+
+        Parameters:
+            job (Job): The job to schedule.
+
+        Returns:
+            Job: The job.
+        """
+        if job.name in self.jobs:
+            raise ValueError(f'Duplicate job name: {job.name}')
+        self.jobs[job.name] = job
+        return job
+
+    def stop(self):
+        """
+        Ask the daemon to shut down. Safe to call from a signal handler on the loop thread.
+
+        Returns:
+            None
+        """
+        if self._stopping is not None and not self._stopping.is_set():
+            log_to_database(self.database_name, 'INFO', 'Daemon stopping', 'Daemon')
+            self._stopping.set()
+
+    async def _sleep(self, seconds):
+        """
+        Sleep for seconds, returning early when the daemon is stopping.
+
+        Returns:
+            bool: True if the daemon is stopping.
+        """
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=max(seconds, 0))
+        except asyncio.TimeoutError:
+            pass
+        return self._stopping.is_set()
+
+    async def run_blocking(self, func, group=None):
+        """
+        Run a blocking function in the daemon's thread pool once a worker, and one of the group's workers, is free.
+        Jobs that fan out over several threads submit each unit of work through this instead of a pool of their own.
+
+        Parameters:
+            func (callable): Function called with no arguments.
+            group (str): The job group the work counts against.
+
+        Returns:
+            object: The function's return value.
+        """
+        async with self._group_slots.get(group, contextlib.nullcontext()), self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func)
+
+    async def _run_once(self, job):
+        job.running = True
+        job.last_started = int(time.time())
+        start = time.perf_counter()
+        try:
+            if job.blocking:
+                await self.run_blocking(job.func, job.group)
+            else:
+                await job.func()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.failures += 1
+            inc('job_failures_total', job=job.name, type=type(e).__name__)
+            log_to_database(self.database_name, 'ERROR', f'Error in job {job.name}: {str(e)}', 'Daemon')
+        finally:
+            job.running = False
+            job.runs += 1
+            job.last_seconds = time.perf_counter() - start
+            observe('job_seconds', job.last_seconds, job=job.name)
+
+    async def _schedule(self, job):
+        if await self._sleep(job.initial_delay):
+            return
+
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await self._run_once(job)
+
+            if job.interval is None:
+                delay = job.interval_on_failure
+                log_to_database(self.database_name, 'WARNING', f'Service job {job.name} returned, restarting in '
+                                                               f'{delay:.0f}s', 'Daemon')
+            else:
+                elapsed = loop.time() - started
+                if elapsed > job.interval:
+                    # Skip the runs missed while busy rather than running them back to back
+                    missed = int(elapsed // job.interval)
+                    job.skipped += missed
+                    inc('job_skipped_total', missed, job=job.name)
+                    log_to_database(self.database_name, 'WARNING', f'Job {job.name} took {elapsed:.1f}s, skipped '
+                                                                   f'{missed} run(s)', 'Daemon')
+                delay = job.interval - elapsed % job.interval
+                delay *= random.uniform(1 - job.jitter, 1 + job.jitter)
+
+            if await self._sleep(delay):
+                return
+
+    async def run(self):
+        """
+        Run every job until stop is called or the process receives SIGINT or SIGTERM.
+
+        Returns:
+            dict: Job name to job stats at shutdown.
+        """
+        # Add a log entry for function entry
+        log_to_database(self.database_name, 'DEBUG', 'Entering Daemon.run function', 'Daemon')
+
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_workers)
+        if self.max_per_group:
+            self._group_slots = {job.group: asyncio.Semaphore(self.max_per_group)
+                                 for job in self.jobs.values() if job.group is not None}
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='daemon-job')
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        tasks = {name: asyncio.create_task(self._schedule(job), name=f'job-{name}') for name, job in self.jobs.items()}
+        log_to_database(self.database_name, 'INFO', f'Daemon started with jobs: {", ".join(self.jobs)}', 'Daemon')
+
+        try:
+            await self._stopping.wait()
+        finally:
+            self._stopping.set()
+
+            # Service jobs never finish on their own, everything else gets the grace period
+            for name, task in tasks.items():
+                if self.jobs[name].interval is None:
+                    task.cancel()
+            done, pending = await asyncio.wait(tasks.values(), timeout=self.grace)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+            still_running = [job.name for job in self.jobs.values() if job.running and job.blocking]
+            if still_running:
+                log_to_database(self.database_name, 'WARNING', f'Blocking jobs still running at shutdown: '
+                                                               f'{", ".join(still_running)}', 'Daemon')
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.remove_signal_handler(sig)
+                except (NotImplementedError, RuntimeError):
+                    pass
+
+            stats = {name: job.stats() for name, job in self.jobs.items()}
+            log_to_database(self.database_name, 'INFO', f'Daemon stopped: {stats}', 'Daemon')
+
+            # Add a log entry for function exit
+            log_to_database(self.database_name, 'DEBUG', 'Exiting Daemon.run function', 'Daemon')
+            flush_logs(self.database_name)
+        return stats
+
+
+# ============================
+# Function: add_page_jobs
+# ============================
+def add_page_jobs(daemon, database_name, page_id=None, access_token=None, model=None, openai_api=None,
+                  reddit_user_agent=None, reddit_client_id=None, reddit_client_secret=None, cadences=None,
+                  subreddits=None, tenant=None, offset=0.0, reply_workers=DEFAULT_REPLY_WORKERS,
+                  reply_timeout=DEFAULT_REPLY_TIMEOUT):
+    """
+    Add the ingest, media, posting, sync and reply jobs of one page to a daemon. Jobs whose credentials are missing
+    are left out.
+
+    Parameters:
+        daemon (Daemon): The daemon to add the jobs to.
+        database_name (str): Path to the page's db.
+        page_id (str): Facebook page id, needed by sync_posts.
+        access_token (str): Facebook page token, needed by every Facebook job.
+        model (str): OpenAI chat completion model, needed by reply.
+        openai_api (str): OpenAI API Key, needed by reply.
+        reddit_user_agent (str): UserAgent info to report back to reddit api.
+        reddit_client_id (str): Reddit API application ID, needed by reddit_ingest.
+        reddit_client_secret (str): Reddit API Access Key, needed by reddit_ingest.
+        cadences (dict): Job name to seconds between runs, merged over DEFAULT_CADENCES. A cadence of 0 or None
+            disables the job.
+        subreddits (list): Subreddits ingested. Defaults to DEFAULT_SUBREDDITS.
+        tenant (str): If set, job names are prefixed with tenant and a colon and the jobs form the tenant's group.
+        offset (float): Fraction of each cadence added to the job's first delay, so pages sharing a daemon do not
+            all run the same job at once.
+        reply_workers (int): Comments answered at the same time by the reply job.
+        reply_timeout (float): Seconds each OpenAI and Graph API request of the reply job may take.
+
+    Returns:
+        list: Names of the jobs added.
+    """
+    cadences = {**DEFAULT_CADENCES, **(cadences or {})}
+    added = []
+
+    def enabled(name):
+        return bool(cadences.get(name))
+
+    def add(name, func, initial_delay=0.0, **kwargs):
+        interval = kwargs.pop('interval', cadences.get(name))
+        if interval:
+            initial_delay += offset * interval
+        job_name = f'{tenant}:{name}' if tenant else name
+        daemon.add_job(Job(job_name, func, interval, initial_delay=initial_delay, group=tenant, **kwargs))
+        added.append(job_name)
+
+    if enabled('reddit_ingest') and reddit_client_id and reddit_client_secret:
+        add('reddit_ingest', functools.partial(
+            run_reddit_scheduler, database_name, reddit_user_agent, reddit_client_id, reddit_client_secret,
+            subreddits=subreddits or DEFAULT_SUBREDDITS, interval=cadences['reddit_ingest']),
+            interval=None, blocking=False)
+
+    if enabled('normalize_media'):
+        add('normalize_media', functools.partial(normalize_media, database_name))
+
+    if access_token:
+        # Posting starts one cadence after launch so a restart does not publish immediately
+        for name, table in (('post_quotes', 'quotes'), ('post_memes', 'memes')):
+            if enabled(name):
+                add(name, functools.partial(post_to_facebook, database_name, access_token, table),
+                    initial_delay=cadences[name])
+        if enabled('sync_posts') and page_id:
+            add('sync_posts', functools.partial(get_all_posts, database_name, page_id, access_token, incremental=True))
+        if enabled('sync_page') and page_id:
+            add('sync_page', functools.partial(sync_page, database_name, page_id, access_token))
+        if enabled('sync_comments'):
+            add('sync_comments', functools.partial(get_all_post_comments, database_name, access_token,
+                                                   incremental=True), initial_delay=30)
+        if enabled('reply') and model and openai_api:
+            # Replies go through the claimed queue, so a crash mid-reply never answers a comment twice. The job runs on
+            # the event loop and hands each worker to the daemon's pool, so it holds no thread while it waits.
+            add('reply', functools.partial(reply_to_comments_async, database_name, access_token, model, openai_api,
+                                           functools.partial(daemon.run_blocking, group=tenant),
+                                           workers=reply_workers, timeout=reply_timeout),
+                initial_delay=60, blocking=False)
+    return added
+
+
+# ============================
+# Function: add_service_jobs
+# ============================
+def add_service_jobs(daemon, database_name, cadences=None):
+    """
+    Add the process wide jobs, event loop lag monitoring and the metrics rollup, to a daemon.
+
+    Parameters:
+        daemon (Daemon): The daemon to add the jobs to.
+        database_name (str): Path to the db the metrics are rolled up into.
+        cadences (dict): Job name to seconds between runs, merged over DEFAULT_CADENCES.
+
+    Returns:
+        None
+    """
+    cadences = {**DEFAULT_CADENCES, **(cadences or {})}
+
+    # Blocking work that slips onto the event loop shows up in the event_loop_lag_seconds histogram
+    daemon.add_job(Job('event_loop_lag', monitor_event_loop_lag, None, blocking=False))
+    if cadences.get('metrics_rollup'):
+        daemon.add_job(Job('metrics_rollup', functools.partial(rollup_to_database, database_name),
+                           cadences['metrics_rollup'], initial_delay=cadences['metrics_rollup']))
+
+
+# ============================
+# Function: build_daemon
+# ============================
+def build_daemon(database_name, page_id=None, access_token=None, model=None, openai_api=None, reddit_user_agent=None,
+                 reddit_client_id=None, reddit_client_secret=None, cadences=None, subreddits=None, max_workers=4,
+                 reply_workers=DEFAULT_REPLY_WORKERS, reply_timeout=DEFAULT_REPLY_TIMEOUT):
+    """
+    Build a Daemon with the standard jobs of one page, see add_page_jobs and add_service_jobs.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        page_id (str): Facebook page id, needed by sync_posts.
+        access_token (str): Facebook page token, needed by every Facebook job.
+        model (str): OpenAI chat completion model, needed by reply.
+        openai_api (str): OpenAI API Key, needed by reply.
+        reddit_user_agent (str): UserAgent info to report back to reddit api.
+        reddit_client_id (str): Reddit API application ID, needed by reddit_ingest.
+        reddit_client_secret (str): Reddit API Access Key, needed by reddit_ingest.
+        cadences (dict): Job name to seconds between runs, merged over DEFAULT_CADENCES. A cadence of 0 or None
+            disables the job.
+        subreddits (list): Subreddits ingested. Defaults to DEFAULT_SUBREDDITS.
+        max_workers (int): Threads available to blocking jobs.
+        reply_workers (int): Comments answered at the same time by the reply job.
+        reply_timeout (float): Seconds each OpenAI and Graph API request of the reply job may take.
+
+    Returns:
+        Daemon: The daemon, ready to run.
+    """
+    daemon = Daemon(database_name, max_workers=max_workers)
+    add_page_jobs(daemon, database_name, page_id, access_token, model, openai_api, reddit_user_agent,
+                  reddit_client_id, reddit_client_secret, cadences=cadences, subreddits=subreddits,
+                  reply_workers=reply_workers, reply_timeout=reply_timeout)
+    add_service_jobs(daemon, database_name, cadences=cadences)
+    return daemon
+
+
+# ============================
+# Function: run_daemon
+# ============================
+async def run_daemon(database_name, page_id=None, access_token=None, model=None, openai_api=None,
+                     reddit_user_agent=None, reddit_client_id=None, reddit_client_secret=None, cadences=None,
+                     subreddits=None, max_workers=4, reply_workers=DEFAULT_REPLY_WORKERS,
+                     reply_timeout=DEFAULT_REPLY_TIMEOUT):
+    """
+    Create the tables, then run the standard jobs in this event loop until SIGINT or SIGTERM. See build_daemon for
+    the parameters.
+
+    Returns:
+        dict: Job name to job stats at shutdown.
+    """
+    create_tables(database_name)
+    daemon = build_daemon(database_name, page_id, access_token, model, openai_api, reddit_user_agent,
+                          reddit_client_id, reddit_client_secret, cadences=cadences, subreddits=subreddits,
+                          max_workers=max_workers, reply_workers=reply_workers, reply_timeout=reply_timeout)
+    return await daemon.run()
@@ -1,13 +1,22 @@
-import sqlite3
 import time
 
+from .commands import classify_comment
+from .dbconn import get_connection
+from .dblogging import get_log_sink
+from .metrics import inc, instrument
+from .migrations import migrate
+
 
 # ============================
 # Function: log_to_database
 # ============================
 def log_to_database(database_name, level, message, function):
     """
-    Log a message to the fb_logging table.
+    Log a message to the fb_logging table of the current log segment, see dblogging.DatabaseLogSink.
+
+    Records are queued in memory and written in batches by the database's shared log sink, so this call never opens a
+    connection or waits on a commit. Records below the sink's level are discarded, see dblogging.set_log_level.
+
     Parameters:
         database_name (str): Path to the application db.
         level (str): The log level, e.g., 'DEBUG', 'INFO', 'WARNING', 'ERROR', or 'CRITICAL'.
@@ -17,28 +26,19 @@ def log_to_database(database_name, level, message, function):
     Returns:
         None
     """
-    # Connect to the SQLite database
-    conn = sqlite3.connect(database_name)
-    c = conn.cursor()
-
-    # Insert the log entry into the fb_logging table
-    try:
-        c.execute('INSERT INTO fb_logging (timestamp, level, message, function) VALUES (?, ?, ?, ?)',
-                  (datetime.now(), level, message, function))
-        conn.commit()
-    except Exception as e:
-        print(f'Error logging to database: {str(e)}')
-
-    # Close the connection
-    conn.close()
+    if level in ('ERROR', 'CRITICAL'):
+        inc('errors_logged_total', function=function, level=level)
+    get_log_sink(database_name).log(level, message, function)
 
 
 # ============================
 # Function: create_tables
 # ============================
+@instrument
 def create_tables(database_name):
     """
-    Create tables for storing posts, comments, quotes, and logs if they don't already exist in the database.
+    Create or upgrade the tables and indexes used by FBPageTools by applying any pending schema migrations. Safe to
+    call on every start, see migrations.migrate.
 
     Parameters:
         database_name (str): Path to the application db
@@ -47,98 +47,14 @@ def create_tables(database_name):
         None
     """
 
-    # Connect to the SQLite database
-    try:
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in create_tables: {str(e)}', 'create_tables')
-        # Create Facebook logging table
-        try:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS "fb_logging" (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME,
-                    level TEXT,
-                    message TEXT,
-                    function TEXT
-                )''')
-        except Exception as e:
-            print(f'Error in create_tables: {str(e)}')
-
     #  Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering create_tables function', 'create_tables')
 
-    #  Create memes table
-    try:
-        c.execute('''CREATE TABLE IF NOT EXISTS posts
-                            (id TEXT PRIMARY KEY,
-                            permalink TEXT,
-                            title TEXT,
-                            author TEXT,
-                            ups INTEGER,
-                            created_utc INTEGER,
-                            image_link TEXT,
-                            indexed_time INTEGER,
-                            posted INTEGER)''')
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in create_tables: {str(e)}', 'create_tables')
-
-    #  Create quotes table
-    try:
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS "quotes" (
-            "author"	TEXT,
-            "quote"	TEXT,
-            "postedOn"	INTEGER,
-            "posted"	INTEGER DEFAULT 0
-        )''')
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in create_tables: {str(e)}', 'create_tables')
-
-    #  Create Facebook Post table
-    try:
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS "fb_posts" (
-            "post_id"	TEXT,
-            "message"	TEXT,
-            "created_time"	INTEGER,
-            "indexed_time"	INTEGER,
-            PRIMARY KEY("post_id")
-        )''')
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in create_tables: {str(e)}', 'create_tables')
-
-    #  Create Facebook Comments table
+    # Apply the migrations this database has not seen yet
     try:
-        c.execute('''
-        CREATE TABLE IF NOT EXISTS "fb_comments" (
-            "comment_id"	TEXT,
-            "post_id"	TEXT,
-            "message"	TEXT,
-            "created_time"	INTEGER,
-            "indexed_time"	INTEGER,
-            "openai_text"	TEXT,
-            "postedOn"	INTEGER,
-            "completed"	INTEGER DEFAULT 0
-        )''')
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in create_tables: {str(e)}', 'create_tables')
-
-    # Commit and close the connection
-    try:
-        conn.commit()
-        conn.close()
+        applied = migrate(database_name)
+        if applied:
+            log_to_database(database_name, 'INFO', f'Applied schema migrations {applied}', 'create_tables')
     except Exception as e:
 
         # Add a log entry for errors
@@ -151,6 +67,7 @@ def create_tables(database_name):
 # ============================
 # Function: update_table_post_status
 # ============================
+@instrument
 def update_table_post_status(database_name, table, row):
     """
     Update table rows when item has been posted to prevent reposting.
@@ -166,8 +83,8 @@ def update_table_post_status(database_name, table, row):
     # Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering update_table_post_status function', 'update_table_post_status')
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(database_name)
+    # Get the shared connection for this thread
+    conn = get_connection(database_name)
     c = conn.cursor()
 
     # Check if the table is 'memes'
@@ -183,8 +100,78 @@ def update_table_post_status(database_name, table, row):
     # Commit the changes to the database
     conn.commit()
 
-    # Close the connection
-    conn.close()
-
     # Add a log entry for function exit
     log_to_database(database_name, 'DEBUG', 'Exiting update_table_post_status function', 'update_table_post_status')
+
+
+# ============================
+# Function: upsert_posts
+# ============================
+@instrument
+def upsert_posts(database_name, posts):
+    """
+    Write a page of Graph API posts to fb_posts in a single transaction, skipping posts that are already stored.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        posts (list): Post dicts as returned by the Graph API, with id, created_time and optionally message.
+
+    Returns:
+        tuple: (inserted, skipped) row counts.
+    """
+    indexed_time = int(time.time())
+    rows = [(post['id'], post.get('message', ''), post['created_time'], indexed_time) for post in posts]
+    if not rows:
+        return 0, 0
+
+    conn = get_connection(database_name)
+    before = conn.total_changes
+    with conn:
+        conn.executemany('INSERT INTO fb_posts (post_id, message, created_time, indexed_time) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(post_id) DO NOTHING', rows)
+    inserted = conn.total_changes - before
+    inc('rows_ingested_total', inserted, table='fb_posts')
+    return inserted, len(rows) - inserted
+
+
+# ============================
+# Function: upsert_comments
+# ============================
+@instrument
+def upsert_comments(database_name, post_id, comments):
+    """
+    Write a page of Graph API comments for one post to fb_comments in a single transaction, skipping comments that
+    are already stored. Relies on the unique (comment_id, message) index created by create_tables.
+
+    Each comment is classified into its command type and prompt as it is written, and new commands are queued in
+    fb_reply_queue by the tr_fb_comments_enqueue trigger, in the same transaction.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        post_id (str): The ID of the post the comments belong to.
+        comments (list): Comment dicts as returned by the Graph API, with id, created_time and optionally message.
+
+    Returns:
+        tuple: (inserted, skipped) row counts.
+    """
+    indexed_time = int(time.time())
+    rows = []
+    for comment in comments:
+        message = comment.get('message', '')
+        command, prompt = classify_comment(message)
+        rows.append((comment['id'], post_id, message, comment['created_time'], indexed_time, command, prompt))
+    if not rows:
+        return 0, 0
+
+    conn = get_connection(database_name)
+    before = conn.total_changes
+    with conn:
+        cursor = conn.executemany('INSERT INTO fb_comments (comment_id, post_id, message, created_time, indexed_time, '
+                                  'command, prompt) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                                  'ON CONFLICT(comment_id, message) DO NOTHING', rows)
+        inserted = cursor.rowcount
+    queued = conn.total_changes - before - inserted
+    if queued:
+        inc('reply_queued_total', queued)
+    inc('rows_ingested_total', inserted, table='fb_comments')
+    return inserted, len(rows) - inserted
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+
+# Pragmas applied to every connection handed out by a ConnectionManager. WAL lets readers and the single writer work
+# at the same time, and synchronous=NORMAL only fsyncs at checkpoints which is safe in WAL mode.
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 30000),
+)
+
+# Callables run with every new connection, e.g. to install a trace callback for benchmarks or metrics
+CONNECTION_HOOKS = []
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+# ============================
+# Function: open_connection
+# ============================
+def open_connection(database_name, pragmas=DEFAULT_PRAGMAS, timeout=30.0):
+    """
+    Open a new SQLite connection with the tuned pragmas and the CONNECTION_HOOKS applied.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        pragmas (tuple): (name, value) pairs applied to the connection.
+        timeout (float): Seconds the connection waits on a lock before raising.
+
+    Returns:
+        sqlite3.Connection: The new connection, owned by the caller.
+    """
+    conn = sqlite3.connect(database_name, timeout=timeout, check_same_thread=False)
+    for name, value in pragmas:
+        conn.execute(f'PRAGMA {name} = {value}')
+    for hook in CONNECTION_HOOKS:
+        hook(conn)
+    return conn
+
+
+# ============================
+# Class: ConnectionManager
+# ============================
+class ConnectionManager:
+    """
+    Hand out one long-lived SQLite connection per thread for a single database file. Every connection is opened in
+    WAL mode with the tuned pragmas so the Reddit ingester, the poster and the comment replier can share the file
+    without reconnecting or stalling on "database is locked".
+
+    Parameters:
+        database_name (str): Path to the application db.
+        pragmas (tuple): (name, value) pairs applied to each new connection. Defaults to DEFAULT_PRAGMAS.
+        timeout (float): Seconds a connection waits on a lock before raising.
+    """
+
+    def __init__(self, database_name, pragmas=DEFAULT_PRAGMAS, timeout=30.0):
+        self.database_name = database_name
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """
+        Return the calling thread's connection, opening it on first use. Coroutines running on the same event loop
+        share the loop thread's connection.
+
+        Returns:
+            sqlite3.Connection: The connection owned by the calling thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = open_connection(self.database_name, self.pragmas, self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """
+        Close every connection opened by this manager. Threads that use the manager afterwards get a new connection.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        self._local = threading.local()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f'Error closing connection to {self.database_name}: {str(e)}')
+
+
+def _key(database_name):
+    if database_name == ':memory:' or str(database_name).startswith('file:'):
+        return database_name
+    return os.path.abspath(database_name)
+
+
+# ============================
+# Function: get_connection_manager
+# ============================
+def get_connection_manager(database_name):
+    """
+    Return the shared connection manager for a database path, creating it on first use.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        ConnectionManager: The manager for database_name.
+    """
+    key = _key(database_name)
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(key)
+            if manager is None:
+                manager = ConnectionManager(database_name)
+                _managers[key] = manager
+    return manager
+
+
+# ============================
+# Function: get_connection
+# ============================
+def get_connection(database_name):
+    """
+    Return the calling thread's shared connection to a database. Callers must not close it.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        sqlite3.Connection: A WAL mode connection owned by the calling thread.
+    """
+    return get_connection_manager(database_name).connection()
+
+
+# ============================
+# Function: close_connections
+# ============================
+def close_connections(database_name=None):
+    """
+    Close the shared connections for one database, or for every database.
+
+    Parameters:
+        database_name (str): Path to the application db. If None every manager is closed.
+
+    Returns:
+        None
+    """
+    with _managers_lock:
+        if database_name is None:
+            managers = list(_managers.values())
+        else:
+            managers = [_managers[_key(database_name)]] if _key(database_name) in _managers else []
+    for manager in managers:
+        manager.close()
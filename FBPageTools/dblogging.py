@@ -0,0 +1,636 @@
+import atexit
+import hashlib
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .dbconn import close_connections, get_connection
+from .metrics import inc
+
+# Numeric weights used to filter records below the configured level
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+
+# Default level for new sinks, can be overridden with the FB_LOG_LEVEL environment variable
+DEFAULT_LOG_LEVEL = os.getenv('FB_LOG_LEVEL', 'DEBUG').upper()
+
+# strftime patterns naming a log segment for each rotation period, and the length of the period
+ROTATIONS = {'hour': ('%Y%m%d%H', timedelta(hours=1)), 'day': ('%Y%m%d', timedelta(days=1))}
+
+# Part number reported for the segment that holds rows moved out of the application database by move_legacy_logs
+LEGACY_PART = -1
+
+LOGGING_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS "fb_logging" (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp DATETIME,
+        level TEXT,
+        message TEXT,
+        function TEXT
+    )'''
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+_STOP = object()
+
+
+# ============================
+# Class: DatabaseLogSink
+# ============================
+class DatabaseLogSink:
+    """
+    Queue log records in memory and write them in batches from a single background writer thread. Records go to the
+    fb_logging table of a log segment, a database file of its own in the log directory, so logging never takes the
+    application database's write lock.
+
+    A new segment is started every rotation period, or sooner once the current one reaches max_bytes. Retired
+    segments are rolled up into hourly counts per function and level in the summary database, and segments older
+    than retention_days are deleted. See query_logs and log_summary for reading them back.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        level (str): Minimum log level to record, e.g., 'DEBUG', 'INFO', 'WARNING', 'ERROR', or 'CRITICAL'. Defaults to
+            DEFAULT_LOG_LEVEL.
+        max_queue (int): Maximum number of records held in memory. Records logged while the queue is full are dropped
+            and counted in the dropped attribute.
+        batch_size (int): Maximum number of records written in a single transaction.
+        flush_interval (float): Seconds the writer waits for more records before writing a partial batch.
+        log_dir (str): Directory holding the segments. Defaults to get_log_dir(database_name).
+        rotate (str): Rotation period, 'hour' or 'day'.
+        max_bytes (int): Size at which a segment is retired before its period ends.
+        retention_days (float): Days detail rows are kept. Hourly rollups are kept indefinitely.
+    """
+
+    def __init__(self, database_name, level=None, max_queue=10000, batch_size=500, flush_interval=1.0, log_dir=None,
+                 rotate='day', max_bytes=67108864, retention_days=14):
+        self.database_name = database_name
+        self.log_dir = log_dir or get_log_dir(database_name)
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self.segment = None
+        self.level = LOG_LEVELS.get((level or DEFAULT_LOG_LEVEL).upper(), LOG_LEVELS['DEBUG'])
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f'log-sink:{database_name}', daemon=True)
+        self._thread.start()
+
+    def set_level(self, level):
+        """
+        Change the minimum level recorded by this sink.
+
+        Parameters:
+            level (str): The new minimum log level.
+
+        Returns:
+            None
+        """
+        self.level = LOG_LEVELS.get(level.upper(), LOG_LEVELS['DEBUG'])
+
+    def log(self, level, message, function):
+        """
+        Queue a log record without touching the database.
+
+        Parameters:
+            level (str): The log level of the record.
+            message (str): The log message.
+            function (str): The name of the function where the log entry was created.
+
+        Returns:
+            bool: True if the record was queued, False if it was filtered out or dropped.
+        """
+        if self._closed or LOG_LEVELS.get(level, LOG_LEVELS['CRITICAL']) < self.level:
+            return False
+
+        try:
+            self._queue.put_nowait((datetime.now().isoformat(sep=' '), level, message, function))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        """
+        Block until every record queued so far has been written to the database.
+
+        Returns:
+            None
+        """
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """
+        Flush any pending records and stop the writer thread.
+
+        Returns:
+            None
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _open_segment(self):
+        """
+        Return the connection to the segment records are written to, rotating to a new segment when the period has
+        changed or the current one is full. Rotation triggers rollup and retention of retired segments.
+        """
+        pattern, _ = ROTATIONS[self.rotate]
+        period = datetime.now().strftime(pattern)
+        if self.segment is not None:
+            current_period, part = _parse_segment(self.database_name, os.path.basename(self.segment))
+            if current_period == period and _file_size(self.segment) < self.max_bytes:
+                return get_connection(self.segment)
+            close_connections(self.segment)
+            part = part + 1 if current_period == period else 0
+        else:
+            os.makedirs(self.log_dir, exist_ok=True)
+            parts = [part for seg_period, part, _ in list_log_segments(self.database_name, self.log_dir)
+                     if seg_period == period and part != LEGACY_PART]
+            part = max(parts, default=0)
+
+        self.segment = os.path.join(self.log_dir, f'{_stem(self.database_name)}-{period}-{part}.db')
+        conn = get_connection(self.segment)
+        conn.execute(LOGGING_SCHEMA)
+        conn.commit()
+
+        try:
+            maintain_logs(self.database_name, self.log_dir, self.retention_days)
+        except Exception as e:
+            print(f'Error maintaining logs: {str(e)}')
+        return conn
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                record = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            # Drain whatever else is already waiting, up to one batch
+            batch = []
+            taken = 1
+            while True:
+                if record is _STOP:
+                    stopping = True
+                else:
+                    batch.append(record)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                    taken += 1
+                except queue.Empty:
+                    break
+
+            try:
+                if batch:
+                    conn = self._open_segment()
+                    conn.executemany('INSERT INTO fb_logging (timestamp, level, message, function) VALUES (?, ?, ?, ?)',
+                                     batch)
+                    conn.commit()
+                    self.written += len(batch)
+                    inc('log_records_written_total', len(batch))
+            except Exception as e:
+                print(f'Error logging to database: {str(e)}')
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+
+def _stem(database_name):
+    # The hash of the absolute path keeps databases with the same file name apart in a shared FB_LOG_DIR
+    digest = hashlib.sha1(os.path.abspath(database_name).encode()).hexdigest()[:8]
+    return f'{os.path.splitext(os.path.basename(database_name))[0]}-{digest}'
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path) + (os.path.getsize(path + '-wal') if os.path.exists(path + '-wal') else 0)
+    except OSError:
+        return 0
+
+
+def _parse_segment(database_name, name):
+    # Segments written before the path hash was added to the stem are still read
+    for stem in (_stem(database_name), os.path.splitext(os.path.basename(database_name))[0]):
+        match = re.fullmatch(re.escape(stem) + r'-(\d{8,10})-(\d+|legacy)\.db', name)
+        if match:
+            return match.group(1), LEGACY_PART if match.group(2) == 'legacy' else int(match.group(2))
+    return None, None
+
+
+# ============================
+# Function: get_log_dir
+# ============================
+def get_log_dir(database_name):
+    """
+    Return the directory holding the log segments of a database. Defaults to a logs folder next to the database file
+    and can be overridden with the FB_LOG_DIR environment variable.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        str: Path to the log directory.
+    """
+    return os.getenv('FB_LOG_DIR') or os.path.join(os.path.dirname(os.path.abspath(database_name)), 'logs')
+
+
+# ============================
+# Function: list_log_segments
+# ============================
+def list_log_segments(database_name, log_dir=None):
+    """
+    List the log segments of a database, oldest first.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        log_dir (str): Directory holding the segments. Defaults to get_log_dir(database_name).
+
+    Returns:
+        list: (period, part, path) tuples, where period is the segment's strftime period key and part is LEGACY_PART
+            for the segment written by move_legacy_logs.
+    """
+    log_dir = log_dir or get_log_dir(database_name)
+    if not os.path.isdir(log_dir):
+        return []
+    segments = []
+    for name in os.listdir(log_dir):
+        period, part = _parse_segment(database_name, name)
+        if period is not None:
+            segments.append((period, part, os.path.join(log_dir, name)))
+    return sorted(segments)
+
+
+def _summary_connection(database_name, log_dir):
+    conn = get_connection(os.path.join(log_dir, f'{_stem(database_name)}-summary.db'))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS "log_rollups" (
+            "hour"	TEXT,
+            "function"	TEXT,
+            "level"	TEXT,
+            "count"	INTEGER,
+            PRIMARY KEY("hour", "function", "level")
+        ) WITHOUT ROWID''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS "log_segments" (
+            "name"	TEXT,
+            "rolled_up_at"	INTEGER,
+            PRIMARY KEY("name")
+        )''')
+    conn.commit()
+    return conn
+
+
+def _period_bounds(period):
+    pattern, length = ROTATIONS['hour' if len(period) == 10 else 'day']
+    start = datetime.strptime(period, pattern)
+    return start, start + length
+
+
+# ============================
+# Function: maintain_logs
+# ============================
+def maintain_logs(database_name, log_dir=None, retention_days=14):
+    """
+    Roll every retired log segment up into hourly counts per function and level, then delete segments whose period
+    ended more than retention_days ago. Each segment is rolled up once, even when several processes share the log
+    directory. Runs automatically whenever a sink rotates.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        log_dir (str): Directory holding the segments. Defaults to get_log_dir(database_name).
+        retention_days (float): Days detail rows are kept.
+
+    Returns:
+        dict: rolled_up and deleted segment counts.
+    """
+    log_dir = log_dir or get_log_dir(database_name)
+    segments = list_log_segments(database_name, log_dir)
+    report = {'rolled_up': 0, 'deleted': 0}
+    if not segments:
+        return report
+
+    conn = _summary_connection(database_name, log_dir)
+    rolled = {row[0] for row in conn.execute('SELECT name FROM log_segments')}
+    current = max((segment for segment in segments if segment[1] != LEGACY_PART), default=(None, None, None))[2]
+    cutoff = datetime.now() - timedelta(days=retention_days)
+
+    for period, _, path in segments:
+        name = os.path.basename(path)
+        if path != current and name not in rolled:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if conn.execute('SELECT 1 FROM log_segments WHERE name = ?', (name,)).fetchone() is None:
+                    conn.execute('ATTACH DATABASE ? AS segment', (path,))
+                    try:
+                        if conn.execute("SELECT 1 FROM segment.sqlite_master WHERE name = 'fb_logging'").fetchone():
+                            conn.execute('INSERT INTO log_rollups (hour, function, level, count) '
+                                         'SELECT substr(timestamp, 1, 13) || \':00\', function, level, COUNT(*) '
+                                         'FROM segment.fb_logging WHERE 1 GROUP BY 1, 2, 3 '
+                                         'ON CONFLICT(hour, function, level) DO UPDATE '
+                                         'SET count = count + excluded.count')
+                        conn.execute('INSERT INTO log_segments (name, rolled_up_at) VALUES (?, ?)',
+                                     (name, int(time.time())))
+                        conn.commit()
+                    finally:
+                        if conn.in_transaction:
+                            conn.rollback()
+                        conn.execute('DETACH DATABASE segment')
+                    report['rolled_up'] += 1
+                    rolled.add(name)
+                else:
+                    conn.rollback()
+                    rolled.add(name)
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+
+        # Detail past the retention window is dropped a whole file at a time, once it has been rolled up
+        if path != current and name in rolled and _period_bounds(period)[1] < cutoff:
+            close_connections(path)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            report['deleted'] += 1
+    return report
+
+
+def _connect_read_only(path):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# ============================
+# Function: query_logs
+# ============================
+def query_logs(database_name, since=None, until=None, level=None, function=None, contains=None, limit=1000):
+    """
+    Read log records from the segments, newest first. Only segments whose period overlaps since and until are opened.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        since (datetime): Earliest timestamp returned. If None there is no lower bound.
+        until (datetime): Latest timestamp returned. If None there is no upper bound.
+        level (str): Minimum level returned, e.g. 'WARNING'.
+        function (str): Only records logged by this function.
+        contains (str): Only records whose message contains this text.
+        limit (int): Maximum number of records returned.
+
+    Returns:
+        list: Records as dicts with timestamp, level, message and function.
+    """
+    flush_logs(database_name)
+    conditions, params = [], []
+    if since is not None:
+        conditions.append('timestamp >= ?')
+        params.append(since.isoformat(sep=' '))
+    if until is not None:
+        conditions.append('timestamp <= ?')
+        params.append(until.isoformat(sep=' '))
+    if level is not None:
+        levels = [name for name, weight in LOG_LEVELS.items() if weight >= LOG_LEVELS[level.upper()]]
+        conditions.append(f'level IN ({", ".join("?" * len(levels))})')
+        params.extend(levels)
+    if function is not None:
+        conditions.append('function = ?')
+        params.append(function)
+    if contains is not None:
+        conditions.append('instr(message, ?) > 0')
+        params.append(contains)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    records = []
+    for period, part, path in reversed(list_log_segments(database_name)):
+        # The legacy segment holds rows of any age, so it is always searched
+        start, end = _period_bounds(period)
+        if part != LEGACY_PART and ((since is not None and end <= since) or (until is not None and start > until)):
+            continue
+        conn = _connect_read_only(path)
+        try:
+            rows = conn.execute(f'SELECT timestamp, level, message, function FROM fb_logging {where} '
+                                f'ORDER BY timestamp DESC LIMIT ?', params + [limit]).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            conn.close()
+        records.extend(dict(row) for row in rows)
+        if len(records) >= limit:
+            break
+
+    records.sort(key=lambda record: record['timestamp'], reverse=True)
+    return records[:limit]
+
+
+# ============================
+# Function: log_summary
+# ============================
+def log_summary(database_name, since=None, until=None, level=None, function=None):
+    """
+    Return hourly record counts per function and level, from the rollups of retired segments and from the segments
+    that have not been rolled up yet.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        since (datetime): Earliest hour returned. If None there is no lower bound.
+        until (datetime): Latest hour returned. If None there is no upper bound.
+        level (str): Only this level.
+        function (str): Only this function.
+
+    Returns:
+        list: Dicts with hour ('YYYY-MM-DD HH:00'), function, level and count, oldest hour first.
+    """
+    flush_logs(database_name)
+    log_dir = get_log_dir(database_name)
+    counts = {}
+
+    conditions, params = [], []
+    if since is not None:
+        conditions.append('hour >= ?')
+        params.append(since.strftime('%Y-%m-%d %H:00'))
+    if until is not None:
+        conditions.append('hour <= ?')
+        params.append(until.strftime('%Y-%m-%d %H:00'))
+    if level is not None:
+        conditions.append('level = ?')
+        params.append(level.upper())
+    if function is not None:
+        conditions.append('function = ?')
+        params.append(function)
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    summary = _summary_connection(database_name, log_dir) if os.path.isdir(log_dir) else None
+    rolled = set()
+    if summary is not None:
+        rolled = {row[0] for row in summary.execute('SELECT name FROM log_segments')}
+        for hour, func, lvl, count in summary.execute(f'SELECT hour, function, level, count FROM log_rollups {where}',
+                                                      params):
+            counts[(hour, func, lvl)] = counts.get((hour, func, lvl), 0) + count
+
+    for _, _, path in list_log_segments(database_name, log_dir):
+        if os.path.basename(path) in rolled:
+            continue
+        conn = _connect_read_only(path)
+        try:
+            rows = conn.execute(f'SELECT * FROM (SELECT substr(timestamp, 1, 13) || \':00\' AS hour, function, level, '
+                                f'COUNT(*) FROM fb_logging GROUP BY 1, 2, 3) {where}', params).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        finally:
+            conn.close()
+        for hour, func, lvl, count in rows:
+            counts[(hour, func, lvl)] = counts.get((hour, func, lvl), 0) + count
+
+    return [{'hour': hour, 'function': func, 'level': lvl, 'count': count}
+            for (hour, func, lvl), count in sorted(counts.items())]
+
+
+# ============================
+# Function: move_legacy_logs
+# ============================
+def move_legacy_logs(database_name, vacuum=False):
+    """
+    Move the rows of the fb_logging table in the application database, written by earlier versions, into a legacy
+    segment in the log directory that the log sink never writes to, then drop the table. Rows are copied in one
+    statement, so the application database is only locked briefly. VACUUM afterwards to give the space back to the
+    file system.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        vacuum (bool): Run VACUUM on the application database once the table is dropped.
+
+    Returns:
+        int: Number of rows moved.
+    """
+    conn = get_connection(database_name)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fb_logging'").fetchone() is None:
+        return 0
+
+    log_dir = get_log_dir(database_name)
+    os.makedirs(log_dir, exist_ok=True)
+    oldest = conn.execute('SELECT MIN(timestamp) FROM fb_logging').fetchone()[0]
+    period = (oldest or datetime.now().isoformat())[:10].replace('-', '')
+    path = os.path.join(log_dir, f'{_stem(database_name)}-{period}-legacy.db')
+    archive = sqlite3.connect(path)
+    archive.execute(LOGGING_SCHEMA)
+    archive.commit()
+    archive.close()
+
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    try:
+        with conn:
+            moved = conn.execute('INSERT INTO archive.fb_logging (timestamp, level, message, function) '
+                                 'SELECT timestamp, level, message, function FROM main.fb_logging').rowcount
+            conn.execute('DROP TABLE main.fb_logging')
+    finally:
+        conn.execute('DETACH DATABASE archive')
+
+    if vacuum:
+        conn.execute('VACUUM')
+    return moved
+
+
+# ============================
+# Function: get_log_sink
+# ============================
+def get_log_sink(database_name, **kwargs):
+    """
+    Return the shared log sink for a database, creating it on first use.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        **kwargs: Options passed to DatabaseLogSink when the sink is created.
+
+    Returns:
+        DatabaseLogSink: The sink that writes to database_name.
+    """
+    sink = _sinks.get(database_name)
+    if sink is None:
+        with _sinks_lock:
+            sink = _sinks.get(database_name)
+            if sink is None:
+                sink = DatabaseLogSink(database_name, **kwargs)
+                _sinks[database_name] = sink
+    return sink
+
+
+# ============================
+# Function: set_log_level
+# ============================
+def set_log_level(level, database_name=None):
+    """
+    Set the minimum level recorded for one database, or for every sink and all sinks created later.
+
+    Parameters:
+        level (str): The minimum log level, e.g., 'DEBUG', 'INFO', 'WARNING', 'ERROR', or 'CRITICAL'.
+        database_name (str): Path to the application db. If None the level applies to every sink.
+
+    Returns:
+        None
+    """
+    global DEFAULT_LOG_LEVEL
+
+    if database_name is not None:
+        get_log_sink(database_name).set_level(level)
+        return
+
+    DEFAULT_LOG_LEVEL = level.upper()
+    with _sinks_lock:
+        for sink in _sinks.values():
+            sink.set_level(level)
+
+
+# ============================
+# Function: flush_logs
+# ============================
+def flush_logs(database_name=None):
+    """
+    Block until queued log records have been written.
+
+    Parameters:
+        database_name (str): Path to the application db. If None every sink is flushed.
+
+    Returns:
+        None
+    """
+    if database_name is None:
+        sinks = list(_sinks.values())
+    else:
+        sinks = [_sinks[database_name]] if database_name in _sinks else []
+
+    for sink in sinks:
+        sink.flush()
+
+
+# ============================
+# Function: close_log_sinks
+# ============================
+def close_log_sinks():
+    """
+    Flush and close every log sink. Registered to run at interpreter exit so no queued records are lost.
+
+    Returns:
+        None
+    """
+    with _sinks_lock:
+        sinks = list(_sinks.values())
+        _sinks.clear()
+    for sink in sinks:
+        sink.close()
+
+
+atexit.register(close_log_sinks)
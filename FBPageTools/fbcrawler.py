@@ -0,0 +1,363 @@
+import asyncio
+import json
+import re
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+
+from .dbapp import log_to_database, upsert_comments
+from .dbconn import get_connection
+from .graphclient import get_rate_limiter, is_throttle_error
+from .metrics import inc, instrument, timed
+
+GRAPH_URL = 'https://graph.facebook.com/'
+
+# The Graph API accepts at most 50 requests in a single batch call
+MAX_BATCH_SIZE = 50
+
+# Retries of a throttled batch call before the error is raised
+MAX_RETRIES = 5
+
+# Graph API error code and subcode of an object that does not exist, a post already removed counts as deleted
+MISSING_OBJECT_ERROR = (100, 33)
+
+
+# ============================
+# Function: _send_batch
+# ============================
+async def _send_batch(session, semaphore, access_token, requests):
+    """
+    Send one Graph API batch call and decode each response. The call is paced by the token's shared rate limiter,
+    and retried after a backoff when the whole batch is throttled.
+
+    Parameters:
+        session (aiohttp.ClientSession): The pooled HTTP session.
+        semaphore (asyncio.Semaphore): Bounds the number of batch calls in flight.
+        access_token (str): The access token to use for the Graph API.
+        requests (list): Up to MAX_BATCH_SIZE (method, relative_url) pairs.
+
+    Returns:
+        list: One (code, body) pair per request, where body is the decoded response body, or (None, None) for
+            requests Facebook did not answer.
+    """
+    batch = json.dumps([{'method': method, 'relative_url': url} for method, url in requests])
+    limiter = get_rate_limiter(access_token)
+    attempt = 0
+    async with semaphore:
+        while True:
+            # Every request in the batch counts against the rate limits
+            await limiter.acquire_async(len(requests))
+            with timed('graph', 'batch'):
+                async with session.post(GRAPH_URL, data={'access_token': access_token, 'batch': batch}) as response:
+                    limiter.update(response.headers)
+                    if response.status != 200:
+                        try:
+                            code = (await response.json(content_type=None))['error']['code']
+                        except Exception:
+                            code = None
+                        if is_throttle_error(code) and attempt < MAX_RETRIES:
+                            inc('graph_throttled_total', code=code)
+                            limiter.throttled(attempt)
+                            attempt += 1
+                            continue
+                    response.raise_for_status()
+                    results = await response.json()
+            break
+
+    decoded = []
+    for result in results:
+        if result is None:
+            decoded.append((None, None))
+            continue
+        try:
+            body = json.loads(result.get('body') or 'null')
+        except ValueError:
+            body = None
+        decoded.append((result.get('code'), body))
+    return decoded
+
+
+# ============================
+# Function: _post_batch
+# ============================
+async def _post_batch(session, semaphore, access_token, relative_urls):
+    """
+    Send one Graph API batch call of GET requests and decode each response body.
+
+    Parameters:
+        session (aiohttp.ClientSession): The pooled HTTP session.
+        semaphore (asyncio.Semaphore): Bounds the number of batch calls in flight.
+        access_token (str): The access token to use for the Graph API.
+        relative_urls (list): Up to MAX_BATCH_SIZE relative Graph API urls to GET.
+
+    Returns:
+        list: One decoded body per request, or None for requests that failed.
+    """
+    results = await _send_batch(session, semaphore, access_token, [('GET', url) for url in relative_urls])
+    return [body if code == 200 else None for code, body in results]
+
+
+# ============================
+# Function: crawl_post_comments
+# ============================
+@instrument
+async def crawl_post_comments(database_name, access_token, concurrency=4, batch_size=MAX_BATCH_SIZE):
+    """
+    Concurrent version of get_all_post_comments. Comment requests for every post in fb_posts are packed into Graph
+    API batch calls, which are sent over one pooled HTTP session with at most concurrency calls in flight. Posts with
+    more than one page of comments have their next pages queued into later batches.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        access_token (str): The access token to use for the Graph API.
+        concurrency (int): Maximum number of batch calls in flight.
+        batch_size (int): Requests packed into each batch call, at most MAX_BATCH_SIZE.
+
+    Returns:
+        dict: Crawl report with posts, comments, elapsed seconds, posts_per_second, http_calls, graph_requests and
+            calls_saved compared with one Graph call per page on the sequential path.
+    """
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering crawl_post_comments function', 'crawl_post_comments')
+
+    start = time.perf_counter()
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    report = {'posts': 0, 'comments': 0, 'http_calls': 0, 'graph_requests': 0, 'errors': 0}
+
+    # Get the shared connection for this thread
+    conn = get_connection(database_name)
+    c = conn.cursor()
+
+    try:
+        c.execute('SELECT post_id FROM fb_posts')
+        post_ids = [row[0] for row in c.fetchall()]
+    except Exception as e:
+
+        # Add a log entry for errors
+        log_to_database(database_name, 'ERROR', f'Error in crawl_post_comments: {str(e)}', 'crawl_post_comments')
+        post_ids = []
+    report['posts'] = len(post_ids)
+
+    # Each pending entry is (post_id, relative_url) for one page of comments
+    pending = [(post_id, f'{post_id}/comments?limit=100') for post_id in post_ids]
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while pending:
+            chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+            pending = []
+            results = await asyncio.gather(
+                *[_post_batch(session, semaphore, access_token, [url for _, url in chunk]) for chunk in chunks],
+                return_exceptions=True)
+
+            report['http_calls'] += len(chunks)
+            for chunk, bodies in zip(chunks, results):
+                report['graph_requests'] += len(chunk)
+                if isinstance(bodies, Exception):
+                    report['errors'] += len(chunk)
+                    log_to_database(database_name, 'ERROR', f'Error in crawl_post_comments: {str(bodies)}',
+                                    'crawl_post_comments')
+                    continue
+
+                for (post_id, _), body in zip(chunk, bodies):
+                    if body is None:
+                        report['errors'] += 1
+                        log_to_database(database_name, 'WARNING', f'Comment request failed for post {post_id}',
+                                        'crawl_post_comments')
+                        continue
+
+                    # Insert comments that are not already in the database
+                    try:
+                        inserted, _ = upsert_comments(database_name, post_id, body.get('data', []))
+                        report['comments'] += inserted
+                    except Exception as e:
+
+                        # Add a log entry for errors
+                        log_to_database(database_name, 'ERROR', f'Error in crawl_post_comments: {str(e)}',
+                                        'crawl_post_comments')
+
+                    # Queue the next page of comments for a later batch
+                    paging = body.get('paging', {})
+                    if 'next' in paging:
+                        after = paging['cursors']['after']
+                        pending.append((post_id, f'{post_id}/comments?{urlencode({"limit": 100, "after": after})}'))
+
+    elapsed = time.perf_counter() - start
+    report['seconds'] = round(elapsed, 3)
+    report['posts_per_second'] = round(report['posts'] / elapsed, 2) if elapsed > 0 else 0.0
+    report['calls_saved'] = report['graph_requests'] - report['http_calls']
+
+    log_to_database(database_name, 'INFO', f'Crawled comments: {report}', 'crawl_post_comments')
+
+    # Add a log entry for function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting crawl_post_comments function', 'crawl_post_comments')
+
+    return report
+
+
+# ============================
+# Function: _deletion_outcome
+# ============================
+def _deletion_outcome(code, body):
+    """
+    Classify the response to one batched DELETE request.
+
+    Parameters:
+        code (int): HTTP status of the request, None if Facebook did not answer it.
+        body (dict): Decoded response body.
+
+    Returns:
+        str: The error message, or None if the post is gone.
+    """
+    if code == 200:
+        return None
+    error = body.get('error', {}) if isinstance(body, dict) else {}
+    if (error.get('code'), error.get('error_subcode')) == MISSING_OBJECT_ERROR:
+        return None
+    return error.get('message') or f'HTTP {code}'
+
+
+# ============================
+# Function: bulk_delete_posts
+# ============================
+@instrument
+async def bulk_delete_posts(database_name, access_token, regex_pattern, dry_run=False, concurrency=4,
+                            batch_size=MAX_BATCH_SIZE, max_attempts=3, sample_size=20):
+    """
+    Delete every stored post whose message matches regex_pattern. Candidates are found in fb_posts instead of the
+    live feed and deleted with batched DELETE requests, at most concurrency batch calls in flight.
+
+    Progress is checkpointed in fb_post_deletions after every batch call. Running again with the same pattern
+    resumes an interrupted run, and retries failed posts until they have been tried max_attempts times. Matching
+    posts that are out of attempts are skipped and counted in the report.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        access_token (str): The access token to use for the Graph API.
+        regex_pattern (str): The regex pattern, matched case-insensitively against each post message.
+        dry_run (bool): Only report what would be deleted, without calling Facebook or writing to the db.
+        concurrency (int): Maximum number of batch calls in flight.
+        batch_size (int): Requests packed into each batch call, at most MAX_BATCH_SIZE.
+        max_attempts (int): Attempts before a failed post is no longer retried.
+        sample_size (int): Candidates listed in the report.
+
+    Returns:
+        dict: Report with candidates, resumed, skipped, deleted and failed counts, http_calls, elapsed seconds and a
+            sample of the candidates.
+    """
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering bulk_delete_posts function', 'bulk_delete_posts')
+
+    start = time.perf_counter()
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    pattern = re.compile(regex_pattern, re.IGNORECASE)
+    report = {'dry_run': dry_run, 'candidates': 0, 'resumed': 0, 'skipped': 0, 'deleted': 0, 'failed': 0,
+              'http_calls': 0, 'sample': []}
+
+    # Get the shared connection for this thread
+    conn = get_connection(database_name)
+
+    try:
+        # Posts already deleted, or out of attempts, are skipped even while they are still stored in fb_posts
+        candidates = {}
+        for post_id, message, status, attempts in conn.execute(
+                'SELECT p.post_id, p.message, d.status, d.attempts FROM fb_posts p '
+                'LEFT JOIN fb_post_deletions d ON d.post_id = p.post_id WHERE p.message IS NOT NULL'):
+            if not pattern.search(message):
+                continue
+            if status == 'deleted' or (attempts or 0) >= max_attempts:
+                report['skipped'] += 1
+            else:
+                candidates[post_id] = message
+
+        # Posts left pending or failed by an earlier run with the same pattern
+        resumed = conn.execute('SELECT post_id, message FROM fb_post_deletions WHERE pattern = ? '
+                               'AND status != \'deleted\' AND attempts < ?', (regex_pattern, max_attempts)).fetchall()
+    except Exception as e:
+
+        # Add a log entry for errors
+        log_to_database(database_name, 'ERROR', f'Error in bulk_delete_posts: {str(e)}', 'bulk_delete_posts')
+        candidates, resumed = {}, []
+
+    report['resumed'] = sum(1 for post_id, _ in resumed if post_id not in candidates)
+    for post_id, message in resumed:
+        candidates.setdefault(post_id, message)
+    report['candidates'] = len(candidates)
+    report['sample'] = [{'post_id': post_id, 'message': message[:80]}
+                        for post_id, message in list(candidates.items())[:sample_size]]
+
+    if dry_run or not candidates:
+        report['seconds'] = round(time.perf_counter() - start, 3)
+        log_to_database(database_name, 'INFO', f'Bulk delete {"dry run" if dry_run else "found nothing"}: '
+                                               f'{report["candidates"]} posts match {regex_pattern!r}',
+                        'bulk_delete_posts')
+
+        # Add a log entry for function exit
+        log_to_database(database_name, 'DEBUG', 'Exiting bulk_delete_posts function', 'bulk_delete_posts')
+        return report
+
+    # Checkpoint every candidate before the first request
+    now = int(time.time())
+    with conn:
+        conn.executemany('INSERT INTO fb_post_deletions (post_id, message, pattern, status, updated_at) '
+                         'VALUES (?, ?, ?, \'pending\', ?) '
+                         'ON CONFLICT(post_id) DO UPDATE SET pattern = excluded.pattern WHERE status != \'deleted\'',
+                         [(post_id, message, regex_pattern, now) for post_id, message in candidates.items()])
+
+    post_ids = list(candidates)
+    chunks = [post_ids[i:i + batch_size] for i in range(0, len(post_ids), batch_size)]
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def delete_chunk(chunk):
+            try:
+                return chunk, await _send_batch(session, semaphore, access_token,
+                                                [('DELETE', post_id) for post_id in chunk])
+            except Exception as e:
+                return chunk, e
+
+        for future in asyncio.as_completed([delete_chunk(chunk) for chunk in chunks]):
+            chunk, results = await future
+            report['http_calls'] += 1
+            if isinstance(results, Exception):
+                errors = [str(results)] * len(chunk)
+            else:
+                errors = [_deletion_outcome(code, body) for code, body in results]
+
+            deleted = [(post_id,) for post_id, error in zip(chunk, errors) if error is None]
+            failed = [(error, post_id) for post_id, error in zip(chunk, errors) if error is not None]
+            report['deleted'] += len(deleted)
+            report['failed'] += len(failed)
+            inc('posts_deleted_total', len(deleted))
+
+            # Record the outcome of this batch before the next one is handled
+            try:
+                now = int(time.time())
+                with conn:
+                    conn.executemany(f'UPDATE fb_post_deletions SET status = \'deleted\', attempts = attempts + 1, '
+                                     f'updated_at = {now}, error = NULL WHERE post_id = ?', deleted)
+                    conn.executemany(f'UPDATE fb_post_deletions SET status = \'failed\', attempts = attempts + 1, '
+                                     f'updated_at = {now}, error = ? WHERE post_id = ?', failed)
+                    conn.executemany('DELETE FROM fb_posts WHERE post_id = ?', deleted)
+                    conn.executemany('DELETE FROM fb_comment_sync WHERE post_id = ?', deleted)
+            except Exception as e:
+
+                # Add a log entry for errors
+                log_to_database(database_name, 'ERROR', f'Error in bulk_delete_posts: {str(e)}', 'bulk_delete_posts')
+
+            for error, post_id in failed:
+                log_to_database(database_name, 'WARNING', f'Could not delete post {post_id}: {error}',
+                                'bulk_delete_posts')
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    log_to_database(database_name, 'INFO', f'Bulk deleted posts matching {regex_pattern!r}: {report["deleted"]} '
+                                           f'deleted, {report["failed"]} failed in {report["http_calls"]} calls',
+                    'bulk_delete_posts')
+
+    # Add a log entry for function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting bulk_delete_posts function', 'bulk_delete_posts')
+
+    return report
@@ -1,88 +1,105 @@
+import asyncio
+import functools
+import os
+import random
 import re
-import sqlite3
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
-import facebook
-import openai
 import requests
 
-from .dbapp import update_table_post_status, log_to_database
+from .aicache import get_response_cache
+from .dbapp import update_table_post_status, log_to_database, upsert_comments, upsert_posts
+from .dbconn import get_connection
+from .graphclient import get_graph_client
+from .mediacache import get_cached_media
+from .metrics import inc, instrument, timed
+from .selector import pick_unposted
+
+# Fields requested for posts and comments, only the columns that are stored
+POST_FIELDS = 'id,message,created_time'
+COMMENT_FIELDS = 'id,message,created_time'
+
+
+# ============================
+# Function: _graph_time_to_epoch
+# ============================
+def _graph_time_to_epoch(created_time):
+    """
+    Convert a Graph API timestamp such as '2023-05-01T12:30:00+0000' to unix seconds.
+
+    Parameters:
+        created_time (str): The created_time value returned by the Graph API.
+
+    Returns:
+        int: Seconds since the epoch, or None if the value could not be parsed.
+    """
+    try:
+        return int(datetime.strptime(created_time, '%Y-%m-%dT%H:%M:%S%z').timestamp())
+    except (TypeError, ValueError):
+        return None
 
 
 # ============================
 # Function: get_all_comments
 # ============================
-def get_all_comments(database_name, post_id, access_token):
+@instrument
+def get_all_comments(database_name, post_id, access_token, since=None, after=None):
     """
-    Retrieve comment for a given post and store them in the database.
+    Retrieve every page of comments for a given post and store them in the database. Each page is written with a
+    single bulk insert.
 
     Parameters:
         post_id (str): The ID of the post to retrieve comments for.
         access_token (str): The access token to use for the Graph API.
         database_name (str): Path to the application db.
+        since (int): Only request comments created at or after this unix time. If None every comment is requested.
+        after (str): Paging cursor to resume from, e.g. the cursor of comments already returned inline with a post.
 
     Returns:
-        None
+        dict: inserted and skipped row counts, and newest, the created time in unix seconds of the newest comment
+            returned or None if there were no comments.
     """
     # Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering get_all_comments function', 'get_all_comments')
 
-    # Initialize the Facebook Graph API with the access token
-    try:
-        graph = facebook.GraphAPI(access_token)
-    except Exception as e:
+    result = {'inserted': 0, 'skipped': 0, 'newest': None}
 
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
-
-    # Get comments for the post
+    # Initialize the Facebook Graph API with the access token
     try:
-        comments = graph.get_object(post_id + '/comments')
+        graph = get_graph_client(access_token)
     except Exception as e:
 
         # Add a log entry for errors
         log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
 
-    # Connect to the SQLite database
+    # Get comments for the post, storing each page and following the paging cursors until the last page
+    args = {'limit': 100, 'fields': COMMENT_FIELDS}
+    if since is not None:
+        args['since'] = since
     try:
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
-
-    # Iterate through the comments and insert them into the database
-    for comment in comments['data']:
-        comment_id = comment['id']
-        message = comment.get('message', '')
-        created_time = comment['created_time']
-
-        # Check if comment already exists in the database
-        try:
-            c.execute('SELECT comment_id FROM fb_comments WHERE comment_id = ? AND message = ?', (comment_id, message))
-            existing_comment = c.fetchone()
-        except Exception as e:
-
-            # Add a log entry for errors
-            log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
-
-        # Insert comment into the database
-        if existing_comment is None:
-            try:
-                c.execute(
-                    'INSERT INTO fb_comments (comment_id, post_id, message, created_time, indexed_time) VALUES (?, ?,'
-                    '?, ?, ?)',
-                    (comment_id, post_id, message, created_time, int(time.time())))
-                conn.commit()
-            except Exception as e:
-
-                # Add a log entry for errors
-                log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
-
-    # Close the connection
-    try:
-        conn.close()
+        with timed('graph', 'get_connections'):
+            if after is not None:
+                page_comments = graph.get_connections(id=post_id, connection_name='comments', after=after, **args)
+            else:
+                page_comments = graph.get_connections(id=post_id, connection_name='comments', **args)
+        while True:
+            inserted, skipped = upsert_comments(database_name, post_id, page_comments['data'])
+            result['inserted'] += inserted
+            result['skipped'] += skipped
+
+            for comment in page_comments['data']:
+                created_epoch = _graph_time_to_epoch(comment['created_time'])
+                if created_epoch is not None and (result['newest'] is None or created_epoch > result['newest']):
+                    result['newest'] = created_epoch
+
+            if 'paging' in page_comments and 'next' in page_comments['paging']:
+                with timed('graph', 'get_connections'):
+                    page_comments = graph.get_connections(id=post_id, connection_name='comments',
+                                                          after=page_comments['paging']['cursors']['after'], **args)
+            else:
+                break
     except Exception as e:
 
         # Add a log entry for errors
@@ -91,110 +108,184 @@ def get_all_comments(database_name, post_id, access_token):
     # Add a log entry for function exit
     log_to_database(database_name, 'DEBUG', 'Exiting get_all_comments function', 'get_all_comments')
 
+    return result
+
 
 # ============================
 # Function: get_all_posts
 # ============================
-def get_all_posts(database_name, page_id, access_token):
+@instrument
+def get_all_posts(database_name, page_id, access_token, incremental=False):
     """
-    Retrieve all posts for a given page and store them in the database.
+    Retrieve all posts for a given page and store them in the database. Each page of posts is written with a single
+    bulk insert.
 
     Parameters:
         page_id (str): The ID of the page to retrieve posts for.
         access_token (str): The access token to use for the Graph API.
         database_name (str): Path to the application db.
+        incremental (bool): Stop at the first page of posts that are all stored already. Posts are returned newest
+            first, so the pages after it hold nothing new.
 
     Returns:
-        None
+        dict: inserted and skipped row counts.
     """
 
     # Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering get_all_posts function', 'get_all_posts')
 
+    result = {'inserted': 0, 'skipped': 0}
+
     # Initialize the Facebook Graph API with the access token
     try:
-        graph = facebook.GraphAPI(access_token)
+        graph = get_graph_client(access_token)
     except Exception as e:
 
         # Add a log entry for errors
         log_to_database(database_name, 'ERROR', f'Error in get_all_posts: {str(e)}', 'get_all_posts')
 
-    # Get posts for the page
-    posts = []
+    # Get posts for the page, storing each page as it arrives
     try:
-        page_posts = graph.get_object(page_id + '/posts')
+        with timed('graph', 'get_object'):
+            page_posts = graph.get_object(page_id + '/posts')
+        while True:
+            inserted, skipped = upsert_posts(database_name, page_posts['data'])
+            result['inserted'] += inserted
+            result['skipped'] += skipped
+
+            if incremental and page_posts['data'] and not inserted:
+                break
+            if 'paging' in page_posts and 'next' in page_posts['paging']:
+                with timed('graph', 'get_connections'):
+                    page_posts = graph.get_connections(id=page_id, connection_name='posts',
+                                                       after=page_posts['paging']['cursors']['after'])
+            else:
+                break
     except Exception as e:
 
         # Add a log entry for errors
         log_to_database(database_name, 'ERROR', f'Error in get_all_posts: {str(e)}', 'get_all_posts')
 
-    while True:
-        for post in page_posts['data']:
-            posts.append(post)
+    log_to_database(database_name, 'INFO', f'Stored posts: {result}', 'get_all_posts')
 
-        if 'paging' in page_posts and 'next' in page_posts['paging']:
-            page_posts = graph.get_connections(id=page_id, connection_name='posts',
-                                               after=page_posts['paging']['cursors']['after'])
-        else:
-            break
+    # Add a log entry for function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting get_all_posts function', 'get_all_posts')
 
-    # Connect to the SQLite database
-    try:
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
-    except Exception as e:
+    return result
 
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in get_all_posts: {str(e)}', 'get_all_posts')
 
-    # Iterate through the posts and insert them into the database
-    for post in posts:
-        post_id = post['id']
-        message = post.get('message', '')
-        created_time = post['created_time']
+# ============================
+# Function: sync_page
+# ============================
+@instrument
+def sync_page(database_name, page_id, access_token, comments_limit=25, page_size=25):
+    """
+    Sync posts and their comments in one paged crawl. Each posts request asks only for the stored fields and expands
+    the first comments_limit comments of every post inline, so most posts need no request of their own. Comments
+    are only requested separately for posts with more comments than fit inline, resuming from the inline cursor.
 
-        # Check if post already exists in the database
-        try:
-            c.execute('SELECT post_id FROM fb_posts WHERE post_id = ?', (post_id,))
-            existing_post = c.fetchone()
-        except Exception as e:
+    The comment sync watermark of every post is moved forward, so a later incremental get_all_post_comments run
+    only asks for newer comments.
 
-            # Add a log entry for errors
-            log_to_database(database_name, 'ERROR', f'Error in get_all_posts: {str(e)}', 'get_all_posts')
+    Parameters:
+        database_name (str): Path to the application db.
+        page_id (str): The ID of the page to sync.
+        access_token (str): The access token to use for the Graph API.
+        comments_limit (int): Comments returned inline with each post.
+        page_size (int): Posts per request.
 
-        # Insert post into the database
-        if existing_post is None:
-            try:
-                c.execute('INSERT INTO fb_posts (post_id, message, created_time, indexed_time) VALUES (?, ?, ?, ?)',
-                          (post_id, message, created_time, int(time.time())))
-                conn.commit()
-            except Exception as e:
+    Returns:
+        dict: posts and comments inserted, graph_requests made for pages of posts, and follow_ups, the posts whose
+            remaining comments were fetched separately.
+    """
 
-                # Add a log entry for errors
-                log_to_database(database_name, 'ERROR', f'Error in get_all_posts: {str(e)}', 'get_all_posts')
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering sync_page function', 'sync_page')
+
+    report = {'posts': 0, 'comments': 0, 'graph_requests': 0, 'follow_ups': 0}
+    fields = f'{POST_FIELDS},comments.limit({comments_limit}){{{COMMENT_FIELDS}}}'
+
+    # Initialize the Facebook Graph API with the access token
+    try:
+        graph = get_graph_client(access_token)
+        conn = get_connection(database_name)
+    except Exception as e:
+
+        # Add a log entry for errors
+        log_to_database(database_name, 'ERROR', f'Error in sync_page: {str(e)}', 'sync_page')
 
-    # Close the connection
     try:
-        conn.close()
+        args = {'fields': fields, 'limit': page_size}
+        with timed('graph', 'get_connections'):
+            page_posts = graph.get_connections(id=page_id, connection_name='posts', **args)
+        report['graph_requests'] += 1
+        while True:
+            report['posts'] += upsert_posts(database_name, page_posts['data'])[0]
+
+            now = int(time.time())
+            watermarks = []
+            for post in page_posts['data']:
+                comments = post.get('comments', {})
+                report['comments'] += upsert_comments(database_name, post['id'], comments.get('data', []))[0]
+                newest = max((_graph_time_to_epoch(comment['created_time']) or 0
+                              for comment in comments.get('data', [])), default=0) or None
+
+                # Fetch the rest of the comments only for posts that overflow the inline limit
+                paging = comments.get('paging', {})
+                if 'next' in paging:
+                    report['follow_ups'] += 1
+                    result = get_all_comments(database_name, post['id'], access_token,
+                                              after=paging['cursors']['after'])
+                    report['comments'] += result['inserted']
+                    if result['newest'] is not None and (newest is None or result['newest'] > newest):
+                        newest = result['newest']
+                watermarks.append((post['id'], newest, now, newest))
+
+            with conn:
+                conn.executemany('INSERT INTO fb_comment_sync (post_id, last_comment_time, last_checked, '
+                                 'last_activity) VALUES (?, ?, ?, ?) ON CONFLICT(post_id) DO UPDATE SET '
+                                 'last_comment_time = NULLIF(MAX(COALESCE(last_comment_time, 0), '
+                                 'COALESCE(excluded.last_comment_time, 0)), 0), last_checked = excluded.last_checked, '
+                                 'last_activity = NULLIF(MAX(COALESCE(last_activity, 0), '
+                                 'COALESCE(excluded.last_activity, 0)), 0)', watermarks)
+
+            if 'paging' in page_posts and 'next' in page_posts['paging']:
+                with timed('graph', 'get_connections'):
+                    page_posts = graph.get_connections(id=page_id, connection_name='posts',
+                                                       after=page_posts['paging']['cursors']['after'], **args)
+                report['graph_requests'] += 1
+            else:
+                break
     except Exception as e:
 
         # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in get_all_posts: {str(e)}', 'get_all_posts')
+        log_to_database(database_name, 'ERROR', f'Error in sync_page: {str(e)}', 'sync_page')
+
+    log_to_database(database_name, 'INFO', f'Synced page: {report}', 'sync_page')
 
     # Add a log entry for function exit
-    log_to_database(database_name, 'DEBUG', 'Exiting get_all_posts function', 'get_all_posts')
+    log_to_database(database_name, 'DEBUG', 'Exiting sync_page function', 'sync_page')
+
+    return report
 
 
 # ============================
 # Function: get_all_post_comments
 # ============================
-def get_all_post_comments(database_name, access_token):
+@instrument
+def get_all_post_comments(database_name, access_token, incremental=False, quiet_age=2592000, quiet_interval=604800):
     """
     Iterates through all posts and adds comments and store them in the database.
 
+    In incremental mode each post keeps a high-watermark in the fb_comment_sync table and only comments newer than it
+    are requested. Posts with no new comments for quiet_age seconds are only polled once every quiet_interval seconds.
+
     Parameters:
         access_token (str): The access token to use for the Graph API.
         database_name (str): Path to the application db.
+        incremental (bool): Request only comments newer than each post's watermark.
+        quiet_age (int): Seconds without new comments after which a post is treated as quiet.
+        quiet_interval (int): Seconds between polls of a quiet post. If None quiet posts are skipped.
 
     Returns:
         None
@@ -203,57 +294,169 @@ def get_all_post_comments(database_name, access_token):
     # Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering get_all_post_comments function', 'get_all_post_comments')
 
-    # Connect to the SQLite database
+    # Get the shared connection for this thread
     try:
-        conn = sqlite3.connect(database_name)
+        conn = get_connection(database_name)
         c = conn.cursor()
     except Exception as e:
 
         # Add a log entry for errors
         log_to_database(database_name, 'ERROR', f'Error in get_all_post_comments: {str(e)}', 'get_all_post_comments')
 
-    # Get all post_ids from the fb_posts table
+    # Get all post_ids from the fb_posts table, along with their sync watermark
     try:
-        c.execute('SELECT post_id FROM fb_posts')
+        c.execute('SELECT p.post_id, p.created_time, s.last_comment_time, s.last_checked, s.last_activity '
+                  'FROM fb_posts p LEFT JOIN fb_comment_sync s ON s.post_id = p.post_id')
     except Exception as e:
 
         # Add a log entry for errors
         log_to_database(database_name, 'ERROR', f'Error in get_all_post_comments: {str(e)}', 'get_all_post_comments')
 
     # Iterate through the post_ids and get all comments for each post
-    for row in c.fetchall():
-        post_id = row[0]
+    for post_id, created_time, last_comment_time, last_checked, last_activity in c.fetchall():
+        if not incremental:
+            try:
+                get_all_comments(database_name, post_id, access_token)
+            except Exception as e:
+
+                # Add a log entry for errors
+                log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
+            continue
+
+        # Skip quiet posts until their next poll is due
+        now = int(time.time())
+        activity = last_activity or _graph_time_to_epoch(created_time) or now
+        if now - activity > quiet_age and last_checked is not None:
+            if quiet_interval is None or now - last_checked < quiet_interval:
+                log_to_database(database_name, 'DEBUG', f'Skipping quiet post {post_id}', 'get_all_post_comments')
+                continue
+
         try:
-            get_all_comments(database_name, post_id, access_token)
+            newest = get_all_comments(database_name, post_id, access_token, since=last_comment_time)['newest']
         except Exception as e:
 
             # Add a log entry for errors
             log_to_database(database_name, 'ERROR', f'Error in get_all_comments: {str(e)}', 'get_all_comments')
+            continue
 
-    # Close the connection
-    try:
-        conn.close()
-    except Exception as e:
+        # Move the watermark forward, and record activity only when something new arrived
+        if newest is not None and (last_comment_time is None or newest > last_comment_time):
+            last_comment_time = newest
+            last_activity = newest
+        try:
+            conn.execute('INSERT INTO fb_comment_sync (post_id, last_comment_time, last_checked, last_activity) '
+                         'VALUES (?, ?, ?, ?) ON CONFLICT(post_id) DO UPDATE SET '
+                         'last_comment_time = excluded.last_comment_time, last_checked = excluded.last_checked, '
+                         'last_activity = excluded.last_activity',
+                         (post_id, last_comment_time, now, last_activity))
+            conn.commit()
+        except Exception as e:
 
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in get_all_post_comments: {str(e)}', 'get_all_post_comments')
+            # Add a log entry for errors
+            log_to_database(database_name, 'ERROR', f'Error in get_all_post_comments: {str(e)}',
+                            'get_all_post_comments')
 
     # Add a log entry for function exit
     log_to_database(database_name, 'DEBUG', 'Exiting get_all_post_comments function', 'get_all_post_comments')
 
 
+# Reply sent to comments that do not carry a recognised command
+DEFAULT_REPLY = "Hi! Thank you for commenting! If you mean to ask a question, make sure to put" \
+                " [Question] before your comment. If you wanted to generate an AI DallE image, place [Image] before" \
+                " your prompt!"
+
+
+# ============================
+# Function: generate_reply
+# ============================
+@instrument
+def generate_reply(command, prompt, model, timeout=None, cache=None):
+    """
+    Build the reply text for a classified comment. 'image' commands are answered with a DallE image url and
+    'question' commands with a chat completion. When a cache is given, a cached response for the same normalized
+    prompt is returned without calling OpenAI.
+
+    Parameters:
+        command (str): The command type stored at ingest, see commands.classify_comment.
+        prompt (str): The comment text after the command prefix.
+        model (str): OpenAI chat completion model.
+        timeout (float): Seconds to wait for the OpenAI request. If None the SDK default is used.
+        cache (ResponseCache): Response cache to read from and fill. If None OpenAI is always called.
+
+    Returns:
+        str: The reply text.
+    """
+    # openai is slow to import and only replies use it, so it is loaded on first use
+    import openai
+
+    reply = DEFAULT_REPLY
+    if not prompt:
+        return reply
+
+    if command == 'image':
+        cached = cache.get('image', '1024x1024', prompt) if cache is not None else None
+        if cached is not None:
+            reply = cached
+        else:
+            start = time.perf_counter()
+            with timed('openai', 'image'):
+                image = openai.Image.create(
+                    prompt=prompt,
+                    n=1,
+                    size="1024x1024",
+                    request_timeout=timeout
+                )
+
+            if image:
+                reply = image['data'][0]['url']
+                if cache is not None:
+                    cache.put('image', '1024x1024', prompt, reply, time.perf_counter() - start)
+
+    elif command == 'question':
+        cached = cache.get('question', model, prompt) if cache is not None else None
+        if cached is not None:
+            reply = cached
+        else:
+            start = time.perf_counter()
+            with timed('openai', 'chat'):
+                completion = openai.ChatCompletion.create(
+                    model=model,
+                    messages=[
+                        {"role": "user", "content": prompt}
+                    ],
+                    request_timeout=timeout
+                )
+
+            if completion:
+                reply = completion['choices'][0]['message']['content']
+                if cache is not None:
+                    cache.put('question', model, prompt, reply, time.perf_counter() - start)
+
+    return reply
+
+
 # ============================
 # Function: reply_to_comments
 # ============================
-def reply_to_comments(database_name, access_token, model, openai_api):
+@instrument
+def reply_to_comments(database_name, access_token, model, openai_api, use_cache=True, max_attempts=3, backoff=5,
+                      stale_after=600):
     """
-    Iterate through the comments table in the database and use Facebook API to reply to each comment with a completed
-    status of 0. Once the comment has been successfully replied to, mark the completed column in the database with 1.
+    Reply to every due comment command waiting in fb_reply_queue, using the command and prompt stored at ingest. The
+    queue is read through its status index, so finding work costs time in proportion to the backlog. Comments are
+    claimed and marked posting before the reply is sent, like reply_to_comments_concurrent, so a crash or restart
+    never answers a comment twice. Once a comment has been replied to, it is marked done in the queue and completed
+    in fb_comments. Failed comments are retried on later runs with exponential backoff and marked failed after
+    max_attempts.
     Parameters:
         access_token (str): The access token to use for the Graph API.
         database_name (str): Path to the application db.
         model (str): OpenAI chat completion model.
         openai_api (str): OpenAi API Key.
+        use_cache (bool): Answer repeated prompts from the openai_cache table instead of calling OpenAI.
+        max_attempts (int): Attempts before a comment is marked failed.
+        backoff (float): Base delay in seconds before the first retry.
+        stale_after (int): Seconds after which an unfinished claim is considered abandoned.
     Returns:
         None
     """
@@ -261,65 +464,337 @@ def reply_to_comments(database_name, access_token, model, openai_api):
     # Log function entry
     log_to_database(database_name, 'DEBUG', 'Entering reply_to_comments function', 'reply_to_comments')
 
-    conn = sqlite3.connect(database_name)
-    c = conn.cursor()
+    # Get the shared connection for this thread
+    conn = get_connection(database_name)
+    _recover_reply_claims(conn, stale_after)
 
-    c.execute('SELECT comment_id, message FROM fb_comments WHERE completed = 0 and (message LIKE \'[Question]%\' OR '
-              'message LIKE \'[Image]%\')')
+    import openai
     openai.api_key = openai_api
-    graph = facebook.GraphAPI(access_token)
+    graph = get_graph_client(access_token)
+    cache = get_response_cache(database_name) if use_cache else None
 
-    for row in c.fetchall():
+    # Claim due comments one at a time, retries that back off past now are left to a later run
+    for comment_id, message, command, prompt, attempts in iter(functools.partial(_claim_reply, database_name), None):
         try:
-            comment_id, message = row[0], row[1]
-            reply = "Hi! Thank you for commenting! If you mean to ask a question, make sure to put" \
-                    " [Question] before your comment. If you wanted to generate an AI DallE image, place [Image] before" \
-                    " your prompt!"
+            reply = generate_reply(command, prompt, model, cache=cache)
 
-            if message.startswith('[Image]'):
-                message = message[8:]  # remove the first 8 characters
-                image = openai.Image.create(
-                    prompt=message,
-                    n=1,
-                    size="1024x1024"
-                )
+            if reply is not None:
+                # Mark the reply as being posted first, so a crash during put_comment is never resent automatically
+                with conn:
+                    conn.execute('UPDATE fb_reply_queue SET status = \'posting\' WHERE comment_id = ? AND message = ?',
+                                 (comment_id, message))
+                with timed('graph', 'put_comment'):
+                    graph.put_comment(comment_id, 'DEV: {}'.format(reply))
+                log_to_database(database_name, 'INFO', f'Replied to comment {comment_id}: {reply}',
+                                'reply_to_comments')
+                now = int(time.time())
+                with conn:
+                    conn.execute('UPDATE fb_comments SET completed = 1, postedOn = ?, openai_text = ? '
+                                 'WHERE comment_id = ? AND message = ?', (now, reply, comment_id, message))
+                    conn.execute('UPDATE fb_reply_queue SET status = \'done\', updated_at = ?, error = NULL '
+                                 'WHERE comment_id = ? AND message = ?', (now, comment_id, message))
+            else:
+                with conn:
+                    conn.execute('UPDATE fb_reply_queue SET status = \'failed\', updated_at = ?, '
+                                 'error = \'no reply generated\' WHERE comment_id = ? AND message = ?',
+                                 (int(time.time()), comment_id, message))
+        except Exception as e:
+            log_to_database(database_name, 'ERROR', f'Error processing comment: {comment_id}, Error: {str(e)}',
+                            'reply_to_comments')
+            now = int(time.time())
+            status, next_attempt_at = _next_reply_attempt(attempts, max_attempts, backoff, now)
+            with conn:
+                conn.execute('UPDATE fb_reply_queue SET status = ?, next_attempt_at = ?, updated_at = ?, error = ? '
+                             'WHERE comment_id = ? AND message = ?',
+                             (status, next_attempt_at, now, str(e), comment_id, message))
 
-                if image:
-                    reply = image['data'][0]['url']
+    if cache is not None:
+        log_to_database(database_name, 'INFO', f'Response cache: {cache.stats()}', 'reply_to_comments')
 
-            if message.startswith('[Question]'):
-                message = message[11:]  # remove the first 11 characters
-                completion = openai.ChatCompletion.create(
-                    model=model,
-                    messages=[
-                        {"role": "user", "content": message}
-                    ]
-                )
+    # Log function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting reply_to_comments function', 'reply_to_comments')
 
-                if completion:
-                    reply = completion['choices'][0]['message']['content']
 
-            if reply is not None:
+# ============================
+# Function: _next_reply_attempt
+# ============================
+def _next_reply_attempt(attempts, max_attempts, backoff, now):
+    """
+    Return the queue status and retry time of a comment whose reply just failed. Retries back off exponentially
+    with jitter, and the comment is marked failed once it has been tried max_attempts times.
+
+    Parameters:
+        attempts (int): Attempts made so far, including the failed one.
+        max_attempts (int): Attempts before a comment is marked failed.
+        backoff (float): Base delay in seconds before the first retry.
+        now (int): Current epoch seconds.
+
+    Returns:
+        tuple: (status, next_attempt_at).
+    """
+    if attempts >= max_attempts:
+        return 'failed', now
+    return 'pending', now + int(backoff * 2 ** (attempts - 1) * random.uniform(1, 1.5))
+
+
+# ============================
+# Function: _claim_reply
+# ============================
+def _claim_reply(database_name):
+    """
+    Atomically move one due pending comment in fb_reply_queue to in_flight.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        tuple: (comment_id, message, command, prompt, attempts) of the claimed comment, or None if nothing is due.
+    """
+    conn = get_connection(database_name)
+    now = int(time.time())
+    with conn:
+        row = conn.execute('UPDATE fb_reply_queue SET status = \'in_flight\', claimed_at = ?, attempts = attempts + 1 '
+                           'WHERE rowid = (SELECT rowid FROM fb_reply_queue WHERE status = \'pending\' '
+                           'AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1) '
+                           'RETURNING comment_id, message, command, prompt, attempts', (now, now)).fetchone()
+    return row
+
+
+# ============================
+# Function: _reply_worker
+# ============================
+def _reply_worker(database_name, graph, model, timeout, max_attempts, backoff, latencies, cache):
+    """
+    Claim and answer queued comments until none are pending. Failed attempts are retried with exponential backoff
+    and jitter until max_attempts is reached.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        graph (facebook.GraphAPI): Graph API client used to post replies.
+        model (str): OpenAI chat completion model.
+        timeout (float): Seconds to wait for each OpenAI request.
+        max_attempts (int): Attempts before a comment is marked failed.
+        backoff (float): Base delay in seconds before the first retry.
+        latencies (list): Seconds taken by each comment answered, appended to by the worker.
+        cache (ResponseCache): Response cache passed to generate_reply, or None.
+
+    Returns:
+        None
+    """
+    conn = get_connection(database_name)
+    while True:
+        claimed = _claim_reply(database_name)
+        if claimed is None:
+            # Wait for comments that are backing off, stop once nothing is left to retry
+            pending = conn.execute('SELECT MIN(next_attempt_at) FROM fb_reply_queue '
+                                   'WHERE status = \'pending\'').fetchone()[0]
+            if pending is None:
+                return
+            time.sleep(min(max(pending - time.time(), 0.1), 5))
+            continue
+
+        comment_id, message, command, prompt, attempts = claimed
+        start = time.perf_counter()
+        try:
+            reply = generate_reply(command, prompt, model, timeout=timeout, cache=cache)
+
+            # Mark the reply as being posted first, so a crash during put_comment is never resent automatically
+            with conn:
+                conn.execute('UPDATE fb_reply_queue SET status = \'posting\' WHERE comment_id = ? AND message = ?',
+                             (comment_id, message))
+            with timed('graph', 'put_comment'):
                 graph.put_comment(comment_id, 'DEV: {}'.format(reply))
-                print('Reply to comment {}\nQ:{}\nA:{}'.format(comment_id, message, reply))
-                c.execute(
-                    f'UPDATE fb_comments SET completed = 1, postedOn = {int(time.time())} WHERE comment_id = ? and '
-                    f'message = ?', (comment_id, row[1]))
-                conn.commit()
+
+            now = int(time.time())
+            with conn:
+                conn.execute('UPDATE fb_comments SET completed = 1, postedOn = ?, openai_text = ? '
+                             'WHERE comment_id = ? AND message = ?', (now, reply, comment_id, message))
+                conn.execute('UPDATE fb_reply_queue SET status = \'done\', updated_at = ?, error = NULL '
+                             'WHERE comment_id = ? AND message = ?', (now, comment_id, message))
+            latencies.append(time.perf_counter() - start)
         except Exception as e:
             log_to_database(database_name, 'ERROR', f'Error processing comment: {comment_id}, Error: {str(e)}',
-                            'reply_to_comments')
+                            'reply_to_comments_concurrent')
+            now = int(time.time())
+            status, next_attempt_at = _next_reply_attempt(attempts, max_attempts, backoff, now)
+            with conn:
+                conn.execute('UPDATE fb_reply_queue SET status = ?, next_attempt_at = ?, updated_at = ?, error = ? '
+                             'WHERE comment_id = ? AND message = ?',
+                             (status, next_attempt_at, now, str(e), comment_id, message))
+
+
+# ============================
+# Function: _recover_reply_claims
+# ============================
+def _recover_reply_claims(conn, stale_after):
+    """
+    Return comments left in_flight for longer than stale_after seconds to pending. Comments left in posting may
+    already have been answered on Facebook, so they are marked failed for review instead of retried.
+    """
+    now = int(time.time())
+    with conn:
+        conn.execute('UPDATE fb_reply_queue SET status = \'pending\' WHERE status = \'in_flight\' AND claimed_at < ?',
+                     (now - stale_after,))
+        conn.execute('UPDATE fb_reply_queue SET status = \'failed\', error = \'interrupted while posting\' '
+                     'WHERE status = \'posting\' AND claimed_at < ?', (now - stale_after,))
+
+
+# ============================
+# Function: _start_reply_run
+# ============================
+def _start_reply_run(database_name, access_token, openai_api, timeout, stale_after, use_cache):
+    """
+    Return claims abandoned by an earlier run to the queue and set up the clients of a reply run.
+
+    Returns:
+        tuple: (graph client, response cache or None, failed comments before the run).
+    """
+    conn = get_connection(database_name)
+    _recover_reply_claims(conn, stale_after)
+    failed_before = conn.execute('SELECT COUNT(*) FROM fb_reply_queue WHERE status = \'failed\'').fetchone()[0]
+
+    import openai
+    openai.api_key = openai_api
+    graph = get_graph_client(access_token, timeout=timeout)
+    cache = get_response_cache(database_name) if use_cache else None
+    return graph, cache, failed_before
+
+
+# ============================
+# Function: _finish_reply_run
+# ============================
+def _finish_reply_run(database_name, start, failed_before, latencies, cache):
+    """
+    Build and log the report of a reply run.
+
+    Returns:
+        dict: The run report.
+    """
+    conn = get_connection(database_name)
+    elapsed = time.perf_counter() - start
+    failed = conn.execute('SELECT COUNT(*) FROM fb_reply_queue WHERE status = \'failed\'').fetchone()[0]
+    latencies.sort()
+    report = {
+        'replied': len(latencies),
+        'failed': failed - failed_before,
+        'seconds': round(elapsed, 3),
+        'replies_per_second': round(len(latencies) / elapsed, 3) if elapsed > 0 else 0.0,
+        'latency_p50': round(latencies[len(latencies) // 2], 3) if latencies else None,
+        'latency_p95': round(latencies[int(len(latencies) * 0.95)], 3) if latencies else None,
+        'latency_max': round(latencies[-1], 3) if latencies else None,
+        'cache': cache.stats() if cache is not None else None,
+    }
+    log_to_database(database_name, 'INFO', f'Reply run: {report}', 'reply_to_comments_concurrent')
+    return report
+
+
+# ============================
+# Function: reply_to_comments_concurrent
+# ============================
+@instrument
+def reply_to_comments_concurrent(database_name, access_token, model, openai_api, workers=4, timeout=60,
+                                 max_attempts=3, backoff=5, stale_after=600, use_cache=True):
+    """
+    Worker-pool version of reply_to_comments. Comment commands queued in fb_reply_queue at ingest are claimed one at
+    a time by each worker (pending, in_flight, posting, done or failed), so an interrupted run resumes where
+    it stopped without sending duplicate replies.
+
+    Comments left in_flight by a crash for longer than stale_after seconds are returned to pending. Comments left in
+    posting may already have been answered on Facebook, so they are marked failed for review instead of retried.
+
+    Parameters:
+        access_token (str): The access token to use for the Graph API.
+        database_name (str): Path to the application db.
+        model (str): OpenAI chat completion model.
+        openai_api (str): OpenAi API Key.
+        workers (int): Number of comments processed at the same time.
+        timeout (float): Seconds to wait for each OpenAI and Graph API request.
+        max_attempts (int): Attempts before a comment is marked failed.
+        backoff (float): Base delay in seconds before the first retry.
+        stale_after (int): Seconds after which an unfinished claim is considered abandoned.
+        use_cache (bool): Answer repeated prompts from the openai_cache table instead of calling OpenAI.
+    Returns:
+        dict: Run report with replied, failed, seconds, replies_per_second, latency figures in seconds and the
+            response cache counters.
+    """
+
+    # Log function entry
+    log_to_database(database_name, 'DEBUG', 'Entering reply_to_comments_concurrent function',
+                    'reply_to_comments_concurrent')
+
+    start = time.perf_counter()
+    graph, cache, failed_before = _start_reply_run(database_name, access_token, openai_api, timeout, stale_after,
+                                                   use_cache)
+    latencies = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_reply_worker, database_name, graph, model, timeout, max_attempts, backoff,
+                                   latencies, cache) for _ in range(workers)]
+        for future in futures:
+            future.result()
+
+    report = _finish_reply_run(database_name, start, failed_before, latencies, cache)
 
     # Log function exit
-    log_to_database(database_name, 'DEBUG', 'Exiting reply_to_comments function', 'reply_to_comments')
+    log_to_database(database_name, 'DEBUG', 'Exiting reply_to_comments_concurrent function',
+                    'reply_to_comments_concurrent')
+
+    return report
+
+
+# ============================
+# Function: reply_to_comments_async
+# ============================
+async def reply_to_comments_async(database_name, access_token, model, openai_api, run_blocking, workers=4, timeout=60,
+                                  max_attempts=3, backoff=5, stale_after=600, use_cache=True):
+    """
+    Async version of reply_to_comments_concurrent for the daemon. Every blocking step and each worker goes through
+    run_blocking, e.g. Daemon.run_blocking, instead of a thread pool of its own, so replies share the daemon's
+    bounded pool and nothing holds a thread while it waits for the workers.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        access_token (str): The access token to use for the Graph API.
+        model (str): OpenAI chat completion model.
+        openai_api (str): OpenAi API Key.
+        run_blocking (callable): Coroutine function that runs a function with no arguments in a thread pool and
+            returns its result.
+        workers (int): Number of comments processed at the same time.
+        timeout (float): Seconds to wait for each OpenAI and Graph API request.
+        max_attempts (int): Attempts before a comment is marked failed.
+        backoff (float): Base delay in seconds before the first retry.
+        stale_after (int): Seconds after which an unfinished claim is considered abandoned.
+        use_cache (bool): Answer repeated prompts from the openai_cache table instead of calling OpenAI.
+    Returns:
+        dict: Run report, see reply_to_comments_concurrent.
+    """
+
+    # Log function entry
+    log_to_database(database_name, 'DEBUG', 'Entering reply_to_comments_async function', 'reply_to_comments_async')
+
+    start = time.perf_counter()
+    graph, cache, failed_before = await run_blocking(functools.partial(
+        _start_reply_run, database_name, access_token, openai_api, timeout, stale_after, use_cache))
+    latencies = []
+
+    await asyncio.gather(*[run_blocking(functools.partial(
+        _reply_worker, database_name, graph, model, timeout, max_attempts, backoff, latencies, cache))
+        for _ in range(workers)])
+
+    report = await run_blocking(functools.partial(
+        _finish_reply_run, database_name, start, failed_before, latencies, cache))
+
+    # Log function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting reply_to_comments_async function', 'reply_to_comments_async')
 
-    conn.close()
+    return report
 
 
 # ============================
 # Function: post_to_facebook
 # ============================
-def post_to_facebook(database_name, access_token, table):
+@instrument
+def post_to_facebook(database_name, access_token, table, strategy='uniform'):
     """
     Post content from database tables. This can be used to pull random meme, or quote data to attach to facebook
     message.
@@ -328,6 +803,8 @@ def post_to_facebook(database_name, access_token, table):
             access_token (str): The access token to use for the Graph API.
             table (str): The table name to retrieve post data.
             database_name (str): Path to the application db.
+            strategy (str): How the row is picked, 'uniform', or 'ups' / 'recent' for weighted meme picks. See
+                selector.pick_unposted.
 
         Returns:
             None
@@ -338,16 +815,7 @@ def post_to_facebook(database_name, access_token, table):
 
     # Initialize the Facebook Graph API with the access token
     try:
-        graph = facebook.GraphAPI(access_token)
-    except Exception as e:
-
-        # Add a log entry for errors
-        log_to_database(database_name, 'ERROR', f'Error in post_to_facebook: {str(e)}', 'post_to_facebook')
-
-    # Connect to the SQLite database
-    try:
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
+        graph = get_graph_client(access_token)
     except Exception as e:
 
         # Add a log entry for errors
@@ -355,8 +823,7 @@ def post_to_facebook(database_name, access_token, table):
 
     # Retrieve a random quote from the specified table in the database
     try:
-        c.execute(f'SELECT * FROM {table} WHERE posted = 0 ORDER BY RANDOM() LIMIT 1')
-        row = c.fetchall()
+        row = pick_unposted(database_name, table, strategy)
     except Exception as e:
 
         # Add a log entry for errors
@@ -370,7 +837,14 @@ def post_to_facebook(database_name, access_token, table):
             if not image_url.startswith('http'):
                 image_url = 'http://' + image_url
 
-            image_data = requests.get(image_url).content
+            # Use the normalized or original copy cached on disk, and only download the image when there is none
+            media_path = get_cached_media(database_name, row[0][0])
+            if media_path is None:
+                with timed('http', 'image'):
+                    image_data = requests.get(image_url).content
+                inc('bytes_downloaded_total', len(image_data), source='post_to_facebook')
+            inc('bytes_uploaded_total', len(image_data) if media_path is None else os.path.getsize(media_path),
+                target='put_photo')
             if "r/ProgrammerHumor" in row[0][1]:
                 message = "{}\n#ProgrammerHumor \n#CodeLife \n#ProgrammingMemes \n#GeekHumor \n#TechLaughs " \
                           "\n#DebuggingLife \n#NerdLaughs \n#CodeJokes \n#SoftwareHumor \n#DevLife " \
@@ -388,7 +862,12 @@ def post_to_facebook(database_name, access_token, table):
 
             # Post the meme to the Facebook page
             try:
-                graph.put_photo(image=image_data, album_id=album_id, message=message)
+                with timed('graph', 'put_photo'):
+                    if media_path is not None:
+                        with open(media_path, 'rb') as image_file:
+                            graph.put_photo(image=image_file, album_id=album_id, message=message)
+                    else:
+                        graph.put_photo(image=image_data, album_id=album_id, message=message)
             except Exception as e:
 
                 # Add a log entry for errors
@@ -412,7 +891,8 @@ def post_to_facebook(database_name, access_token, table):
 
             # Post the quote to the Facebook page
             try:
-                graph.put_object('me', 'feed', message=message)
+                with timed('graph', 'put_object'):
+                    graph.put_object('me', 'feed', message=message)
             except Exception as e:
 
                 # Add a log entry for errors
@@ -434,43 +914,78 @@ def post_to_facebook(database_name, access_token, table):
 # ============================
 # Function: remove_dev_posts
 # ============================
-def remove_dev_posts(database_name, page_id, access_token, regex_pattern):
+@instrument
+def remove_dev_posts(database_name, page_id, access_token, regex_pattern, bulk=False, dry_run=False, refresh=True,
+                     concurrency=4):
     """
     This can be used to remove bulk posts on the requested Facebook PageID
 
+    By default the live feed is walked page by page and matching posts are deleted one at a time. With bulk=True
+    candidates are found in fb_posts instead, after an incremental refresh of the stored posts, and deleted with
+    concurrent Graph API batch calls that resume after an interruption, see bulk_delete_posts.
+
     Parameters:
         database_name (str): Path to the application db.
         page_id (str): The ID of the page to retrieve posts for.
         access_token (str): The access token to use for the Graph API.
         regex_pattern (str): The regex pattern used to find specific types of messages on a post
+        bulk (bool): Delete the matching posts stored in fb_posts with batched requests.
+        dry_run (bool): Only report the posts that would be deleted.
+        refresh (bool): In bulk mode, fetch posts newer than the stored ones first.
+        concurrency (int): In bulk mode, maximum number of batch calls in flight.
     Returns:
-        None
+        dict: In bulk mode the bulk_delete_posts report, otherwise the matched and deleted post counts.
     """
     # Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering remove_dev_posts function', 'remove_dev_posts')
 
+    if bulk:
+        from .fbcrawler import bulk_delete_posts
+
+        if refresh:
+            get_all_posts(database_name, page_id, access_token, incremental=True)
+        report = asyncio.run(bulk_delete_posts(database_name, access_token, regex_pattern, dry_run=dry_run,
+                                               concurrency=concurrency))
+
+        # Add a log entry for function exit
+        log_to_database(database_name, 'DEBUG', 'Exiting remove_dev_posts function', 'remove_dev_posts')
+        return report
+
+    report = {'dry_run': dry_run, 'matched': 0, 'deleted': 0}
+    pattern = re.compile(regex_pattern, re.IGNORECASE)
+
     # Initialize the Facebook Graph API with the access token
-    graph = facebook.GraphAPI(access_token)
+    graph = get_graph_client(access_token)
 
     # Retrieve all posts from page
-    posts = graph.get_connections(page_id, "feed")
+    with timed('graph', 'get_connections'):
+        posts = graph.get_connections(page_id, "feed")
 
     # Continuously loop through the posts until no more pages are available
     while True:
         # Loop through each post in the current batch of posts
-        for post in posts['data'][:-1]:
+        for post in posts['data']:
 
             # Check if the post contains a message and if the message matches the regex pattern
-            if 'message' in post and re.search(regex_pattern, post['message'], re.IGNORECASE):
+            if 'message' in post and pattern.search(post['message']):
+                report['matched'] += 1
+                if dry_run:
+                    log_to_database(database_name, 'INFO', f'Would delete post with ID: {post["id"]}',
+                                    'remove_dev_posts')
+                    continue
+
                 # Delete the post from the page
-                graph.delete_object(post['id'])
+                with timed('graph', 'delete_object'):
+                    graph.delete_object(post['id'])
+                report['deleted'] += 1
                 log_to_database(database_name, 'INFO', f'Deleted post with ID: {post["id"]}', 'remove_dev_posts')
 
         # Check if there are more pages of posts
         if 'paging' in posts and 'next' in posts['paging']:
 
             # Retrieve the next page of posts
-            posts = requests.get(posts['paging']['next']).json()
+            with timed('graph', 'get_connections'):
+                posts = graph.get_connections(page_id, 'feed', after=posts['paging']['cursors']['after'])
         else:
 
             # If no more pages are available, break the loop
@@ -478,3 +993,5 @@ def remove_dev_posts(database_name, page_id, access_token, regex_pattern):
 
     # Add a log entry for function exit
     log_to_database(database_name, 'DEBUG', 'Exiting remove_dev_posts function', 'remove_dev_posts')
+
+    return report
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import facebook
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import inc, observe
+
+# Graph API error codes returned when a rate limit is hit: application, user, page, per-endpoint hourly limits and
+# the business use case range
+THROTTLE_CODES = {4, 17, 32, 613}
+BUSINESS_THROTTLE_CODES = range(80000, 80015)
+
+# Usage headers reported by the Graph API, each a JSON object of percentages of the limit used
+USAGE_HEADERS = ('X-App-Usage', 'X-Page-Usage', 'X-Business-Use-Case-Usage')
+
+# Requests per second and burst size of each token's limiter while usage is low
+DEFAULT_RATE = float(os.getenv('FB_GRAPH_RATE', '50'))
+DEFAULT_BURST = float(os.getenv('FB_GRAPH_BURST', '100'))
+
+# Usage percentage above which the request rate is lowered, reaching min_rate at 100%
+SLOWDOWN_USAGE = 50
+
+# Connections kept alive per host in the session shared by every token
+POOL_SIZE = 16
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_session = None
+_session_lock = threading.Lock()
+
+# Limiter of the request in flight on each thread, read by the shared session's response hook
+_current = threading.local()
+
+
+# ============================
+# Function: is_throttle_error
+# ============================
+def is_throttle_error(code):
+    """
+    Return True if a Graph API error code means a rate limit was hit.
+
+    Parameters:
+        code (int): The error code.
+
+    Returns:
+        bool: True for throttling errors.
+    """
+    return code in THROTTLE_CODES or code in BUSINESS_THROTTLE_CODES
+
+
+# ============================
+# Function: parse_usage
+# ============================
+def parse_usage(headers):
+    """
+    Read the highest usage percentage and the longest lockout from the Graph API usage headers. Business use case
+    usage is reported per business and per type, every entry counts.
+
+    Parameters:
+        headers (Mapping): Response headers, looked up case-insensitively by requests and aiohttp.
+
+    Returns:
+        tuple: (usage, regain_seconds) where usage is the highest percentage, None if no header was present, and
+            regain_seconds the longest estimated_time_to_regain_access, converted from minutes.
+    """
+    usage = None
+    regain = 0
+    for name in USAGE_HEADERS:
+        raw = headers.get(name)
+        if not raw:
+            continue
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            continue
+        entries = [value] if name != 'X-Business-Use-Case-Usage' else \
+            [entry for group in value.values() for entry in group]
+        for entry in entries:
+            for key in ('call_count', 'total_cputime', 'total_time'):
+                if isinstance(entry.get(key), (int, float)):
+                    usage = max(usage or 0, entry[key])
+            regain = max(regain, (entry.get('estimated_time_to_regain_access') or 0) * 60)
+    return usage, regain
+
+
+# ============================
+# Class: RateLimiter
+# ============================
+class RateLimiter:
+    """
+    Token bucket shared by every Graph API call made with one access token. The refill rate follows the usage
+    headers: full rate below SLOWDOWN_USAGE percent, falling linearly to min_rate as usage reaches 100%. A lockout
+    reported in the headers, or a throttling error, pauses every caller until it is over. Callers that take more
+    tokens than are available borrow against the refill and wait for it, so batch calls can cost more than burst.
+
+    Parameters:
+        rate (float): Requests per second when usage is low.
+        burst (float): Requests that can be made at once after an idle period.
+        min_rate (float): Requests per second when usage is at or above 100%.
+        backoff (float): Seconds of the first pause after a throttling error, doubled on every retry.
+        max_backoff (float): Longest pause after a throttling error.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=0.2, backoff=2.0, max_backoff=300.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.usage = None
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, cost):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= cost
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(delay, self._blocked_until - now)
+
+    def acquire(self, cost=1):
+        """
+        Take cost tokens, sleeping until they are available.
+
+        Parameters:
+            cost (int): Requests about to be made, e.g. the size of a batch call.
+
+        Returns:
+            float: Seconds slept.
+        """
+        delay = self._reserve(cost)
+        if delay > 0:
+            observe('graph_rate_wait_seconds', delay)
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self, cost=1):
+        """
+        Coroutine version of acquire that waits without blocking the event loop.
+
+        Parameters:
+            cost (int): Requests about to be made, e.g. the size of a batch call.
+
+        Returns:
+            float: Seconds waited.
+        """
+        delay = self._reserve(cost)
+        if delay > 0:
+            observe('graph_rate_wait_seconds', delay)
+            await asyncio.sleep(delay)
+        return delay
+
+    def update(self, headers):
+        """
+        Adjust the rate to the usage reported in a response's headers. Responses without usage headers raise a
+        lowered rate back towards the full rate a step at a time.
+
+        Parameters:
+            headers (Mapping): The response headers.
+
+        Returns:
+            None
+        """
+        usage, regain = parse_usage(headers)
+        with self._lock:
+            if usage is None and not regain:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+                return
+            if usage is not None:
+                self.usage = usage
+                if usage <= SLOWDOWN_USAGE:
+                    self.rate = self.max_rate
+                else:
+                    fraction = max(0.0, (100 - usage) / (100 - SLOWDOWN_USAGE))
+                    self.rate = max(self.min_rate, self.max_rate * fraction)
+            if regain:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + regain)
+
+    def throttled(self, attempt):
+        """
+        Record a throttling error. Every caller is paused for an exponential backoff with full jitter, and the rate is
+        halved. A longer lockout reported in the error's usage headers still applies, see update.
+
+        Parameters:
+            attempt (int): Retries already made for the failed request, starting at 0.
+
+        Returns:
+            float: Seconds the limiter is paused for.
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+
+    def stats(self):
+        """
+        Return the limiter's state.
+
+        Returns:
+            dict: Current rate, last reported usage and seconds left in a pause.
+        """
+        return {'rate': self.rate, 'usage': self.usage,
+                'blocked_seconds': max(0.0, self._blocked_until - time.monotonic())}
+
+
+# ============================
+# Class: GraphClient
+# ============================
+class GraphClient(facebook.GraphAPI):
+    """
+    facebook.GraphAPI that paces every request with the token's shared RateLimiter and retries throttling errors.
+    Requests go through one pooled requests.Session shared by every token, so connections are kept alive between
+    calls and shared across threads and pages.
+
+    Parameters:
+        access_token (str): The access token to use for the Graph API.
+        timeout (float): Seconds to wait for each request. If None requests waits indefinitely.
+        max_retries (int): Retries of a throttled request before the error is raised.
+    """
+
+    def __init__(self, access_token, timeout=None, max_retries=5):
+        super().__init__(access_token, timeout=timeout, session=_get_session())
+        self.limiter = get_rate_limiter(access_token)
+        self.max_retries = max_retries
+
+    def request(self, path, args=None, post_args=None, files=None, method=None):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            _current.limiter = self.limiter
+            try:
+                return super().request(path, args=dict(args or {}), post_args=post_args and dict(post_args),
+                                       files=files, method=method)
+            except facebook.GraphAPIError as e:
+                if not is_throttle_error(e.code) or attempt >= self.max_retries:
+                    raise
+                inc('graph_throttled_total', code=e.code)
+                self.limiter.throttled(attempt)
+                attempt += 1
+
+                # Rewind uploads so the retry sends the whole file again
+                for value in (files or {}).values():
+                    if hasattr(value, 'seek'):
+                        value.seek(0)
+
+
+# ============================
+# Function: _get_session
+# ============================
+def _get_session():
+    """
+    Return the pooled session shared by every GraphClient, creating it on first use. Its response hook feeds the
+    usage headers of every response, including errors, to the limiter of the token that made the request.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.hooks['response'].append(_update_limiter)
+                _session = session
+    return _session
+
+
+def _update_limiter(response, *args, **kwargs):
+    limiter = getattr(_current, 'limiter', None)
+    if limiter is not None:
+        limiter.update(response.headers)
+
+
+# ============================
+# Function: get_rate_limiter
+# ============================
+def get_rate_limiter(access_token):
+    """
+    Return the rate limiter shared by every Graph API call made with an access token, creating it on first use, so
+    callers that do not use GraphClient, like the batch crawler, are paced together with it.
+
+    Parameters:
+        access_token (str): The access token to use for the Graph API.
+
+    Returns:
+        RateLimiter: The token's limiter.
+    """
+    limiter = _limiters.get(access_token)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(access_token, RateLimiter())
+    return limiter
+
+
+# ============================
+# Function: get_graph_client
+# ============================
+def get_graph_client(access_token, timeout=None):
+    """
+    Return a Graph API client for an access token that shares the pooled session and the token's rate limiter.
+
+    Parameters:
+        access_token (str): The access token to use for the Graph API.
+        timeout (float): Seconds to wait for each request. If None requests waits indefinitely.
+
+    Returns:
+        GraphClient: The client.
+    """
+    return GraphClient(access_token, timeout=timeout)
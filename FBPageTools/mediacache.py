@@ -0,0 +1,208 @@
+import hashlib
+import imghdr
+import os
+import time
+import uuid
+
+from .dbconn import get_connection
+
+# Columns added to the memes table by migration 2 to record where an image is cached
+MEDIA_COLUMNS = (('media_path', 'TEXT'), ('media_size', 'INTEGER'), ('media_hash', 'TEXT'))
+
+# Columns added to the memes table by migration 6 to record the normalized copy uploaded instead, see mediaprep
+UPLOAD_COLUMNS = (('upload_path', 'TEXT'), ('upload_size', 'INTEGER'))
+
+# Bytes inspected with imghdr before the rest of the image is streamed to disk
+SNIFF_BYTES = 2048
+
+
+# ============================
+# Function: get_media_dir
+# ============================
+def get_media_dir(database_name):
+    """
+    Return the media cache directory for a database. Defaults to a media folder next to the database file and can be
+    overridden with the MEDIA_CACHE_DIR environment variable.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        str: Path to the media cache directory.
+    """
+    return os.getenv('MEDIA_CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(database_name)), 'media')
+
+
+# ============================
+# Function: fetch_to_cache
+# ============================
+async def fetch_to_cache(session, semaphore, url, media_dir, sniff_bytes=SNIFF_BYTES, chunk_size=65536):
+    """
+    Stream an image to the content-addressed media cache in a single request. The first bytes are checked with
+    imghdr and the download is abandoned straight away if they are not an image. Files are stored as
+    <media_dir>/<first two hash chars>/<sha256>.<type>, so the same image posted under several urls is kept once.
+
+    Parameters:
+        session (aiohttp.ClientSession): The shared HTTP session.
+        semaphore (asyncio.Semaphore): Bounds the number of downloads in flight.
+        url (str): The image url.
+        media_dir (str): The media cache directory.
+        sniff_bytes (int): Number of leading bytes checked before the rest is downloaded.
+        chunk_size (int): Bytes read from the response per chunk.
+
+    Returns:
+        tuple: (image_type, path, size, sha256) where image_type is the imghdr format name and size the bytes read.
+            image_type, path and sha256 are None when the url is not an image.
+    """
+    os.makedirs(media_dir, exist_ok=True)
+    temp_path = os.path.join(media_dir, f'.{uuid.uuid4().hex}.part')
+    digest = hashlib.sha256()
+    size = 0
+
+    async with semaphore:
+        async with session.get(url) as response:
+            response.raise_for_status()
+
+            head = b''
+            while len(head) < sniff_bytes:
+                chunk = await response.content.read(sniff_bytes - len(head))
+                if not chunk:
+                    break
+                head += chunk
+
+            image_type = imghdr.what(None, h=head)
+            if image_type is None:
+                return None, None, len(head), None
+
+            try:
+                with open(temp_path, 'wb') as f:
+                    f.write(head)
+                    digest.update(head)
+                    size += len(head)
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+    sha256 = digest.hexdigest()
+    path = os.path.join(media_dir, sha256[:2], f'{sha256}.{image_type}')
+    if os.path.exists(path):
+        os.remove(temp_path)
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    return image_type, path, size, sha256
+
+
+# ============================
+# Function: discard_media
+# ============================
+def discard_media(database_name, paths):
+    """
+    Delete cached images that no memes row points at, such as the downloads of memes rejected as near-duplicates or
+    not stored. Files are content-addressed, so a file shared with a stored meme is kept.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        paths (list): Paths returned by fetch_to_cache.
+
+    Returns:
+        int: Files removed.
+    """
+    paths = set(paths)
+    if not paths:
+        return 0
+    used = {row[0] for row in get_connection(database_name).execute(
+        f'SELECT media_path FROM memes WHERE media_path IN ({", ".join("?" * len(paths))})', list(paths))}
+
+    removed = 0
+    for path in paths - used:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+    return removed
+
+
+# ============================
+# Function: get_cached_media
+# ============================
+def get_cached_media(database_name, meme_id):
+    """
+    Return the cached image file for a meme if it is still on disk. The normalized upload copy is preferred over the
+    original download when both exist.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        meme_id (str): The memes row id.
+
+    Returns:
+        str: Path to the cached image, or None if the meme has no cached file.
+    """
+    row = get_connection(database_name).execute('SELECT upload_path, media_path FROM memes WHERE id = ?',
+                                                (meme_id,)).fetchone()
+    for path in row or ():
+        if path is not None and os.path.exists(path):
+            return path
+    return None
+
+
+# ============================
+# Function: evict_media
+# ============================
+def evict_media(database_name, media_dir=None, max_age=2592000, max_bytes=2147483648):
+    """
+    Delete cached images older than max_age, then the least recently written images until the cache fits in
+    max_bytes. Rows pointing at deleted files have their media columns cleared so the poster falls back to the url.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        media_dir (str): The media cache directory. Defaults to get_media_dir(database_name).
+        max_age (int): Seconds an image is kept. If None images are only evicted for space.
+        max_bytes (int): Disk budget for the cache in bytes. If None images are only evicted by age.
+
+    Returns:
+        dict: removed file count, freed bytes and remaining bytes.
+    """
+    media_dir = media_dir or get_media_dir(database_name)
+    files = []
+    for root, _, names in os.walk(media_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    files.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in files)
+    removed = []
+    for mtime, size, path in files:
+        expired = max_age is not None and now - mtime > max_age
+        over_budget = max_bytes is not None and total > max_bytes
+        if not expired and not over_budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append((path, size))
+
+    conn = get_connection(database_name)
+    if removed and conn.execute('SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = \'memes\'').fetchone():
+        with conn:
+            conn.executemany('UPDATE memes SET media_path = NULL, media_size = NULL WHERE media_path = ?',
+                             [(path,) for path, _ in removed])
+            conn.executemany('UPDATE memes SET upload_path = NULL, upload_size = NULL WHERE upload_path = ?',
+                             [(path,) for path, _ in removed])
+
+    return {'removed': len(removed), 'freed_bytes': sum(size for _, size in removed), 'remaining_bytes': total}
@@ -0,0 +1,257 @@
+import hashlib
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import requests
+from PIL import Image, ImageOps
+
+from .dbapp import log_to_database
+from .dbconn import get_connection
+from .mediacache import get_media_dir
+from .metrics import inc, instrument
+
+# Longest side in pixels of an uploaded image, larger images are downscaled
+MAX_SIDE = 2048
+
+# JPEG quality of the first encode, and the lowest quality tried before the image is shrunk further
+JPEG_QUALITY = 85
+MIN_QUALITY = 60
+
+# Largest upload in bytes, images are re-encoded at lower quality or a smaller size until they fit
+MAX_UPLOAD_BYTES = 1048576
+
+# EXIF tag holding the orientation the pixels must be rotated to
+ORIENTATION_TAG = 0x0112
+
+
+# ============================
+# Function: get_upload_dir
+# ============================
+def get_upload_dir(database_name):
+    """
+    Return the directory of normalized upload copies, an upload folder inside the media cache directory so
+    evict_media manages both.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        str: Path to the upload directory.
+    """
+    return os.path.join(get_media_dir(database_name), 'upload')
+
+
+def _encode(img, quality):
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+# ============================
+# Function: normalize_image
+# ============================
+def normalize_image(image, max_side=MAX_SIDE, quality=JPEG_QUALITY, max_bytes=MAX_UPLOAD_BYTES,
+                    min_quality=MIN_QUALITY):
+    """
+    Re-encode an image as a progressive JPEG for upload. The EXIF orientation is applied to the pixels, transparency
+    is flattened onto white, the image is downscaled to fit max_side and no metadata is written. Quality is lowered
+    in steps down to min_quality, then the image is shrunk, until the result fits in max_bytes.
+
+    Parameters:
+        image (str | file): Path or file object of the image.
+        max_side (int): Longest side in pixels of the result.
+        quality (int): JPEG quality of the first encode.
+        max_bytes (int): Largest size in bytes of the result. If None only quality and max_side apply.
+        min_quality (int): Lowest JPEG quality tried before shrinking.
+
+    Returns:
+        bytes: The JPEG data.
+    """
+    with Image.open(image) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel('A'))
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        data = _encode(img, quality)
+        while max_bytes is not None and len(data) > max_bytes:
+            if quality > min_quality:
+                quality = max(min_quality, quality - 10)
+            elif min(img.size) > 64:
+                img = img.resize((int(img.width * 0.75), int(img.height * 0.75)), Image.LANCZOS)
+            else:
+                break
+            data = _encode(img, quality)
+    return data
+
+
+# ============================
+# Function: _within_limits
+# ============================
+def _within_limits(image, max_side, max_bytes, size):
+    """
+    Return True if an image can be uploaded as it is: it fits in max_bytes and max_side and needs no rotation.
+    """
+    with Image.open(image) as img:
+        rotated = img.getexif().get(ORIENTATION_TAG, 1) != 1
+        return not rotated and max(img.size) <= max_side and (max_bytes is None or size <= max_bytes)
+
+
+# ============================
+# Function: _store_upload
+# ============================
+def _store_upload(upload_dir, data, extension):
+    """
+    Write upload data to the upload directory under its sha256 and return the path. Identical data is stored once.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = os.path.join(upload_dir, sha256[:2], f'{sha256}.{extension}')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(upload_dir, f'.{uuid.uuid4().hex}.part')
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    return path
+
+
+# ============================
+# Function: _normalize_meme
+# ============================
+def _normalize_meme(job):
+    """
+    Normalize one meme in a worker process, from its cached file when available or else by downloading its url. The
+    result is stored content-addressed in the upload directory. When the re-encode is no smaller than a source that
+    is already within the limits, the source is kept as the upload instead.
+
+    Parameters:
+        job (tuple): (meme_id, media_path, image_url, upload_dir, max_side, quality, max_bytes).
+
+    Returns:
+        tuple: (meme_id, path, size, source_size, error, permanent) where path is None if the image could not be
+            normalized, and permanent is False for download errors that are worth retrying on a later run.
+    """
+    meme_id, media_path, image_url, upload_dir, max_side, quality, max_bytes = job
+    try:
+        if media_path and os.path.exists(media_path):
+            with open(media_path, 'rb') as f:
+                source = f.read()
+        else:
+            if not image_url.startswith('http'):
+                image_url = 'http://' + image_url
+            response = requests.get(image_url, timeout=30)
+            response.raise_for_status()
+            source = response.content
+            media_path = None
+    except Exception as e:
+        return meme_id, None, None, None, str(e), False
+
+    try:
+        data = normalize_image(BytesIO(source), max_side, quality, max_bytes)
+        keep = len(data) >= len(source) and _within_limits(BytesIO(source), max_side, max_bytes, len(source))
+        if keep and media_path is None:
+            with Image.open(BytesIO(source)) as img:
+                extension = (img.format or 'img').lower().replace('jpeg', 'jpg')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Image.open raises UnidentifiedImageError, an OSError, for data that is not an image
+        return meme_id, None, None, None, str(e), True
+
+    try:
+        if keep:
+            path = media_path or _store_upload(upload_dir, source, extension)
+            return meme_id, path, len(source), len(source), None, False
+        return meme_id, _store_upload(upload_dir, data, 'jpg'), len(data), len(source), None, False
+    except Exception as e:
+        return meme_id, None, None, None, str(e), False
+
+
+# ============================
+# Function: normalize_media
+# ============================
+@instrument
+def normalize_media(database_name, workers=None, limit=200, max_side=MAX_SIDE, quality=JPEG_QUALITY,
+                    max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Normalize the images of unposted memes for upload, see normalize_image, in worker processes so the work never
+    competes with the ingest event loop. Each result is recorded in the upload_path and upload_size columns and is
+    uploaded by post_to_facebook instead of the original. Images that are already within the limits and would not
+    shrink are kept as they are. Memes whose image cannot be decoded are marked with an upload_size of 0 and are not
+    tried again, download errors are retried on the next run.
+
+    Workers are started with the spawn method, so they do not inherit the locks of the daemon's threads.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        workers (int): Number of worker processes. Defaults to the CPU count.
+        limit (int): Memes normalized per call, newest first. If None every pending meme is normalized.
+        max_side (int): Longest side in pixels of a normalized image.
+        quality (int): JPEG quality of the first encode.
+        max_bytes (int): Largest size in bytes of a normalized image.
+
+    Returns:
+        dict: normalized, kept, failed and deferred counts, bytes_in and bytes_out of the prepared images and elapsed
+            seconds.
+    """
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering normalize_media function', 'normalize_media')
+
+    start = time.perf_counter()
+    report = {'normalized': 0, 'kept': 0, 'failed': 0, 'deferred': 0, 'bytes_in': 0, 'bytes_out': 0}
+    upload_dir = get_upload_dir(database_name)
+
+    try:
+        conn = get_connection(database_name)
+        rows = conn.execute('SELECT id, media_path, image_link FROM memes WHERE posted = 0 AND upload_size IS NULL '
+                            'ORDER BY indexed_time DESC LIMIT ?', (-1 if limit is None else limit,)).fetchall()
+    except Exception as e:
+
+        # Add a log entry for errors
+        log_to_database(database_name, 'ERROR', f'Error in normalize_media: {str(e)}', 'normalize_media')
+        rows = []
+
+    if rows:
+        os.makedirs(upload_dir, exist_ok=True)
+        jobs = [(meme_id, media_path, image_link, upload_dir, max_side, quality, max_bytes)
+                for meme_id, media_path, image_link in rows]
+        updates = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for meme_id, path, size, source_size, error, permanent in executor.map(_normalize_meme, jobs,
+                                                                                    chunksize=4):
+                if path is None:
+                    if permanent:
+                        report['failed'] += 1
+                        updates.append((None, 0, meme_id))
+                    else:
+                        report['deferred'] += 1
+                    log_to_database(database_name, 'WARNING', f'Could not normalize meme {meme_id}: {error}',
+                                    'normalize_media')
+                    continue
+                report['kept' if size == source_size else 'normalized'] += 1
+                report['bytes_in'] += source_size
+                report['bytes_out'] += size
+                updates.append((path, size, meme_id))
+
+        try:
+            with conn:
+                conn.executemany('UPDATE memes SET upload_path = ?, upload_size = ? WHERE id = ?', updates)
+        except Exception as e:
+
+            # Add a log entry for errors
+            log_to_database(database_name, 'ERROR', f'Error in normalize_media: {str(e)}', 'normalize_media')
+        inc('upload_bytes_saved_total', report['bytes_in'] - report['bytes_out'])
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    log_to_database(database_name, 'INFO', f'Normalized media: {report}', 'normalize_media')
+
+    # Add a log entry for function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting normalize_media function', 'normalize_media')
+
+    return report
@@ -0,0 +1,252 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+from .dbapp import create_tables, log_to_database
+from .dbconn import get_connection
+
+# Bits in a difference hash
+HASH_BITS = 64
+
+# Images within this many differing bits of a stored image are treated as the same meme
+DEFAULT_MAX_DISTANCE = 4
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+# ============================
+# Function: dhash
+# ============================
+def dhash(image):
+    """
+    Compute the 64-bit difference hash of an image: the image is shrunk to 9x8 grayscale and each bit records whether
+    a pixel is brighter than its right-hand neighbour. Re-encoding, resizing and small edits change only a few bits.
+
+    Parameters:
+        image (str | file): Path or file object of the image.
+
+    Returns:
+        int: The hash as an unsigned 64-bit integer.
+    """
+    with Image.open(image) as img:
+        pixels = list(img.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+# ============================
+# Class: MultiIndexHash
+# ============================
+class MultiIndexHash:
+    """
+    In-memory multi-index hash table for Hamming-distance lookups. Each hash is split into max_distance + 1 chunks
+    and indexed under every chunk. Two hashes within max_distance bits must agree exactly on at least one chunk, so a
+    lookup only compares against the few hashes sharing a chunk instead of every stored hash.
+
+    Parameters:
+        max_distance (int): Largest Hamming distance reported as a match.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        width = HASH_BITS // chunks
+        self._spans = [(i * width, HASH_BITS - i * width if i == chunks - 1 else width) for i in range(chunks)]
+        self._tables = [{} for _ in self._spans]
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _chunks(self, value):
+        return [(value >> shift) & ((1 << width) - 1) for shift, width in self._spans]
+
+    def add(self, meme_id, value):
+        """
+        Index a hash. Adding the same meme_id again with the same hash does nothing.
+
+        Parameters:
+            meme_id (str): The memes row id.
+            value (int): The image hash.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if self._ids.get(meme_id) == value:
+                return
+            self._ids[meme_id] = value
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                table.setdefault(chunk, []).append(meme_id)
+
+    def find(self, value):
+        """
+        Find the closest indexed hash within max_distance.
+
+        Parameters:
+            value (int): The image hash to look up.
+
+        Returns:
+            tuple: (meme_id, distance) of the closest match, or None if nothing is within max_distance.
+        """
+        best = None
+        with self._lock:
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                for meme_id in table.get(chunk, ()):
+                    distance = bin(self._ids[meme_id] ^ value).count('1')
+                    if distance <= self.max_distance and (best is None or distance < best[1]):
+                        best = (meme_id, distance)
+        return best
+
+
+# ============================
+# Function: get_meme_index
+# ============================
+def get_meme_index(database_name, max_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Return the duplicate index for a database, loading the stored hashes from the meme_hashes table on first use.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        max_distance (int): Largest Hamming distance treated as a duplicate when the index is first built.
+
+    Returns:
+        MultiIndexHash: The in-memory index.
+    """
+    index = _indexes.get(database_name)
+    if index is not None:
+        return index
+
+    with _indexes_lock:
+        index = _indexes.get(database_name)
+        if index is None:
+            conn = get_connection(database_name)
+            index = MultiIndexHash(max_distance)
+            for meme_id, phash in conn.execute('SELECT meme_id, phash FROM meme_hashes'):
+                index.add(meme_id, int(phash, 16))
+            _indexes[database_name] = index
+    return index
+
+
+# ============================
+# Function: store_hashes
+# ============================
+def store_hashes(database_name, hashes):
+    """
+    Persist image hashes and add them to the in-memory index.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        hashes (list): (meme_id, hash) pairs.
+
+    Returns:
+        None
+    """
+    index = get_meme_index(database_name)
+    now = int(time.time())
+    conn = get_connection(database_name)
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO meme_hashes (meme_id, phash, indexed_time) VALUES (?, ?, ?)',
+                         [(meme_id, f'{value:016x}', now) for meme_id, value in hashes])
+    for meme_id, value in hashes:
+        index.add(meme_id, value)
+
+
+# ============================
+# Function: _hash_meme
+# ============================
+def _hash_meme(job):
+    """
+    Hash one meme in a worker process, from its cached file when available or else by downloading its url.
+
+    Parameters:
+        job (tuple): (meme_id, media_path, image_url).
+
+    Returns:
+        tuple: (meme_id, hash, error) where hash is None if the image could not be read.
+    """
+    meme_id, media_path, image_url = job
+    try:
+        if media_path and os.path.exists(media_path):
+            return meme_id, dhash(media_path), None
+
+        if not image_url.startswith('http'):
+            image_url = 'http://' + image_url
+        response = requests.get(image_url, timeout=30)
+        response.raise_for_status()
+        return meme_id, dhash(BytesIO(response.content)), None
+    except Exception as e:
+        return meme_id, None, str(e)
+
+
+# ============================
+# Function: backfill_hashes
+# ============================
+def backfill_hashes(database_name, workers=None, chunk_size=500):
+    """
+    Hash every meme that is not yet in meme_hashes, in parallel worker processes.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        workers (int): Number of worker processes. Defaults to the CPU count.
+        chunk_size (int): Hashes written per transaction.
+
+    Returns:
+        dict: hashed and failed counts and elapsed seconds.
+    """
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering backfill_hashes function', 'backfill_hashes')
+
+    start = time.perf_counter()
+    get_meme_index(database_name)
+    conn = get_connection(database_name)
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(memes)')}
+    media_column = 'm.media_path' if 'media_path' in columns else 'NULL'
+    jobs = conn.execute(f'SELECT m.id, {media_column}, m.image_link FROM memes m '
+                        f'LEFT JOIN meme_hashes h ON h.meme_id = m.id WHERE h.meme_id IS NULL').fetchall()
+
+    report = {'hashed': 0, 'failed': 0}
+    pending = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for meme_id, value, error in executor.map(_hash_meme, jobs, chunksize=16):
+            if value is None:
+                report['failed'] += 1
+                log_to_database(database_name, 'WARNING', f'Could not hash meme {meme_id}: {error}', 'backfill_hashes')
+                continue
+            pending.append((meme_id, value))
+            if len(pending) >= chunk_size:
+                store_hashes(database_name, pending)
+                report['hashed'] += len(pending)
+                pending = []
+    if pending:
+        store_hashes(database_name, pending)
+        report['hashed'] += len(pending)
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    log_to_database(database_name, 'INFO', f'Backfilled meme hashes: {report}', 'backfill_hashes')
+
+    # Add a log entry for function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting backfill_hashes function', 'backfill_hashes')
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hash existing memes into the duplicate index.')
+    parser.add_argument('database_name', help='Path to the application db.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes.')
+    args = parser.parse_args()
+    create_tables(args.database_name)
+    print(backfill_hashes(args.database_name, workers=args.workers))
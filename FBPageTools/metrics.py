@@ -0,0 +1,383 @@
+import asyncio
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .dbconn import CONNECTION_HOOKS, get_connection
+
+# Instrumentation is on unless FB_METRICS is set to 0, see set_metrics_enabled
+ENABLED = os.getenv('FB_METRICS', '1') != '0'
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_rolled_up = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+# ============================
+# Function: set_metrics_enabled
+# ============================
+def set_metrics_enabled(enabled):
+    """
+    Turn instrumentation on or off. While off, instrumented functions and timers only pay for one flag check.
+
+    Parameters:
+        enabled (bool): Whether to record metrics.
+
+    Returns:
+        None
+    """
+    global ENABLED
+    ENABLED = enabled
+
+
+# ============================
+# Function: inc
+# ============================
+def inc(name, value=1, **labels):
+    """
+    Add to a counter.
+
+    Parameters:
+        name (str): Metric name, e.g. 'rows_ingested_total'.
+        value (float): Amount to add.
+        **labels: Label values identifying the series.
+
+    Returns:
+        None
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+# ============================
+# Function: observe
+# ============================
+def observe(name, seconds, **labels):
+    """
+    Record a latency in a histogram.
+
+    Parameters:
+        name (str): Metric name, e.g. 'api_call_seconds'.
+        seconds (float): The observed duration.
+        **labels: Label values identifying the series.
+
+    Returns:
+        None
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(LATENCY_BUCKETS), 0, 0.0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += 1
+        histogram[2] += seconds
+
+
+@contextmanager
+def _timer(api, operation):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        inc('api_errors_total', api=api, operation=operation, type=type(e).__name__)
+        raise
+    finally:
+        observe('api_call_seconds', time.perf_counter() - start, api=api, operation=operation)
+        inc('api_calls_total', api=api, operation=operation)
+
+
+@contextmanager
+def _disabled_timer():
+    yield
+
+
+# ============================
+# Function: timed
+# ============================
+def timed(api, operation):
+    """
+    Context manager that records the latency, call count and errors by type of one external call.
+
+    Parameters:
+        api (str): 'graph', 'reddit', 'openai' or 'http'.
+        operation (str): The call made, e.g. 'get_connections'.
+
+    Returns:
+        contextmanager: The timer, or a no-op when instrumentation is off.
+    """
+    if not ENABLED:
+        return _disabled_timer()
+    return _timer(api, operation)
+
+
+# ============================
+# Function: instrument
+# ============================
+def instrument(func):
+    """
+    Decorator recording the latency, call count and escaping errors by type of a function or coroutine.
+
+    Parameters:
+        func (callable): The function to wrap.
+
+    Returns:
+        callable: The wrapped function.
+    """
+    name = func.__name__
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not ENABLED:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                inc('function_errors_total', function=name, type=type(e).__name__)
+                raise
+            finally:
+                observe('function_seconds', time.perf_counter() - start, function=name)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            inc('function_errors_total', function=name, type=type(e).__name__)
+            raise
+        finally:
+            observe('function_seconds', time.perf_counter() - start, function=name)
+    return wrapper
+
+
+# ============================
+# Function: count_sqlite_statements
+# ============================
+def count_sqlite_statements(conn):
+    """
+    Connection hook that counts SQLite statements by verb. It is registered in dbconn.CONNECTION_HOOKS on import and
+    only installs a trace callback on connections opened while instrumentation is on.
+
+    Parameters:
+        conn (sqlite3.Connection): A newly opened connection.
+
+    Returns:
+        None
+    """
+    if not ENABLED:
+        return
+
+    def trace(statement):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        inc('sqlite_statements_total', verb=verb)
+
+    conn.set_trace_callback(trace)
+
+
+CONNECTION_HOOKS.append(count_sqlite_statements)
+
+
+# ============================
+# Function: snapshot
+# ============================
+def snapshot():
+    """
+    Return a copy of every series.
+
+    Returns:
+        tuple: (counters, histograms) dicts keyed by (name, labels).
+    """
+    with _lock:
+        return dict(_counters), {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+
+
+# ============================
+# Function: reset_metrics
+# ============================
+def reset_metrics():
+    """
+    Clear every series.
+
+    Returns:
+        None
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _rolled_up.clear()
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"'.replace('\n', ' ') for k, v in pairs) + '}'
+
+
+# ============================
+# Function: render_prometheus
+# ============================
+def render_prometheus():
+    """
+    Render every series in the Prometheus text exposition format.
+
+    Returns:
+        str: The exposition text.
+    """
+    counters, histograms = snapshot()
+    lines = []
+    for name in sorted({key[0] for key in counters}):
+        lines.append(f'# TYPE fbpagetools_{name} counter')
+        for (series, labels), value in sorted(counters.items()):
+            if series == name:
+                lines.append(f'fbpagetools_{name}{_labels(labels)} {value}')
+
+    for name in sorted({key[0] for key in histograms}):
+        lines.append(f'# TYPE fbpagetools_{name} histogram')
+        for (series, labels), (buckets, count, total) in sorted(histograms.items()):
+            if series != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'fbpagetools_{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'fbpagetools_{name}_bucket{_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'fbpagetools_{name}_sum{_labels(labels)} {total}')
+            lines.append(f'fbpagetools_{name}_count{_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+# ============================
+# Function: write_prometheus
+# ============================
+def write_prometheus(path):
+    """
+    Write the metrics to a Prometheus text file, e.g. for the node_exporter textfile collector. The file is replaced
+    atomically so a scrape never sees a partial file.
+
+    Parameters:
+        path (str): Destination .prom file.
+
+    Returns:
+        None
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(render_prometheus())
+    os.replace(temp_path, path)
+
+
+# ============================
+# Function: rollup_to_database
+# ============================
+def rollup_to_database(database_name):
+    """
+    Store what changed since the previous rollup in the metrics_rollup table, one row per series.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        int: Number of rows written.
+    """
+    counters, histograms = snapshot()
+    period_end = int(time.time())
+    rows = []
+    with _lock:
+        for (name, labels), value in counters.items():
+            previous = _rolled_up.get(('c', name, labels), 0)
+            if value != previous:
+                rows.append((period_end, name, _labels(labels), value - previous, None))
+            _rolled_up[('c', name, labels)] = value
+        for (name, labels), (_, count, total) in histograms.items():
+            previous_count, previous_total = _rolled_up.get(('h', name, labels), (0, 0.0))
+            if count != previous_count:
+                rows.append((period_end, name, _labels(labels), count - previous_count, total - previous_total))
+            _rolled_up[('h', name, labels)] = (count, total)
+
+    if rows:
+        conn = get_connection(database_name)
+        with conn:
+            conn.executemany('INSERT INTO metrics_rollup (period_end, name, labels, count, sum) VALUES (?, ?, ?, ?, ?)',
+                             rows)
+    return len(rows)
+
+
+# ============================
+# Function: monitor_event_loop_lag
+# ============================
+async def monitor_event_loop_lag(interval=0.25):
+    """
+    Measure how late the event loop wakes up a sleeping task and record it in the event_loop_lag_seconds histogram.
+    A blocking call on the loop thread shows up as lag of roughly its duration. Runs until cancelled.
+
+    Parameters:
+        interval (float): Seconds between probes.
+
+    Returns:
+        None
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        observe('event_loop_lag_seconds', max(0.0, loop.time() - expected))
+
+
+# ============================
+# Function: start_metrics_exporter
+# ============================
+def start_metrics_exporter(database_name=None, prometheus_path=None, interval=60):
+    """
+    Export metrics periodically from a daemon thread.
+
+    Parameters:
+        database_name (str): Write rollups to this db. If None no rollups are written.
+        prometheus_path (str): Rewrite this Prometheus text file. If None no file is written.
+        interval (float): Seconds between exports.
+
+    Returns:
+        threading.Event: Set it to stop the exporter after its next export.
+    """
+    stop = threading.Event()
+
+    def run():
+        while True:
+            stopped = stop.wait(interval)
+            try:
+                if prometheus_path:
+                    write_prometheus(prometheus_path)
+                if database_name:
+                    rollup_to_database(database_name)
+            except Exception as e:
+                print(f'Error exporting metrics: {str(e)}')
+            if stopped:
+                return
+
+    threading.Thread(target=run, name='metrics-exporter', daemon=True).start()
+    return stop
@@ -0,0 +1,356 @@
+import time
+
+from .commands import classify_comment
+from .dbconn import get_connection
+from .mediacache import MEDIA_COLUMNS, UPLOAD_COLUMNS
+
+
+# ============================
+# Function: _columns
+# ============================
+def _columns(conn, table):
+    """
+    Return the column names of a table, or an empty set if it does not exist.
+    """
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+# ============================
+# Function: _create_base_tables
+# ============================
+def _create_base_tables(conn):
+    """
+    Version 1: the quotes, fb_posts, fb_comments, fb_comment_sync and fb_reply_queue tables, and the unique
+    (comment_id, message) key on fb_comments. Duplicate comments left by older versions are removed first, keeping
+    the earliest copy.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS "quotes" (
+        "author"	TEXT,
+        "quote"	TEXT,
+        "postedOn"	INTEGER,
+        "posted"	INTEGER DEFAULT 0
+    )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS "fb_posts" (
+        "post_id"	TEXT,
+        "message"	TEXT,
+        "created_time"	INTEGER,
+        "indexed_time"	INTEGER,
+        PRIMARY KEY("post_id")
+    )''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "fb_comments" (
+        "comment_id"	TEXT,
+        "post_id"	TEXT,
+        "message"	TEXT,
+        "created_time"	INTEGER,
+        "indexed_time"	INTEGER,
+        "openai_text"	TEXT,
+        "postedOn"	INTEGER,
+        "completed"	INTEGER DEFAULT 0
+    )''')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                    "AND name = 'ux_fb_comments_comment_message'").fetchone() is None:
+        conn.execute('DELETE FROM fb_comments WHERE rowid NOT IN '
+                     '(SELECT MIN(rowid) FROM fb_comments GROUP BY comment_id, message)')
+        conn.execute('CREATE UNIQUE INDEX ux_fb_comments_comment_message ON fb_comments (comment_id, message)')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "fb_comment_sync" (
+        "post_id"	TEXT,
+        "last_comment_time"	INTEGER,
+        "last_checked"	INTEGER,
+        "last_activity"	INTEGER,
+        PRIMARY KEY("post_id")
+    )''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "fb_reply_queue" (
+        "comment_id"	TEXT,
+        "message"	TEXT,
+        "status"	TEXT DEFAULT 'pending',
+        "attempts"	INTEGER DEFAULT 0,
+        "next_attempt_at"	INTEGER DEFAULT 0,
+        "claimed_at"	INTEGER,
+        "updated_at"	INTEGER,
+        "error"	TEXT,
+        PRIMARY KEY("comment_id", "message")
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_fb_reply_queue_status ON fb_reply_queue (status, next_attempt_at)')
+
+
+# ============================
+# Function: _create_memes
+# ============================
+def _create_memes(conn):
+    """
+    Version 2: the memes table written by the Reddit ingester, including the media cache columns. Databases that
+    already have a memes table only get the columns they are missing.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS memes
+                    (id TEXT PRIMARY KEY,
+                    permalink TEXT,
+                    title TEXT,
+                    author TEXT,
+                    ups INTEGER,
+                    created_utc INTEGER,
+                    image_link TEXT,
+                    indexed_time INTEGER,
+                    posted INTEGER,
+                    postedOn INTEGER,
+                    media_path TEXT,
+                    media_size INTEGER,
+                    media_hash TEXT)''')
+    existing = _columns(conn, 'memes')
+    for name, column_type in MEDIA_COLUMNS:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE memes ADD COLUMN {name} {column_type}')
+
+
+# ============================
+# Function: _create_hot_indexes
+# ============================
+def _create_hot_indexes(conn):
+    """
+    Version 3: indexes for the most frequent queries.
+
+    The completed index also holds comment_id and message, so the reply queries are answered from the index alone.
+    Lookups by comment_id use the leading column of ux_fb_comments_comment_message, so they need no index of their
+    own. The partial indexes only hold unposted rows, which is what the content pickers search.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_fb_comments_completed ON fb_comments (completed, comment_id, message)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_fb_comments_post_id ON fb_comments (post_id, created_time)')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_memes_unposted ON memes (posted) WHERE posted = 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_quotes_unposted ON quotes (posted) WHERE posted = 0')
+
+
+# ============================
+# Function: _classify_comments
+# ============================
+def _classify_comments(conn):
+    """
+    Version 4: store each comment's command type and prompt, classified once instead of on every reply run, and
+    keep pending commands in fb_reply_queue. Existing comments and queue rows are classified here, unanswered
+    commands are queued, and a trigger queues every command inserted from now on.
+    """
+    for table in ('fb_comments', 'fb_reply_queue'):
+        existing = _columns(conn, table)
+        for name in ('command', 'prompt'):
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} TEXT')
+
+        rows = conn.execute(f'SELECT rowid, message FROM {table} WHERE command IS NULL').fetchall()
+        conn.executemany(f'UPDATE {table} SET command = ?, prompt = ? WHERE rowid = ?',
+                         [classify_comment(message) + (rowid,) for rowid, message in rows])
+
+    conn.execute('INSERT OR IGNORE INTO fb_reply_queue (comment_id, message, command, prompt, status, next_attempt_at) '
+                 'SELECT comment_id, message, command, prompt, \'pending\', 0 FROM fb_comments '
+                 'WHERE completed = 0 AND command != \'none\'')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS tr_fb_comments_enqueue AFTER INSERT ON fb_comments
+        WHEN NEW.completed = 0 AND NEW.command != 'none'
+        BEGIN
+            INSERT OR IGNORE INTO fb_reply_queue (comment_id, message, command, prompt, status, next_attempt_at)
+            VALUES (NEW.comment_id, NEW.message, NEW.command, NEW.prompt, 'pending', 0);
+        END''')
+
+
+# ============================
+# Function: _create_post_deletions
+# ============================
+def _create_post_deletions(conn):
+    """
+    Version 5: the fb_post_deletions checkpoint of bulk post deletions. Each candidate post is stored with the
+    pattern that matched it and moves from pending to deleted or failed, so an interrupted run resumes where it
+    stopped.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "fb_post_deletions" (
+        "post_id"	TEXT,
+        "message"	TEXT,
+        "pattern"	TEXT,
+        "status"	TEXT DEFAULT 'pending',
+        "attempts"	INTEGER DEFAULT 0,
+        "updated_at"	INTEGER,
+        "error"	TEXT,
+        PRIMARY KEY("post_id")
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_fb_post_deletions_pattern ON fb_post_deletions (pattern, status)')
+
+
+# ============================
+# Function: _add_upload_columns
+# ============================
+def _add_upload_columns(conn):
+    """
+    Version 6: the upload_path and upload_size columns of memes, which record the normalized copy of each image
+    that is uploaded in place of the original.
+    """
+    existing = _columns(conn, 'memes')
+    for name, column_type in UPLOAD_COLUMNS:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE memes ADD COLUMN {name} {column_type}')
+
+
+# ============================
+# Function: _create_support_tables
+# ============================
+def _create_support_tables(conn):
+    """
+    Version 7: the tables that older versions created on first use. meme_hashes holds the perceptual hash of each
+    meme, openai_cache the cached OpenAI responses, pick_queue the pre-shuffled queues of the weighted content
+    pickers and metrics_rollup the periodic metrics rollups.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "meme_hashes" (
+        "meme_id"	TEXT,
+        "phash"	TEXT,
+        "indexed_time"	INTEGER,
+        PRIMARY KEY("meme_id")
+    )''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "openai_cache" (
+        "key"	TEXT,
+        "kind"	TEXT,
+        "model"	TEXT,
+        "prompt"	TEXT,
+        "response"	TEXT,
+        "latency"	REAL,
+        "created_at"	INTEGER,
+        "last_used"	INTEGER,
+        "hits"	INTEGER DEFAULT 0,
+        PRIMARY KEY("key")
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS ix_openai_cache_last_used ON openai_cache (last_used)')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "pick_queue" (
+        "source"	TEXT,
+        "strategy"	TEXT,
+        "sort_key"	REAL,
+        "row_id"	INTEGER,
+        PRIMARY KEY("source", "strategy", "sort_key", "row_id")
+    ) WITHOUT ROWID''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "metrics_rollup" (
+        "period_end"	INTEGER,
+        "name"	TEXT,
+        "labels"	TEXT,
+        "count"	REAL,
+        "sum"	REAL
+    )''')
+
+
+# ============================
+# Function: _create_pick_queue_state
+# ============================
+def _create_pick_queue_state(conn):
+    """
+    Version 8: pick_queue_state, when each weighted pick queue was filled and the largest rowid it covers, so the
+    pickers can tell when a queue is missing newer rows.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS "pick_queue_state" (
+        "source"	TEXT,
+        "strategy"	TEXT,
+        "filled_at"	INTEGER,
+        "max_row_id"	INTEGER,
+        PRIMARY KEY("source", "strategy")
+    )''')
+
+
+# ============================
+# Function: _reset_pick_queues
+# ============================
+def _reset_pick_queues(conn):
+    """
+    Version 9: empty the weighted pick queues, whose keys are now computed in log space, so keys from before and
+    after the change are never compared. The pickers rebuild each queue on the next pick.
+    """
+    conn.execute('DELETE FROM pick_queue')
+    conn.execute('DELETE FROM pick_queue_state')
+
+
+# Ordered (version, name, function) migrations. Every function must be safe to run again on a database it already
+# upgraded, and must not rebuild tables, so upgrades can run while other processes use the database.
+MIGRATIONS = [
+    (1, 'base tables', _create_base_tables),
+    (2, 'memes table', _create_memes),
+    (3, 'hot query indexes', _create_hot_indexes),
+    (4, 'comment commands and reply queue', _classify_comments),
+    (5, 'post deletion checkpoint', _create_post_deletions),
+    (6, 'normalized upload columns', _add_upload_columns),
+    (7, 'hash, cache, pick queue and metrics tables', _create_support_tables),
+    (8, 'pick queue state', _create_pick_queue_state),
+    (9, 'log space pick queue keys', _reset_pick_queues),
+]
+
+
+# ============================
+# Function: get_schema_version
+# ============================
+def get_schema_version(database_name):
+    """
+    Return the highest migration version applied to a database.
+
+    Parameters:
+        database_name (str): Path to the application db.
+
+    Returns:
+        int: The schema version, 0 for a database that was never migrated.
+    """
+    conn = get_connection(database_name)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'").fetchone() is None:
+        return 0
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+# ============================
+# Function: migrate
+# ============================
+def migrate(database_name, target=None):
+    """
+    Apply pending migrations in order, each in its own write transaction. The version is re-read inside the
+    transaction, so processes starting at the same time apply each migration once. Migrations only add tables,
+    columns and indexes, and readers keep working during an upgrade because the database is in WAL mode.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        target (int): Stop after this version. If None every migration is applied.
+
+    Returns:
+        list: Versions applied by this call.
+    """
+    conn = get_connection(database_name)
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS "schema_version" (
+                "version"	INTEGER,
+                "name"	TEXT,
+                "applied_at"	INTEGER,
+                PRIMARY KEY("version")
+            )''')
+
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+            if version <= current:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                         (version, name, int(time.time())))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+
+    # Refresh the planner statistics for any new indexes
+    if applied:
+        conn.execute('PRAGMA optimize')
+    return applied
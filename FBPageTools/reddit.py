@@ -1,101 +1,403 @@
 import asyncio
+import contextlib
 import imghdr
-import sqlite3
+import random
 import time
 
 import aiohttp
 import asyncpraw
 
+from .asyncdb import AsyncDatabase
 from .dbapp import log_to_database
+from .mediacache import SNIFF_BYTES, discard_media, fetch_to_cache, get_media_dir
+from .memeindex import MultiIndexHash, dhash, get_meme_index
+from .metrics import inc, instrument, timed
+
+
+# ============================
+# Function: sniff_image
+# ============================
+@instrument
+async def sniff_image(session, semaphore, url, sniff_bytes=SNIFF_BYTES):
+    """
+    Detect the image format of a url from its first bytes only. A Range request is sent, and the body is read no
+    further than sniff_bytes in case the host ignores the range and returns the whole file.
+
+    Parameters:
+        session (aiohttp.ClientSession): The shared HTTP session.
+        semaphore (asyncio.Semaphore): Bounds the number of downloads in flight.
+        url (str): The image url.
+        sniff_bytes (int): Number of leading bytes to fetch.
+
+    Returns:
+        tuple: (image_type, bytes_read) where image_type is the imghdr format name, or None if not recognised.
+    """
+    async with semaphore:
+        async with session.get(url, headers={'Range': f'bytes=0-{sniff_bytes - 1}'}) as response:
+            response.raise_for_status()
+            head = b''
+            while len(head) < sniff_bytes:
+                chunk = await response.content.read(sniff_bytes - len(head))
+                if not chunk:
+                    break
+                head += chunk
+
+    return imghdr.what(None, h=head), len(head)
 
 
 # ============================
 # Function: process_subreddit
 # ============================
-async def process_subreddit(database_name, subreddit_name, reddit_user_agent, reddit_client_id, reddit_client_secret):
+@instrument
+async def process_subreddit(database_name, subreddit_name, reddit_user_agent, reddit_client_id, reddit_client_secret,
+                            session=None, concurrency=8, reddit=None, cache_media=True, dedupe=True, db=None):
     """
         Check sub reddit for new posts and indexes them into a db if they meet filtered
         requirements.
 
+        Posts already stored in the memes table are skipped before any request is made. The remaining candidates
+        are checked concurrently over one HTTP session. With cache_media each image is streamed once into the media
+        cache, abandoning the download as soon as the first bytes show it is not an image, and the cached path is
+        recorded on the memes row for the poster. Without it only the first bytes of each image are fetched.
+        Cached images are perceptually hashed, and near-duplicates of memes already stored are rejected. Cached
+        images of memes that are rejected or not stored are deleted again.
+        Database reads and writes go through an AsyncDatabase, so they never block the event loop.
+
         Parameters:
             database_name (str): Path to the application db.
             subreddit_name (str): Iterated subreddit name
             reddit_user_agent (str): UserAgent info to report back to reddit api.
             reddit_client_id (str): Reddit API application ID.
             reddit_client_secret (str): Reddit API Access Key
+            session (aiohttp.ClientSession): Shared HTTP session for image checks. If None one is opened for the call.
+            concurrency (int): Maximum number of image checks in flight.
+            reddit (asyncpraw.Reddit): Shared authenticated client. If None a client is opened for the call.
+            cache_media (bool): Store accepted images in the media cache directory.
+            dedupe (bool): Reject near-duplicate images, needs cache_media.
+            db (AsyncDatabase): Shared open async database. If None one is opened for the call.
         Returns:
             None
         """
 
+    # Open a client for this call only when no shared client was given
+    if reddit is None:
+        async with asyncpraw.Reddit(user_agent=reddit_user_agent,
+                                    client_id=reddit_client_id,
+                                    client_secret=reddit_client_secret) as reddit:
+            return await process_subreddit(database_name, subreddit_name, reddit_user_agent, reddit_client_id,
+                                           reddit_client_secret, session=session, concurrency=concurrency,
+                                           reddit=reddit, cache_media=cache_media, dedupe=dedupe, db=db)
+
+    # Open an async database for this call only when no shared one was given
+    if db is None:
+        async with AsyncDatabase(database_name) as db:
+            return await process_subreddit(database_name, subreddit_name, reddit_user_agent, reddit_client_id,
+                                           reddit_client_secret, session=session, concurrency=concurrency,
+                                           reddit=reddit, cache_media=cache_media, dedupe=dedupe, db=db)
+
     # Add a log entry for function entry
     log_to_database(database_name, 'DEBUG', 'Entering process_subreddit function', 'process_subreddit')
 
-    async with asyncpraw.Reddit(user_agent=reddit_user_agent,
-                                client_id=reddit_client_id,
-                                client_secret=reddit_client_secret) as reddit:
-        try:
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    filtered_posts = []
+    new_hashes = []
+    media = {}
+    bytes_read = 0
+    media_dir = get_media_dir(database_name)
+    try:
+        with timed('reddit', 'top'):
             subreddit = await reddit.subreddit(subreddit_name)
-            top_posts = subreddit.top('day', limit=100)
-
-            # filter posts that meet requirements
-            filtered_posts = []
-            async for post in top_posts:
-                if not post.over_18 and post.score >= 100 and time.time() - post.created_utc <= 86400:
-                    # check if URL ends with a recognized image format
-                    if post.url.endswith(('.jpg', '.jpeg', '.png')):
-                        try:
-                            async with aiohttp.ClientSession() as session:
-                                async with session.get(post.url) as response:
-                                    if imghdr.what(None, h=await response.read()) is not None:
-                                        filtered_posts.append(post)
-                                    else:
-                                        log_to_database(database_name, 'INFO', 'Could not detect image.',
-                                                        'process_subreddit')
-                        except Exception as e:
-                            log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(e)}',
-                                            'process_subreddit')
-                    else:
-                        log_to_database(database_name, 'INFO', f'Post {post.id} is not an image file',
-                                        'process_subreddit')
+            top_posts = [post async for post in subreddit.top('day', limit=100)]
+
+        # filter posts that meet requirements
+        candidates = []
+        for post in top_posts:
+            if not post.over_18 and post.score >= 100 and time.time() - post.created_utc <= 86400:
+                # check if URL ends with a recognized image format
+                if post.url.endswith(('.jpg', '.jpeg', '.png')):
+                    candidates.append(post)
+                else:
+                    log_to_database(database_name, 'INFO', f'Post {post.id} is not an image file',
+                                    'process_subreddit')
+
+        # skip posts that are already stored before making any image requests
+        if candidates:
+            stored = await db.stored_meme_ids([post.id for post in candidates])
+            candidates = [post for post in candidates if post.id not in stored]
+
+        # check the remaining candidates concurrently over one session
+        owns_session = session is None
+        if owns_session:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency))
+        try:
+            semaphore = asyncio.Semaphore(concurrency)
+            if cache_media:
+                checks = [fetch_to_cache(session, semaphore, post.url, media_dir) for post in candidates]
+            else:
+                checks = [sniff_image(session, semaphore, post.url) for post in candidates]
+            results = await asyncio.gather(*checks, return_exceptions=True)
+        finally:
+            if owns_session:
+                await session.close()
+
+        for post, result in zip(candidates, results):
+            if isinstance(result, Exception):
+                log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(result)}',
+                                'process_subreddit')
+                continue
+
+            if cache_media:
+                image_type, path, size, sha256 = result
+                media[post.id] = (path, size, sha256)
+            else:
+                image_type, size = result
+            bytes_read += size
+            if image_type is not None:
+                filtered_posts.append(post)
+            else:
+                log_to_database(database_name, 'INFO', 'Could not detect image.', 'process_subreddit')
+        # reject near duplicates of stored memes, including ones accepted earlier in this run
+        if dedupe and cache_media and filtered_posts:
+            index = await loop.run_in_executor(None, get_meme_index, database_name)
+
+            # memes accepted in this run join the shared index only once they are stored
+            accepted = MultiIndexHash(index.max_distance)
+            hashes = await asyncio.gather(*[loop.run_in_executor(None, dhash, media[post.id][0])
+                                            for post in filtered_posts], return_exceptions=True)
+            unique_posts = []
+            for post, value in zip(filtered_posts, hashes):
+                if isinstance(value, Exception):
+                    log_to_database(database_name, 'WARNING', f'Could not hash post {post.id}: {str(value)}',
+                                    'process_subreddit')
+                    unique_posts.append(post)
+                    continue
+
+                match = index.find(value) or accepted.find(value)
+                if match is not None:
+                    log_to_database(database_name, 'INFO', f'Post {post.id} is a near duplicate of {match[0]} '
+                                                           f'(distance {match[1]})', 'process_subreddit')
+                    continue
+                accepted.add(post.id, value)
+                new_hashes.append((post.id, value))
+                unique_posts.append(post)
+            filtered_posts = unique_posts
+    except Exception as e:
+        log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(e)}', 'process_subreddit')
+        filtered_posts = []
+
+    # save post metadata into a local sqlite db
+    inserted_ids = []
+    try:
+        now = int(time.time())
+
+        # the author of a post is None once the account is deleted
+        inserted_ids = await db.insert_memes([(post.id, 'reddit.com{}'.format(post.permalink), post.title,
+                                               post.author.name if post.author else None, post.ups,
+                                               post.created_utc, post.url, now, 0, None,
+                                               *media.get(post.id, (None, None, None)))
+                                              for post in filtered_posts])
+    except Exception as e:
+        log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(e)}', 'process_subreddit')
+
+    # delete the downloads no stored meme points at
+    paths = [path for path, _, _ in media.values() if path is not None]
+    if paths:
+        try:
+            await loop.run_in_executor(None, discard_media, database_name, paths)
+        except Exception as e:
+            log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(e)}', 'process_subreddit')
+
+    inserted = len(inserted_ids)
+    inc('rows_ingested_total', inserted, table='memes')
+    inc('bytes_downloaded_total', bytes_read, source='process_subreddit')
+
+    # persist the hashes of the memes that were stored
+    stored = set(inserted_ids)
+    new_hashes = [(meme_id, value) for meme_id, value in new_hashes if meme_id in stored]
+    if new_hashes:
+        try:
+            await db.store_meme_hashes(new_hashes)
         except Exception as e:
             log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(e)}', 'process_subreddit')
-            filtered_posts = []
 
-        # save post metadata into a local sqlite db
+    log_to_database(database_name, 'INFO', f'Processed r/{subreddit_name}: {inserted} new posts, '
+                                           f'{bytes_read} image bytes, {time.perf_counter() - start:.2f}s',
+                    'process_subreddit')
+    log_to_database(database_name, 'DEBUG', 'Exiting process_subreddit function', 'process_subreddit')
+
+
+# Subreddits checked by main_loop_reddit and run_reddit_scheduler when no list is given
+DEFAULT_SUBREDDITS = ['meme', 'me_irl', 'funny', 'ProgrammerHumor', 'starterpacks']
 
-        conn = sqlite3.connect(database_name)
-        c = conn.cursor()
 
-        for post in filtered_posts:
-            try:
-                c.execute("INSERT OR IGNORE INTO memes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                          (
-                              post.id,
-                              'reddit.com{}'.format(post.permalink),
-                              post.title,
-                              post.author.name,
-                              post.ups,
-                              post.created_utc,
-                              post.url,
-                              int(time.time()),
-                              0,
-                              None)),
+# ============================
+# Function: wait_for_rate_limit
+# ============================
+@instrument
+async def wait_for_rate_limit(reddit, min_remaining=10):
+    """
+    Sleep without blocking the event loop until Reddit's rate-limit window resets, if fewer than min_remaining
+    requests are left in it. The figures come from the X-Ratelimit headers asyncpraw records on every response.
 
+    Parameters:
+        reddit (asyncpraw.Reddit): The shared authenticated client.
+        min_remaining (int): Requests that must be left in the window before a subreddit run starts.
 
-            except Exception as e:
-                log_to_database(database_name, 'ERROR', f'Error in process_subreddit: {str(e)}', 'process_subreddit')
+    Returns:
+        float: Seconds slept.
+    """
+    limits = reddit.auth.limits
+    remaining, reset_timestamp = limits.get('remaining'), limits.get('reset_timestamp')
+    if remaining is None or reset_timestamp is None or remaining >= min_remaining:
+        return 0.0
 
-        conn.commit()
-        conn.close()
-        log_to_database(database_name, 'DEBUG', 'Exiting process_subreddit function', 'process_subreddit')
+    delay = max(0.0, reset_timestamp - time.time())
+    await asyncio.sleep(delay)
+    return delay
+
+
+# ============================
+# Function: _schedule_subreddit
+# ============================
+async def _schedule_subreddit(database_name, subreddit_name, interval, jitter, reddit, session, db):
+    """
+    Run process_subreddit for one subreddit forever, sleeping interval seconds plus or minus jitter between runs.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        subreddit_name (str): The subreddit to ingest.
+        interval (float): Seconds between runs.
+        jitter (float): Fraction of interval to randomise each sleep by.
+        reddit (asyncpraw.Reddit): The shared authenticated client.
+        session (aiohttp.ClientSession): The shared HTTP session for image checks.
+        db (AsyncDatabase): The shared async database.
+
+    Returns:
+        None
+    """
+    while True:
+        try:
+            waited = await wait_for_rate_limit(reddit)
+            if waited:
+                log_to_database(database_name, 'INFO', f'Waited {waited:.0f}s for Reddit rate limit',
+                                'run_reddit_scheduler')
+            await process_subreddit(database_name, subreddit_name, None, None, None, session=session, reddit=reddit,
+                                    db=db)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_to_database(database_name, 'ERROR', f'Error in run_reddit_scheduler: {str(e)}', 'run_reddit_scheduler')
+
+        await asyncio.sleep(interval * random.uniform(1 - jitter, 1 + jitter))
+
+
+# ============================
+# Function: run_reddit_scheduler
+# ============================
+@instrument
+async def run_reddit_scheduler(database_name, reddit_user_agent, reddit_client_id, reddit_client_secret,
+                               subreddits=None, interval=21600, jitter=0.1, reddit=None, session=None):
+    """
+    Ingest every subreddit on its own schedule with one authenticated asyncpraw client, one HTTP session and one
+    async database connection. Each subreddit runs as its own task and sleeps with asyncio.sleep, so the scheduler
+    can share an event loop with other async jobs. Runs until cancelled.
+
+    Schedulers of several databases can share the client and the session by passing them in, see
+    tenants.run_shared_reddit_ingest. They are then left open on exit.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        reddit_user_agent (str): UserAgent info to report back to reddit api.
+        reddit_client_id (str): Reddit API application ID.
+        reddit_client_secret (str): Reddit API Access Key
+        subreddits (list | dict): Subreddit names, or a dict of subreddit name to interval in seconds. Defaults to
+            DEFAULT_SUBREDDITS.
+        interval (float): Seconds between runs for subreddits without their own interval.
+        jitter (float): Fraction of the interval each sleep is randomised by, so runs do not line up.
+        reddit (asyncpraw.Reddit): A shared authenticated client. If None one is created from the credentials.
+        session (aiohttp.ClientSession): A shared HTTP session for image checks. If None one is created.
+
+    Returns:
+        None
+    """
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering run_reddit_scheduler function', 'run_reddit_scheduler')
+
+    if subreddits is None:
+        subreddits = DEFAULT_SUBREDDITS
+    if not isinstance(subreddits, dict):
+        subreddits = {subreddit_name: interval for subreddit_name in subreddits}
+
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            if reddit is None:
+                reddit = await stack.enter_async_context(asyncpraw.Reddit(user_agent=reddit_user_agent,
+                                                                          client_id=reddit_client_id,
+                                                                          client_secret=reddit_client_secret))
+            if session is None:
+                session = await stack.enter_async_context(
+                    aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16)))
+            db = await stack.enter_async_context(AsyncDatabase(database_name))
+            await asyncio.gather(*[
+                _schedule_subreddit(database_name, subreddit_name, subreddit_interval, jitter, reddit, session, db)
+                for subreddit_name, subreddit_interval in subreddits.items()])
+    finally:
+        # Add a log entry for function exit
+        log_to_database(database_name, 'DEBUG', 'Exiting run_reddit_scheduler function', 'run_reddit_scheduler')
+
+
+# ============================
+# Function: ingest_subreddits
+# ============================
+@instrument
+async def ingest_subreddits(database_name, reddit_user_agent, reddit_client_id, reddit_client_secret,
+                            subreddits=None):
+    """
+    Ingest every subreddit once with one authenticated asyncpraw client, one HTTP session and one async database
+    connection, for runs from cron instead of the scheduler.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        reddit_user_agent (str): UserAgent info to report back to reddit api.
+        reddit_client_id (str): Reddit API application ID.
+        reddit_client_secret (str): Reddit API Access Key
+        subreddits (list): Subreddit names. Defaults to DEFAULT_SUBREDDITS.
+
+    Returns:
+        None
+    """
+    # Add a log entry for function entry
+    log_to_database(database_name, 'DEBUG', 'Entering ingest_subreddits function', 'ingest_subreddits')
+
+    async with asyncpraw.Reddit(user_agent=reddit_user_agent,
+                                client_id=reddit_client_id,
+                                client_secret=reddit_client_secret) as reddit:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16)) as session, \
+                AsyncDatabase(database_name) as db:
+            for subreddit_name in subreddits or DEFAULT_SUBREDDITS:
+                try:
+                    await wait_for_rate_limit(reddit)
+                    await process_subreddit(database_name, subreddit_name, None, None, None, session=session,
+                                            reddit=reddit, db=db)
+                except Exception as e:
+
+                    # Add a log entry for errors
+                    log_to_database(database_name, 'ERROR', f'Error in ingest_subreddits: {str(e)}',
+                                    'ingest_subreddits')
+
+    # Add a log entry for function exit
+    log_to_database(database_name, 'DEBUG', 'Exiting ingest_subreddits function', 'ingest_subreddits')
 
 
 # ============================
 # Function: main_loop_reddit
 # ============================
+@instrument
 async def main_loop_reddit(database_name, reddit_user_agent, reddit_client_id, reddit_client_secret):
     """
-           Iterates through subreddit list using process_subreddit.
+           Iterates through subreddit list using process_subreddit every six hours.
 
            Parameters:
                database_name (str): Path to the application db.
@@ -106,12 +408,6 @@ async def main_loop_reddit(database_name, reddit_user_agent, reddit_client_id, r
                None
            """
 
-    # Place the subreddits in which you want to check for posts within this list
-    subreddit_names = ['meme', 'me_irl', 'funny', 'ProgrammerHumor', 'starterpacks']
-
-    while True:
-        tasks = [
-            process_subreddit(database_name, subreddit_name, reddit_user_agent, reddit_client_id, reddit_client_secret)
-            for subreddit_name in subreddit_names]
-        await asyncio.gather(*tasks)
-        time.sleep(21600)
+    # Place the subreddits in which you want to check for posts within DEFAULT_SUBREDDITS
+    await run_reddit_scheduler(database_name, reddit_user_agent, reddit_client_id, reddit_client_secret,
+                               subreddits=DEFAULT_SUBREDDITS, interval=21600)
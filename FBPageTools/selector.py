@@ -0,0 +1,188 @@
+import math
+import random
+import time
+
+from .dbconn import get_connection
+
+# Weighting strategies supported by pick_unposted, besides plain 'uniform'
+WEIGHTED_STRATEGIES = ('ups', 'recent')
+
+# Half-life in seconds of the 'recent' weighting
+RECENT_HALF_LIFE = 86400
+
+# Random rowids a uniform pick tries before it falls back to choosing among the unposted rows by offset
+UNIFORM_PICK_ATTEMPTS = 32
+
+
+# ============================
+# Function: _pick_uniform
+# ============================
+def _pick_uniform(conn, table, attempts=UNIFORM_PICK_ATTEMPTS):
+    """
+    Pick an unposted row uniformly at random by rejection sampling: draw a random rowid between the smallest and
+    largest unposted rowids and accept it only if that exact row is unposted. Each draw is a primary key lookup, so
+    the cost does not grow with the table. If every draw misses, which happens when few rows in the range are still
+    unposted, the unposted rows are counted through the partial index and one is taken at a random offset. Both
+    paths give every unposted row the same chance.
+
+    Parameters:
+        conn (sqlite3.Connection): The shared connection.
+        table (str): The content table.
+        attempts (int): Random rowids drawn before falling back to the offset.
+
+    Returns:
+        list: A single row in the shape of a fetchall() result, or an empty list if nothing is unposted.
+    """
+    low = conn.execute(f'SELECT rowid FROM {table} WHERE posted = 0 ORDER BY rowid LIMIT 1').fetchone()
+    if low is None:
+        return []
+    high = conn.execute(f'SELECT rowid FROM {table} WHERE posted = 0 ORDER BY rowid DESC LIMIT 1').fetchone()
+
+    for _ in range(attempts):
+        row = conn.execute(f'SELECT * FROM {table} WHERE rowid = ? AND posted = 0',
+                           (random.randint(low[0], high[0]),)).fetchall()
+        if row:
+            return row
+
+    count = conn.execute(f'SELECT COUNT(*) FROM {table} WHERE posted = 0').fetchone()[0]
+    return conn.execute(f'SELECT * FROM {table} WHERE rowid = (SELECT rowid FROM {table} WHERE posted = 0 '
+                        f'ORDER BY rowid LIMIT 1 OFFSET ?)', (random.randrange(count),)).fetchall()
+
+
+# ============================
+# Function: _sort_key
+# ============================
+def _sort_key(strategy, ups, created_utc):
+    """
+    Return the Efraimidis-Spirakis key log(random()) / weight of a row in log space, as log(weight) minus the log
+    of an exponential variate, so small weights never underflow into ties. 'recent' weights halve every
+    RECENT_HALF_LIFE seconds of age, so their logs differ by a constant as time passes and keys computed at
+    different times stay in the right order.
+    """
+    if strategy == 'ups':
+        log_weight = math.log(max(ups or 0, 1))
+    else:
+        log_weight = (created_utc or time.time()) * math.log(2) / RECENT_HALF_LIFE
+    return log_weight - math.log(max(random.expovariate(1.0), 1e-300))
+
+
+# ============================
+# Function: refill_pick_queue
+# ============================
+def refill_pick_queue(database_name, table, strategy, incremental=False):
+    """
+    Fill the pre-shuffled queue for a weighted strategy. Every unposted row gets an Efraimidis-Spirakis key, so
+    reading the queue in key order gives a weighted random order. A full refill is the only step that reads the whole
+    table and can be run ahead of time, e.g. from a scheduled job. The largest rowid covered is recorded in
+    pick_queue_state, so an incremental refill only adds the rows inserted since.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        table (str): The content table. Weighted strategies need the ups and created_utc columns of memes.
+        strategy (str): 'ups' to weight by upvotes or 'recent' to favour newer posts.
+        incremental (bool): Only queue rows added since the last refill instead of rebuilding the queue.
+
+    Returns:
+        int: Number of rows queued.
+    """
+    conn = get_connection(database_name)
+    state = conn.execute('SELECT max_row_id FROM pick_queue_state WHERE source = ? AND strategy = ?',
+                         (table, strategy)).fetchone()
+    incremental = incremental and state is not None
+    after = state[0] if incremental else 0
+    max_row_id = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+    rows = conn.execute(f'SELECT rowid, ups, created_utc FROM {table} WHERE posted = 0 AND rowid > ? AND rowid <= ?',
+                        (after, max_row_id)).fetchall()
+    queued = [(table, strategy, _sort_key(strategy, ups, created_utc), rowid) for rowid, ups, created_utc in rows]
+
+    with conn:
+        if not incremental:
+            conn.execute('DELETE FROM pick_queue WHERE source = ? AND strategy = ?', (table, strategy))
+        conn.executemany('INSERT OR IGNORE INTO pick_queue (source, strategy, sort_key, row_id) VALUES (?, ?, ?, ?)',
+                         queued)
+        conn.execute('INSERT OR REPLACE INTO pick_queue_state (source, strategy, filled_at, max_row_id) '
+                     'VALUES (?, ?, ?, ?)', (table, strategy, int(time.time()), max_row_id))
+    return len(queued)
+
+
+# ============================
+# Function: _pick_queue_is_stale
+# ============================
+def _pick_queue_is_stale(conn, table, strategy):
+    """
+    Return True if a weighted pick queue was never filled or is missing rows added to the table since it was
+    filled. Both checks are index lookups.
+    """
+    state = conn.execute('SELECT max_row_id FROM pick_queue_state WHERE source = ? AND strategy = ?',
+                         (table, strategy)).fetchone()
+    if state is None:
+        return True
+    latest = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+    return latest > state[0]
+
+
+# ============================
+# Function: _pick_weighted
+# ============================
+def _pick_weighted(database_name, conn, table, strategy):
+    """
+    Pop the next row from the pre-shuffled queue, skipping entries whose row has been posted since the queue was
+    filled. Rows added since the queue was filled are queued before the pick, and the queue is rebuilt when it runs
+    dry.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        conn (sqlite3.Connection): The shared connection.
+        table (str): The content table.
+        strategy (str): One of WEIGHTED_STRATEGIES.
+
+    Returns:
+        list: A single row in the shape of a fetchall() result, or an empty list if nothing is unposted.
+    """
+    refilled = False
+    if _pick_queue_is_stale(conn, table, strategy):
+        refill_pick_queue(database_name, table, strategy, incremental=True)
+
+    while True:
+        try:
+            entry = conn.execute('SELECT sort_key, row_id FROM pick_queue WHERE source = ? AND strategy = ? '
+                                 'ORDER BY sort_key DESC LIMIT 1', (table, strategy)).fetchone()
+        except Exception:
+            entry = None
+
+        if entry is None:
+            if refilled or refill_pick_queue(database_name, table, strategy) == 0:
+                return []
+            refilled = True
+            continue
+
+        with conn:
+            conn.execute('DELETE FROM pick_queue WHERE source = ? AND strategy = ? AND sort_key = ? AND row_id = ?',
+                         (table, strategy, entry[0], entry[1]))
+        row = conn.execute(f'SELECT * FROM {table} WHERE rowid = ? AND posted = 0', (entry[1],)).fetchall()
+        if row:
+            return row
+
+
+# ============================
+# Function: pick_unposted
+# ============================
+def pick_unposted(database_name, table, strategy='uniform'):
+    """
+    Pick one unposted row from a content table without scanning or sorting it.
+
+    Parameters:
+        database_name (str): Path to the application db.
+        table (str): The content table, 'memes' or 'quotes'.
+        strategy (str): 'uniform' for a random unposted row found through the partial index of migration 3, or
+            'ups' / 'recent' to pop from a weighted, pre-shuffled queue (memes only).
+
+    Returns:
+        list: A single row in the shape of a fetchall() result, or an empty list if nothing is unposted.
+    """
+    conn = get_connection(database_name)
+    if strategy in WEIGHTED_STRATEGIES:
+        return _pick_weighted(database_name, conn, table, strategy)
+    if strategy != 'uniform':
+        raise ValueError(f'Unknown pick strategy: {strategy}')
+    return _pick_uniform(conn, table)
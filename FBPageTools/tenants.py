@@ -0,0 +1,195 @@
+import asyncio
+import functools
+import json
+import os
+import re
+
+import aiohttp
+import asyncpraw
+
+from .daemon import (DEFAULT_CADENCES, DEFAULT_REPLY_TIMEOUT, DEFAULT_REPLY_WORKERS, Daemon, Job, add_page_jobs,
+                     add_service_jobs)
+from .dbapp import create_tables, log_to_database
+from .reddit import DEFAULT_SUBREDDITS, run_reddit_scheduler
+
+# Tenant names become job name prefixes and shard file names
+TENANT_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# $VAR or ${VAR} references left in a config string after expansion, i.e. variables that are not set
+UNSET_VARIABLE = re.compile(r'\$(\w+|\{[^}]*\})')
+
+# Settings a tenant inherits from the config's defaults when it does not set them
+TENANT_SETTINGS = ('page_id', 'access_token', 'subreddits', 'model', 'reply_workers', 'reply_timeout')
+
+
+def _expand(value):
+    if isinstance(value, str):
+        expanded = os.path.expandvars(value)
+        match = UNSET_VARIABLE.search(expanded)
+        if match:
+            raise ValueError(f'Environment variable {match.group(1).strip("{}")} is not set')
+        return expanded
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _expand(item) for key, item in value.items()}
+    return value
+
+
+# ============================
+# Function: load_tenants
+# ============================
+def load_tenants(path):
+    """
+    Load a tenant config file. The file is JSON with a tenants list, one entry per Facebook page, and optional
+    process wide settings:
+
+        data_dir: directory of the shards, defaults to the config file's directory
+        database_name: db of the runtime's own logs and metrics, defaults to runtime.db in data_dir
+        max_workers, max_per_tenant: threads shared by every tenant's blocking jobs, and the most one tenant may hold
+        openai_api, reddit_user_agent, reddit_client_id, reddit_client_secret: credentials shared by every tenant
+        defaults: page_id, access_token, subreddits, cadences, model, reply_workers or reply_timeout used by tenants
+            that do not set their own
+
+    Each tenant has a name and may set database_name, its shard, which defaults to <name>.db in data_dir. Cadences
+    are merged over the defaults' cadences. Relative paths are resolved against the config file's directory.
+    ${VAR} references in any string are replaced with environment variables, so tokens can stay out of the file, and
+    a reference to a variable that is not set raises ValueError.
+
+    Parameters:
+        path (str): Path to the config file.
+
+    Returns:
+        dict: The process wide settings with a tenants list of resolved tenant dicts.
+    """
+    with open(path) as f:
+        config = _expand(json.load(f))
+
+    config_dir = os.path.dirname(os.path.abspath(path))
+    data_dir = os.path.normpath(os.path.join(config_dir, config.get('data_dir') or '.'))
+    defaults = config.get('defaults', {})
+    tenants = []
+    for entry in config.get('tenants', []):
+        name = entry.get('name')
+        if not name or not TENANT_NAME.match(name):
+            raise ValueError(f'Invalid tenant name: {name!r}')
+        if any(tenant['name'] == name for tenant in tenants):
+            raise ValueError(f'Duplicate tenant name: {name}')
+
+        tenant = {key: entry.get(key, defaults.get(key)) for key in TENANT_SETTINGS}
+        tenant['name'] = name
+        tenant['database_name'] = os.path.join(config_dir if entry.get('database_name') else data_dir,
+                                               entry.get('database_name') or f'{name}.db')
+        tenant['cadences'] = {**DEFAULT_CADENCES, **defaults.get('cadences', {}), **entry.get('cadences', {})}
+        tenant['subreddits'] = tenant['subreddits'] or DEFAULT_SUBREDDITS
+        tenant['reply_workers'] = tenant['reply_workers'] or DEFAULT_REPLY_WORKERS
+        tenant['reply_timeout'] = tenant['reply_timeout'] or DEFAULT_REPLY_TIMEOUT
+        tenants.append(tenant)
+
+    if len({tenant['database_name'] for tenant in tenants}) != len(tenants):
+        raise ValueError('Tenants must not share a database')
+
+    max_workers = config.get('max_workers', 4)
+    return {
+        'data_dir': data_dir,
+        'database_name': os.path.join(config_dir if config.get('database_name') else data_dir,
+                                      config.get('database_name') or 'runtime.db'),
+        'max_workers': max_workers,
+        'max_per_tenant': config.get('max_per_tenant', max(1, max_workers // 2)),
+        'openai_api': config.get('openai_api'),
+        'reddit_user_agent': config.get('reddit_user_agent'),
+        'reddit_client_id': config.get('reddit_client_id'),
+        'reddit_client_secret': config.get('reddit_client_secret'),
+        'cadences': {**DEFAULT_CADENCES, **defaults.get('cadences', {})},
+        'tenants': tenants,
+    }
+
+
+# ============================
+# Function: run_shared_reddit_ingest
+# ============================
+async def run_shared_reddit_ingest(tenants, reddit_user_agent, reddit_client_id, reddit_client_secret, jitter=0.1):
+    """
+    Ingest every tenant's subreddits into its shard with one authenticated asyncpraw client and one HTTP session,
+    so every tenant draws on the same Reddit rate limit and connection pool. Runs until cancelled.
+
+    Parameters:
+        tenants (list): Tenant dicts from load_tenants. Tenants whose reddit_ingest cadence is 0 are skipped.
+        reddit_user_agent (str): UserAgent info to report back to reddit api.
+        reddit_client_id (str): Reddit API application ID.
+        reddit_client_secret (str): Reddit API Access Key
+        jitter (float): Fraction of each tenant's interval every sleep is randomised by.
+
+    Returns:
+        None
+    """
+    async with asyncpraw.Reddit(user_agent=reddit_user_agent,
+                                client_id=reddit_client_id,
+                                client_secret=reddit_client_secret) as reddit:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16)) as session:
+            await asyncio.gather(*[
+                run_reddit_scheduler(tenant['database_name'], reddit_user_agent, reddit_client_id,
+                                     reddit_client_secret, subreddits=tenant['subreddits'],
+                                     interval=tenant['cadences']['reddit_ingest'], jitter=jitter, reddit=reddit,
+                                     session=session)
+                for tenant in tenants if tenant['cadences'].get('reddit_ingest')])
+
+
+# ============================
+# Function: build_tenant_daemon
+# ============================
+def build_tenant_daemon(config):
+    """
+    Build one Daemon that serves every tenant. Each tenant's jobs run against its own shard and are named
+    <tenant>:<job>. Tenants share the daemon's thread pool, including reply workers, the Graph API session, the Reddit
+    client and the event loop. A tenant adds no pools or processes, only the two threads tied to its shard: the log
+    sink's writer and the aiosqlite connection of its Reddit ingest. Each tenant's first runs are offset by a fraction
+    of the cadence so tenants take turns, and no tenant holds more than max_per_tenant workers at once.
+
+    Parameters:
+        config (dict): Settings from load_tenants.
+
+    Returns:
+        Daemon: The daemon, ready to run.
+    """
+    tenants = config['tenants']
+    daemon = Daemon(config['database_name'], max_workers=config['max_workers'],
+                    max_per_group=config['max_per_tenant'])
+
+    for index, tenant in enumerate(tenants):
+        add_page_jobs(daemon, tenant['database_name'], tenant['page_id'], tenant['access_token'], tenant['model'],
+                      config['openai_api'], cadences=tenant['cadences'], tenant=tenant['name'],
+                      offset=index / len(tenants), reply_workers=tenant['reply_workers'],
+                      reply_timeout=tenant['reply_timeout'])
+
+    if config['reddit_client_id'] and config['reddit_client_secret']:
+        daemon.add_job(Job('reddit_ingest', functools.partial(
+            run_shared_reddit_ingest, tenants, config['reddit_user_agent'], config['reddit_client_id'],
+            config['reddit_client_secret']), None, blocking=False))
+
+    add_service_jobs(daemon, config['database_name'], cadences=config['cadences'])
+    return daemon
+
+
+# ============================
+# Function: run_tenants
+# ============================
+async def run_tenants(path):
+    """
+    Create the tables of every shard, then run every tenant in this event loop until SIGINT or SIGTERM. See
+    load_tenants for the config file.
+
+    Parameters:
+        path (str): Path to the tenant config file.
+
+    Returns:
+        dict: Job name to job stats at shutdown.
+    """
+    config = load_tenants(path)
+    os.makedirs(config['data_dir'], exist_ok=True)
+    create_tables(config['database_name'])
+    for tenant in config['tenants']:
+        create_tables(tenant['database_name'])
+    log_to_database(config['database_name'], 'INFO',
+                    f'Serving tenants: {", ".join(tenant["name"] for tenant in config["tenants"])}', 'run_tenants')
+    return await build_tenant_daemon(config).run()
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import asyncpraw
+import facebook
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import FBPageTools as fb  # noqa: E402
+from FBPageTools import dbconn, dblogging, fbcrawler  # noqa: E402
+from benchmarks.standins import StandInConfig, StandInServer  # noqa: E402
+
+
+# ============================
+# Class: WriteCounter
+# ============================
+class WriteCounter:
+    """
+    Count SQLite statements on every connection handed out by dbconn, splitting application writes from log writes.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.writes = 0
+        self.log_writes = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.statements = self.writes = self.log_writes = 0
+
+    def install(self, conn):
+        conn.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        verb = statement.lstrip()[:7].upper()
+        with self._lock:
+            self.statements += 1
+            if verb.startswith(('INSERT', 'UPDATE', 'DELETE', 'REPLACE')):
+                if 'fb_logging' in statement:
+                    self.log_writes += 1
+                else:
+                    self.writes += 1
+
+
+# ============================
+# Function: measure
+# ============================
+def measure(name, server, counter, database_name, func, count_items):
+    """
+    Run one entry point and collect wall time, throughput, peak Python memory, SQLite statements and HTTP requests.
+
+    Parameters:
+        name (str): Scenario name used in the report.
+        server (StandInServer): The stand-in server, whose counters are reset before the run.
+        counter (WriteCounter): SQLite statement counter.
+        database_name (str): Path to the benchmark db.
+        func (callable): Runs the entry point. A dict it returns is added to the result as its report.
+        count_items (callable): Returns the number of items the entry point produced.
+
+    Returns:
+        dict: The scenario result.
+    """
+    server.reset_stats()
+    counter.reset()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    error = None
+    report = None
+    try:
+        report = func()
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    elapsed = time.perf_counter() - start
+    dblogging.flush_logs(database_name)
+    _, peak = tracemalloc.get_traced_memory()
+    items = count_items()
+
+    result = {
+        'scenario': name,
+        'items': items,
+        'seconds': round(elapsed, 3),
+        'items_per_second': round(items / elapsed, 1) if elapsed > 0 else 0.0,
+        'peak_memory_mb': round(peak / 1048576, 2),
+        'sqlite_statements': counter.statements,
+        'sqlite_writes': counter.writes,
+        'sqlite_log_writes': counter.log_writes,
+        'http_requests': dict(server.requests),
+        'http_bytes': server.bytes_sent,
+        'http_bytes_received': server.bytes_received,
+    }
+    if isinstance(report, dict):
+        result['report'] = report
+    if error:
+        result['error'] = error
+    print(json.dumps(result), flush=True)
+    return result
+
+
+async def _probe_loop_lag(lags, interval=0.005):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+def _hold_write_lock(database_name, seconds, stop):
+    conn = dbconn.open_connection(database_name)
+    while not stop.is_set():
+        conn.execute('BEGIN IMMEDIATE')
+        time.sleep(seconds)
+        conn.commit()
+        time.sleep(seconds / 5)
+    conn.close()
+
+
+def _count(database_name, sql):
+    try:
+        return dbconn.get_connection(database_name).execute(sql).fetchone()[0]
+    except Exception:
+        return 0
+
+
+# ============================
+# Function: run_benchmarks
+# ============================
+def run_benchmarks(config, scenarios, posts_to_publish=50, subreddits=('meme', 'funny'), writer_hold_ms=0):
+    """
+    Run the selected FBPageTools entry points against a fresh database and the local stand-ins.
+
+    Parameters:
+        config (StandInConfig): Data volumes and failure behaviour of the stand-ins.
+        scenarios (list): Scenario names to run, in pipeline order.
+        posts_to_publish (int): post_to_facebook calls per content table.
+        subreddits (tuple): Subreddits ingested by the process_subreddit scenario.
+        writer_hold_ms (float): If set, a background writer holds the db write lock this long, over and over, like
+            another job committing while the scenarios run.
+
+    Returns:
+        list: One result dict per scenario.
+    """
+    server = StandInServer(config).start()
+    counter = WriteCounter()
+    dbconn.CONNECTION_HOOKS.append(counter.install)
+
+    # Point the SDKs at the stand-ins
+    facebook.FACEBOOK_GRAPH_URL = server.url + '/'
+    fbcrawler.GRAPH_URL = server.url + '/'
+    openai.api_base = server.url + '/v1'
+
+    workdir = tempfile.mkdtemp(prefix='fbpagetools-bench-')
+    database_name = os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('MEDIA_CACHE_DIR', os.path.join(workdir, 'media'))
+    fb.create_tables(database_name)
+    conn = dbconn.get_connection(database_name)
+    conn.executemany('INSERT INTO quotes (author, quote, posted) VALUES (?, ?, 0)',
+                     [(f'Author {i}', f'Quote number {i}') for i in range(max(posts_to_publish * 20, 1000))])
+    conn.executemany('INSERT INTO memes (id, permalink, title, author, ups, created_utc, image_link, indexed_time, '
+                     'posted, postedOn) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, NULL)',
+                     [(f'seed{i}', f'reddit.com/r/meme/comments/seed{i}/', f'Seed meme {i}', 'user', 100 + i,
+                       int(time.time()), f'{server.url}/img/seed{i}.png', int(time.time()))
+                      for i in range(max(posts_to_publish * 20, 1000))])
+    conn.commit()
+
+    token = 'stand-in-token'
+    tracemalloc.start()
+
+    def reddit_ingest():
+        async def ingest():
+            probe = asyncio.create_task(_probe_loop_lag(lags))
+            try:
+                async with asyncpraw.Reddit(client_id='bench', client_secret='bench', user_agent='fbpagetools-bench',
+                                            oauth_url=server.url, reddit_url=server.url) as reddit:
+                    await asyncio.gather(*[fb.process_subreddit(database_name, name, None, None, None, reddit=reddit)
+                                           for name in subreddits])
+            finally:
+                probe.cancel()
+
+        lags = []
+        asyncio.run(ingest())
+        lags.sort()
+        return {'loop_lag_max_ms': round(lags[-1] * 1000, 2) if lags else 0.0,
+                'loop_lag_p99_ms': round(lags[int(len(lags) * 0.99)] * 1000, 2) if lags else 0.0,
+                'loop_lag_probes': len(lags)}
+
+    available = {
+        'get_all_posts': (
+            lambda: fb.get_all_posts(database_name, config.page_id, token),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM fb_posts')),
+        'get_all_post_comments': (
+            lambda: fb.get_all_post_comments(database_name, token),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM fb_posts')),
+        'get_all_post_comments_incremental': (
+            lambda: fb.get_all_post_comments(database_name, token, incremental=True),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM fb_posts')),
+        'sync_page': (
+            lambda: fb.sync_page(database_name, config.page_id, token),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM fb_posts')),
+        'crawl_post_comments': (
+            lambda: asyncio.run(fb.crawl_post_comments(database_name, token)),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM fb_posts')),
+        'reply_to_comments': (
+            lambda: fb.reply_to_comments(database_name, token, 'gpt-3.5-turbo', 'stand-in-key'),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM fb_comments WHERE completed = 1')),
+        'process_subreddit': (
+            reddit_ingest,
+            lambda: _count(database_name, "SELECT COUNT(*) FROM memes WHERE id NOT LIKE 'seed%'")),
+        'bulk_delete_posts': (
+            lambda: fb.remove_dev_posts(database_name, config.page_id, token, r'number \d*7$', bulk=True),
+            lambda: _count(database_name, "SELECT COUNT(*) FROM fb_post_deletions WHERE status = 'deleted'")),
+        'normalize_media': (
+            lambda: fb.normalize_media(database_name, limit=None),
+            lambda: _count(database_name, 'SELECT COUNT(*) FROM memes WHERE upload_size > 0')),
+        'post_to_facebook': (
+            lambda: [fb.post_to_facebook(database_name, token, table)
+                     for _ in range(posts_to_publish) for table in ('memes', 'quotes')],
+            lambda: _count(database_name, 'SELECT (SELECT COUNT(*) FROM memes WHERE posted = 1) + '
+                                          '(SELECT COUNT(*) FROM quotes WHERE posted = 1)')),
+    }
+
+    results = []
+    stop_writer = threading.Event()
+    if writer_hold_ms:
+        threading.Thread(target=_hold_write_lock, args=(database_name, writer_hold_ms / 1000, stop_writer),
+                         daemon=True).start()
+    try:
+        for name in scenarios:
+            if name not in available:
+                print(json.dumps({'scenario': name, 'skipped': 'unknown scenario'}), flush=True)
+                continue
+            func, count_items = available[name]
+            results.append(measure(name, server, counter, database_name, func, count_items))
+    finally:
+        stop_writer.set()
+        tracemalloc.stop()
+        dbconn.CONNECTION_HOOKS.remove(counter.install)
+        server.stop()
+    return results
+
+
+# ============================
+# Function: compare_results
+# ============================
+def compare_results(baseline, current):
+    """
+    Print the change in wall time, throughput, peak memory and SQLite writes between two result files.
+
+    Parameters:
+        baseline (list): Results from an earlier run.
+        current (list): Results from this run.
+
+    Returns:
+        None
+    """
+    before = {result['scenario']: result for result in baseline}
+    print(f'{"scenario":36} {"seconds":>18} {"items/s":>18} {"peak MB":>16} {"writes":>16}')
+    for result in current:
+        old = before.get(result['scenario'])
+        if old is None:
+            continue
+        cells = []
+        for key in ('seconds', 'items_per_second', 'peak_memory_mb', 'sqlite_writes'):
+            cells.append(f'{old.get(key, 0)} -> {result.get(key, 0)}')
+        print(f'{result["scenario"]:36} {cells[0]:>18} {cells[1]:>18} {cells[2]:>16} {cells[3]:>16}')
+
+
+DEFAULT_SCENARIOS = ['get_all_posts', 'get_all_post_comments', 'get_all_post_comments_incremental',
+                     'sync_page', 'crawl_post_comments', 'reply_to_comments', 'process_subreddit', 'post_to_facebook']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark FBPageTools entry points against local stand-ins.')
+    parser.add_argument('--posts', type=int, default=1000, help='Posts on the stand-in page.')
+    parser.add_argument('--comments-per-post', type=int, default=5, help='Comments on every post.')
+    parser.add_argument('--question-ratio', type=float, default=0.1, help='Fraction of [Question] comments.')
+    parser.add_argument('--listing-size', type=int, default=100, help='Posts in every subreddit listing.')
+    parser.add_argument('--image-side', type=int, default=256, help='Side in pixels of generated images.')
+    parser.add_argument('--publish', type=int, default=50, help='post_to_facebook calls per content table.')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay added to every response.')
+    parser.add_argument('--upload-kbps', type=float, default=0.0, help='Simulated upload bandwidth to the stand-ins.')
+    parser.add_argument('--graph-rate-limit', type=int, default=0,
+                        help='Graph calls per second the stand-in allows before answering with error code 4.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail.')
+    parser.add_argument('--writer-hold-ms', type=float, default=0.0,
+                        help='Hold the db write lock this long in a loop from a background writer.')
+    parser.add_argument('--scenario', action='append', help='Scenario to run, may be repeated. Defaults to all.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Print the change against an earlier results file.')
+    args = parser.parse_args()
+
+    stand_in_config = StandInConfig(posts=args.posts, comments_per_post=args.comments_per_post,
+                                    question_ratio=args.question_ratio, listing_size=args.listing_size,
+                                    image_side=args.image_side, latency_ms=args.latency_ms,
+                                    error_rate=args.error_rate, upload_kbps=args.upload_kbps,
+                                    graph_rate_limit=args.graph_rate_limit)
+    run_results = run_benchmarks(stand_in_config, args.scenario or DEFAULT_SCENARIOS, posts_to_publish=args.publish,
+                                 writer_hold_ms=args.writer_hold_ms)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), run_results)
@@ -0,0 +1,361 @@
+import asyncio
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+# Epoch of the newest generated post, everything else is dated backwards from here
+BASE_TIME = 1682899200
+
+
+# ============================
+# Class: StandInConfig
+# ============================
+class StandInConfig:
+    """
+    Data volumes and failure behaviour of the stand-in services.
+
+    Parameters:
+        page_id (str): Page id served by the Graph stand-in.
+        posts (int): Number of posts on the page.
+        comments_per_post (int): Comments on every post.
+        question_ratio (float): Fraction of comments that start with [Question].
+        listing_size (int): Posts in every subreddit top listing.
+        image_side (int): Width and height in pixels of generated images.
+        latency_ms (float): Delay added to every response.
+        upload_kbps (float): Simulated client upload bandwidth, request bodies are delayed by their transfer time.
+        graph_rate_limit (int): Graph calls allowed per second, each request in a batch counts. Calls over the limit
+            are answered with error code 4. Usage is reported in the X-App-Usage header. 0 turns the limit off.
+        error_rate (float): Fraction of requests answered with a 500 error.
+        seed (int): Seed for the error and image generators.
+    """
+
+    def __init__(self, page_id='1000', posts=1000, comments_per_post=5, question_ratio=0.1, listing_size=100,
+                 image_side=256, latency_ms=0.0, error_rate=0.0, seed=1, upload_kbps=0.0,
+                 graph_rate_limit=0):
+        self.page_id = page_id
+        self.posts = posts
+        self.comments_per_post = comments_per_post
+        self.question_ratio = question_ratio
+        self.listing_size = listing_size
+        self.image_side = image_side
+        self.latency_ms = latency_ms
+        self.upload_kbps = upload_kbps
+        self.graph_rate_limit = graph_rate_limit
+        self.error_rate = error_rate
+        self.seed = seed
+
+
+def _graph_time(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+0000')
+
+
+def _png(seed, side):
+    """
+    Build a valid greyscale PNG of side x side pixels whose content depends on seed, so every image hashes differently.
+    """
+    rng = random.Random(seed)
+    rows = b''.join(b'\x00' + rng.randbytes(side) for _ in range(side))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', side, side, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b'')
+
+
+# ============================
+# Class: StandInServer
+# ============================
+class StandInServer:
+    """
+    Local HTTP stand-in for the Graph API, Reddit OAuth API, an image host and the OpenAI API, served from a
+    background thread. Data is generated on demand, so a million posts cost no memory until they are requested.
+
+    Parameters:
+        config (StandInConfig): Data volumes and failure behaviour.
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 picks a free port.
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or StandInConfig()
+        self.host = host
+        self.port = port
+        self.url = None
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._rng = random.Random(self.config.seed)
+        self._images = OrderedDict()
+        self._graph_calls = deque()
+        self._graph_used = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    # ----------------------------
+    # Lifecycle
+    # ----------------------------
+    def start(self):
+        """
+        Start serving in a background thread and wait until the port is bound.
+
+        Returns:
+            StandInServer: self, with url set.
+        """
+        self._thread = threading.Thread(target=self._serve, name='stand-in-server', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        """
+        Stop the server and its thread.
+
+        Returns:
+            None
+        """
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def reset_stats(self):
+        """
+        Clear the request and byte counters.
+
+        Returns:
+            None
+        """
+        self.requests.clear()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application(middlewares=[self._middleware], client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/api/v1/access_token', self._reddit_token)
+        app.router.add_get('/r/{subreddit}/top', self._reddit_top)
+        app.router.add_get('/img/{name}', self._image)
+        app.router.add_post('/v1/chat/completions', self._chat_completion)
+        app.router.add_post('/v1/images/generations', self._image_generation)
+        app.router.add_post('/', self._graph_batch)
+        app.router.add_route('*', '/{path:.*}', self._graph)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{self.host}:{self.port}'
+        self._ready.set()
+        self._loop.run_forever()
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        received = request.content_length or 0
+        self.bytes_received += received
+        if self.config.upload_kbps and received:
+            await asyncio.sleep(received * 8 / (self.config.upload_kbps * 1000))
+        if self.config.latency_ms:
+            await asyncio.sleep(self.config.latency_ms / 1000)
+        if self.config.error_rate and self._rng.random() < self.config.error_rate:
+            self.requests['error'] += 1
+            return web.json_response({'error': {'message': 'Stand-in error', 'type': 'OAuthException', 'code': 2}},
+                                     status=500)
+        response = await handler(request)
+        if response.body is not None:
+            self.bytes_sent += len(response.body)
+        return response
+
+    # ----------------------------
+    # Graph API
+    # ----------------------------
+    def _post(self, index):
+        return {'id': f'{self.config.page_id}_{index}', 'message': f'Post number {index}',
+                'created_time': _graph_time(BASE_TIME - index * 60)}
+
+    def _comment(self, post_index, index):
+        created = BASE_TIME - post_index * 60 + (index + 1) * 30
+        if (post_index * 31 + index * 17) % 100 < self.config.question_ratio * 100:
+            message = f'[Question] What is the answer to number {(post_index + index) % 50}?'
+        else:
+            message = f'Comment {index} on post {post_index}'
+        return {'id': f'{self.config.page_id}_{post_index}_{index}', 'message': message,
+                'created_time': _graph_time(created)}
+
+    def _page(self, items, total, offset, limit, path):
+        body = {'data': items}
+        if offset + limit < total:
+            body['paging'] = {'cursors': {'before': str(offset), 'after': str(offset + limit)},
+                              'next': f'{self.url}/{path}?after={offset + limit}&limit={limit}'}
+        return body
+
+    def _graph_get(self, path, query):
+        parts = [part for part in path.split('/') if part and not (part[0] == 'v' and part[1:2].isdigit())]
+        limit = int(query.get('limit', 25))
+        offset = int(query.get('after', 0))
+
+        if len(parts) == 2 and parts[1] in ('posts', 'feed') and parts[0] in (self.config.page_id, 'me'):
+            self.requests['graph_posts'] += 1
+            end = min(offset + limit, self.config.posts)
+            posts = [self._post(i) for i in range(offset, end)]
+
+            # Nested expansion, e.g. fields=id,message,comments.limit(5){id,message,created_time}
+            expansion = re.search(r'comments\.limit\((\d+)\)', query.get('fields', ''))
+            if expansion:
+                inline = int(expansion.group(1))
+                for i, post in zip(range(offset, end), posts):
+                    comments = [self._comment(i, j) for j in range(self.config.comments_per_post)]
+                    if comments:
+                        post['comments'] = self._page(comments[:inline], len(comments), 0, inline,
+                                                      f'{post["id"]}/comments')
+            return self._page(posts, self.config.posts, offset, limit, f'{parts[0]}/{parts[1]}')
+
+        if len(parts) == 2 and parts[1] == 'comments':
+            self.requests['graph_comments'] += 1
+            post_index = int(parts[0].rsplit('_', 1)[1])
+            comments = [self._comment(post_index, i) for i in range(self.config.comments_per_post)]
+            if 'since' in query:
+                since = int(query['since'])
+                comments = [c for c in comments
+                            if datetime.strptime(c['created_time'], '%Y-%m-%dT%H:%M:%S%z').timestamp() >= since]
+            return self._page(comments[offset:offset + limit], len(comments), offset, limit, f'{parts[0]}/comments')
+
+        self.requests['graph_object'] += 1
+        return {'id': parts[0] if parts else ''}
+
+    def _graph_quota(self, cost):
+        """
+        Charge cost calls against the Graph rate limit. Returns the usage headers, and the throttling response when
+        the calls are over the limit.
+        """
+        limit = self.config.graph_rate_limit
+        if not limit:
+            return {}, None
+        now = time.monotonic()
+        while self._graph_calls and self._graph_calls[0][0] <= now - 1:
+            self._graph_used -= self._graph_calls.popleft()[1]
+        if self._graph_used + cost > limit:
+            self.requests['graph_throttled'] += 1
+            headers = {'X-App-Usage': json.dumps({'call_count': 100, 'total_cputime': 0, 'total_time': 0})}
+            return headers, web.json_response({'error': {'message': '(#4) Application request limit reached',
+                                                         'type': 'OAuthException', 'code': 4}},
+                                              status=400, headers=headers)
+        self._graph_calls.append((now, cost))
+        self._graph_used += cost
+        usage = int(self._graph_used * 100 / limit)
+        return {'X-App-Usage': json.dumps({'call_count': usage, 'total_cputime': 0, 'total_time': 0})}, None
+
+    async def _graph(self, request):
+        headers, throttled = self._graph_quota(1)
+        if throttled is not None:
+            return throttled
+        response = await self._graph_call(request)
+        response.headers.update(headers)
+        return response
+
+    async def _graph_call(self, request):
+        query = dict(request.query)
+        if request.method in ('POST', 'DELETE'):
+            data = await request.post()
+            query.update({k: v for k, v in data.items() if isinstance(v, str)})
+            parts = [part for part in request.match_info['path'].split('/')
+                     if part and not (part[0] == 'v' and part[1:2].isdigit())]
+            if request.method == 'DELETE' or query.get('method', '').lower() == 'delete':
+                self.requests['graph_delete'] += 1
+                return web.json_response({'success': True})
+            self.requests[f'graph_post_{parts[-1] if parts else "root"}'] += 1
+            return web.json_response({'id': f'{int(time.time() * 1000)}_{self.requests.total()}'})
+        return web.json_response(self._graph_get(request.match_info['path'], query))
+
+    async def _graph_batch(self, request):
+        data = await request.post()
+        batch = json.loads(data['batch'])
+        headers, throttled = self._graph_quota(len(batch))
+        if throttled is not None:
+            return throttled
+        self.requests['graph_batch'] += 1
+        results = []
+        for item in batch:
+            url = item['relative_url']
+            path, _, raw_query = url.partition('?')
+            query = dict(pair.split('=', 1) for pair in raw_query.split('&') if '=' in pair)
+            if item.get('method', 'GET').upper() == 'DELETE':
+                self.requests['graph_delete'] += 1
+                body = {'success': True}
+            else:
+                body = self._graph_get(path, query)
+            results.append({'code': 200, 'headers': [], 'body': json.dumps(body)})
+        return web.json_response(results, headers=headers)
+
+    # ----------------------------
+    # Reddit
+    # ----------------------------
+    async def _reddit_token(self, request):
+        self.requests['reddit_token'] += 1
+        return web.json_response({'access_token': 'stand-in', 'expires_in': 3600, 'scope': '*',
+                                  'token_type': 'bearer'})
+
+    async def _reddit_top(self, request):
+        self.requests['reddit_listing'] += 1
+        subreddit = request.match_info['subreddit']
+        limit = min(int(request.query.get('limit', 100)), self.config.listing_size)
+        now = time.time()
+        children = []
+        for i in range(limit):
+            post_id = f'{subreddit.lower()}{i}'
+            children.append({'kind': 't3', 'data': {
+                'id': post_id, 'name': f't3_{post_id}', 'title': f'{subreddit} meme {i}', 'author': f'user{i}',
+                'subreddit': subreddit, 'over_18': False, 'score': 500 + i, 'ups': 500 + i,
+                'created_utc': now - 3600 - i, 'url': f'{self.url}/img/{post_id}.png',
+                'permalink': f'/r/{subreddit}/comments/{post_id}/meme_{i}/'}})
+        return web.json_response({'kind': 'Listing', 'data': {'children': children, 'after': None, 'before': None}})
+
+    # ----------------------------
+    # Image host
+    # ----------------------------
+    async def _image(self, request):
+        self.requests['image'] += 1
+        name = request.match_info['name']
+        body = self._images.get(name)
+        if body is None:
+            body = _png(name, self.config.image_side)
+            self._images[name] = body
+            if len(self._images) > 256:
+                self._images.popitem(last=False)
+
+        range_header = request.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            start, _, end = range_header[6:].partition('-')
+            start, end = int(start or 0), min(int(end or len(body) - 1), len(body) - 1)
+            return web.Response(body=body[start:end + 1], status=206, content_type='image/png',
+                                headers={'Content-Range': f'bytes {start}-{end}/{len(body)}'})
+        return web.Response(body=body, content_type='image/png')
+
+    # ----------------------------
+    # OpenAI
+    # ----------------------------
+    async def _chat_completion(self, request):
+        self.requests['openai_chat'] += 1
+        payload = await request.json()
+        prompt = payload['messages'][-1]['content']
+        return web.json_response({
+            'id': 'chatcmpl-stand-in', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': payload.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': f'Stand-in answer to: {prompt}'}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 10, 'total_tokens': 20}})
+
+    async def _image_generation(self, request):
+        self.requests['openai_image'] += 1
+        return web.json_response({'created': int(time.time()), 'data': [{'url': f'{self.url}/img/generated.png'}]})
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Submodules each python -m FBPageTools job imports before it runs, see FBPageTools/__main__.py
+JOB_MODULES = {
+    'ingest': ('dbapp', 'reddit'),
+    'post': ('dbapp', 'fbpage'),
+    'sync-posts': ('dbapp', 'fbpage'),
+    'sync-comments': ('dbapp', 'fbpage'),
+    'reply': ('dbapp', 'fbpage'),
+    'cleanup': ('dbapp', 'dblogging', 'mediacache'),
+}
+
+# Run in a fresh interpreter: import the CLI and the given submodules, then report peak memory and loaded SDKs
+CHILD = '''
+import importlib, json, resource, sys
+import FBPageTools.__main__
+modules = sys.argv[1:] or list(importlib.import_module('FBPageTools')._EXPORTS)
+for name in modules:
+    importlib.import_module(f'FBPageTools.{name}')
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'max_rss_mb': round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+                  'sdks': sorted(sdk for sdk in ('aiohttp', 'asyncpraw', 'facebook', 'openai', 'PIL')
+                                 if sdk in sys.modules)}))
+'''
+
+
+# ============================
+# Function: _import_ms
+# ============================
+def _import_ms(importtime):
+    """
+    Return the total import time in milliseconds from -X importtime output, the sum of the cumulative times of the
+    top-level imports.
+    """
+    total = 0
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        if not package[1:].startswith(' '):
+            total += int(cumulative)
+    return total / 1000
+
+
+# ============================
+# Function: measure_startup
+# ============================
+def measure_startup(modules=None, repeat=5):
+    """
+    Start a fresh interpreter repeat times with python -X importtime, import the FBPageTools CLI and modules, and
+    report the medians.
+
+    Parameters:
+        modules (tuple): FBPageTools submodules to import. If None every submodule is imported, as an eager package
+            would.
+        repeat (int): Interpreters started.
+
+    Returns:
+        dict: Median wall and import milliseconds, peak resident memory in MB and the SDKs that were loaded.
+    """
+    walls, imports, result = [], [], {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHILD, *(modules or ())], cwd=ROOT,
+                              capture_output=True, text=True, check=True)
+        walls.append((time.perf_counter() - start) * 1000)
+        imports.append(_import_ms(proc.stderr))
+        result = json.loads(proc.stdout)
+    return {'wall_ms': round(statistics.median(walls), 1), 'import_ms': round(statistics.median(imports), 1),
+            **result}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the start-up cost of python -m FBPageTools jobs.')
+    parser.add_argument('--job', action='append', choices=sorted(JOB_MODULES),
+                        help='Job to measure, may be repeated. Defaults to all.')
+    parser.add_argument('--repeat', type=int, default=5, help='Interpreters started per measurement.')
+    args = parser.parse_args()
+
+    print(json.dumps({'job': 'every module', **measure_startup(repeat=args.repeat)}))
+    for job in args.job or JOB_MODULES:
+        print(json.dumps({'job': job, **measure_startup(JOB_MODULES[job], repeat=args.repeat)}))
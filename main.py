@@ -1,7 +1,8 @@
 import asyncio
 import os
 from dotenv import load_dotenv
-from FBPageTools.reddit import main_loop_reddit
+from FBPageTools.daemon import run_daemon
+from FBPageTools.tenants import run_tenants
 
 # Load environment variables
 load_dotenv()
@@ -13,12 +14,13 @@ MODEL_ENGINE = os.getenv('MODEL_ENGINE')
 REDDIT_CLIENT_ID = os.getenv('REDDIT_CLIENT_ID')
 REDDIT_CLIENT_SECRET = os.getenv('REDDIT_CLIENT_SECRET')
 REDDIT_USER_AGENT = os.getenv('REDDIT_USER_AGENT')
+TENANTS_CONFIG = os.getenv('TENANTS_CONFIG')
 
 if __name__ == '__main__':
-    asyncio.run(main_loop_reddit(DATABASE_NAME, REDDIT_USER_AGENT, REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET))
-    # fb.create_tables(DATABASE_NAME)
-    # fb.post_to_facebook(DATABASE_NAME, FACEBOOK_ACCESS_TOKEN, 'quotes')
-    # fb.post_to_facebook(DATABASE_NAME, FACEBOOK_ACCESS_TOKEN, 'memes')
-    # fb.get_all_posts(DATABASE_NAME, FACEBOOK_PAGE_ID, FACEBOOK_ACCESS_TOKEN)
-    # fb.get_all_post_comments(DATABASE_NAME, FACEBOOK_ACCESS_TOKEN)
-    # fb.reply_to_comments(DATABASE_NAME, FACEBOOK_ACCESS_TOKEN, MODEL_ENGINE, OPEN_AI_API)
+    if TENANTS_CONFIG:
+        # Serves every page listed in the tenant config from one process, see FBPageTools.tenants
+        asyncio.run(run_tenants(TENANTS_CONFIG))
+    else:
+        # Runs Reddit ingest, posting, post and comment sync and replies in one process, see FBPageTools.daemon
+        asyncio.run(run_daemon(DATABASE_NAME, FACEBOOK_PAGE_ID, FACEBOOK_ACCESS_TOKEN, MODEL_ENGINE, OPEN_AI_API,
+                               REDDIT_USER_AGENT, REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET))